@@ -7,7 +7,7 @@ from django.db.models.signals import post_save
 
 from gim.core.models import (Repository, Issue, IssueComment, IssueEvent,
                              PullRequestComment, IssueCommits, CommitComment)
-from gim.core.utils import contribute_to_model
+from gim.core.utils import contribute_to_model, deferrable, merge_post_save_calls, post_save_key
 
 from gim.events.models import Event, EventPart
 
@@ -38,6 +38,7 @@ class _Issue(models.Model):
             self._activity_limpyd_object, created = IssueActivity.get_or_connect(object_id=self.id)
         return self._activity_limpyd_object
 
+    @deferrable(key=lambda issue: issue.pk)
     def ask_for_activity_update(self):
         from gim.activity.tasks import ResetIssueActivity
         ResetIssueActivity.add_job(self.pk, priority=-5, delayed_for=timedelta(minutes=15))
@@ -45,6 +46,7 @@ class _Issue(models.Model):
 contribute_to_model(_Issue, Issue)
 
 
+@deferrable(key=post_save_key, merge=merge_post_save_calls)
 def update_activity_for_fk_link(sender, instance, created, **kwargs):
     if not instance.issue_id:
         return
@@ -67,6 +69,7 @@ post_save.connect(update_activity_for_fk_link, sender=IssueCommits, weak=False,
                   dispatch_uid='update_activity_for_fk_link_IssueCommits')
 
 
+@deferrable(key=post_save_key, merge=merge_post_save_calls)
 def update_activity_for_commit_comment(sender, instance, created, **kwargs):
     try:
         instance.issue = instance.commit.related_commits.all()[0].issue
@@ -80,6 +83,7 @@ post_save.connect(update_activity_for_commit_comment, sender=CommitComment, weak
                   dispatch_uid='update_activity_for_commit_comment')
 
 
+@deferrable(key=post_save_key, merge=merge_post_save_calls)
 def update_activity_for_event_part(sender, instance, created, **kwargs):
     if not instance.event_id or not instance.event.issue_id:
         return
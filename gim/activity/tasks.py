@@ -3,10 +3,12 @@ __all__ = [
 ]
 
 from gim.core.tasks.issue import IssueJob
+from gim.core.utils import bulk_sync
 
 
 class ResetIssueActivity(IssueJob):
     queue_name = 'reset-issue-activity'
+    batch_size = 50
 
     def run(self, queue):
         try:
@@ -14,3 +16,28 @@ class ResetIssueActivity(IssueJob):
         except self.model.DoesNotExist:
             # self.status.hset(STATUSES.CANCELED)
             return False
+
+    @classmethod
+    def run_batch(cls, jobs, queue):
+        """
+        Reset the activity of the issues of all the given jobs, loaded together
+        in one query
+        """
+        issues = cls.model.objects.in_bulk([int(job.identifier.hget()) for job in jobs])
+
+        results = []
+        for job in jobs:
+            issue = issues.get(int(job.identifier.hget()))
+            if issue is None:
+                results.append(False)
+                continue
+            try:
+                # own context to keep its side effects if another job fails
+                with bulk_sync():
+                    issue.activity.update()
+            except Exception, e:
+                results.append(e)
+            else:
+                results.append(None)
+
+        return results
@@ -0,0 +1,395 @@
+"""
+Some micro-benchmarks to run in a shell, to check the cost of some hot paths
+of the github synchronization.
+"""
+
+import json
+import os
+from datetime import datetime, timedelta
+from timeit import default_timer
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from gim import github
+
+
+class Rollback(Exception):
+    pass
+
+
+def _fake_user(login, user_id):
+    return {
+        'login': login,
+        'id': user_id,
+        'avatar_url': 'https://avatars.githubusercontent.com/u/%d?v=2' % user_id,
+        'gravatar_id': '',
+        'url': 'https://api.github.com/users/%s' % login,
+        'html_url': 'https://github.com/%s' % login,
+        'type': 'User',
+        'site_admin': False,
+    }
+
+
+def _fake_date(**delta):
+    return (datetime.utcnow() - timedelta(**delta)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def make_issues_page(nb_issues=100, repository_path='foo/bar'):
+    """
+    Return a json string looking like a page of issues got from the github api
+    with the "full+json" format (with body, body_html and body_text)
+    """
+    now = datetime.utcnow()
+    user = _fake_user
+
+    issues = []
+    for number in range(nb_issues, 0, -1):
+        body = 'Some text about the issue #%d, with a list:\n\n' % number
+        body += '\n'.join('- item %d of the list' % i for i in range(10))
+        url = 'https://api.github.com/repos/%s/issues/%d' % (repository_path, number)
+        issues.append({
+            'url': url,
+            'labels_url': url + '/labels{/name}',
+            'comments_url': url + '/comments',
+            'events_url': url + '/events',
+            'html_url': 'https://github.com/%s/issues/%d' % (repository_path, number),
+            'id': 1000000 + number,
+            'number': number,
+            'title': 'Issue number %d' % number,
+            'user': user('user%d' % (number % 10), 100 + number % 10),
+            'labels': [{
+                'url': 'https://api.github.com/repos/%s/labels/label%d' % (repository_path, i),
+                'name': 'label%d' % i,
+                'color': 'fc2929',
+            } for i in range(number % 4)],
+            'state': 'open' if number % 3 else 'closed',
+            'locked': False,
+            'assignee': user('user%d' % (number % 5), 100 + number % 5) if number % 2 else None,
+            'milestone': None,
+            'comments': number % 7,
+            'created_at': (now - timedelta(days=number)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'updated_at': (now - timedelta(hours=number)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'closed_at': None,
+            'body': body,
+            'body_text': body.replace('- ', ''),
+            'body_html': '<p>%s</p>' % body.replace('\n', '<br />'),
+            'closed_by': None,
+        })
+
+    return json.dumps(issues)
+
+
+def _peak_memory(function, *args):
+    """
+    Run the given function in a forked process and return the peak resident
+    memory of this process, in KB
+    """
+    pid = os.fork()
+    if not pid:
+        try:
+            function(*args)
+        finally:
+            os._exit(0)
+    _, _, rusage = os.wait4(pid, 0)
+    return rusage.ru_maxrss
+
+
+def bench_json_decoding(path=None, iterations=50):
+    """
+    Compare the time and the peak memory needed to decode a page of issues
+    with the different json decoding ways of the github client.
+    If `path` is given, it must be a json file, for example a page of 100
+    issues saved with:
+        curl -H 'Accept: application/vnd.github.v3.full+json' \
+             'https://api.github.com/repos/OWNER/REPO/issues?per_page=100'
+    Else a fake page of 100 issues is used.
+    """
+    if path:
+        with open(path) as f:
+            content = f.read()
+    else:
+        content = make_issues_page()
+
+    def previous_decoding(jsonstr):
+        # the way it was done before JsonObject was used as an object_hook
+        def _obj_hook(pairs):
+            o = github.JsonObject()
+            for k, v in pairs.iteritems():
+                o[str(k)] = v
+            return o
+        return json.loads(jsonstr, object_hook=_obj_hook)
+
+    decoders = [
+        ('JsonObject, str keys (old)', previous_decoding),
+        ('JsonObject', lambda jsonstr: github._parse_json(jsonstr)),
+        ('plain dicts (json)', json.loads),
+    ]
+    if github.fast_json is not None:
+        decoders.append(('plain dicts (ujson)', github.fast_json.loads))
+
+    base_memory = _peak_memory(len, content)
+
+    print('Decoding %d bytes, %d times' % (len(content), iterations))
+    print('%30s  %10s  %12s' % ('', 'ms/decode', 'peak KB'))
+    for name, decoder in decoders:
+        start = default_timer()
+        for i in range(iterations):
+            decoder(content)
+        duration = (default_timer() - start) * 1000 / iterations
+        memory = _peak_memory(decoder, content) - base_memory
+        print('%30s  %10.2f  %12d' % (name, duration, memory))
+
+
+def count_queries(function, *args, **kwargs):
+    """
+    Return the number of sql queries done when calling the given function
+    """
+    with CaptureQueriesContext(connection) as context:
+        function(*args, **kwargs)
+    return len(context)
+
+
+def bench_queries_per_page(repository, nb_issues=100):
+    """
+    Print the number of sql queries needed to save a page of fake issues in
+    the given repository, with and without the bulk loading of existing
+    objects, the first time (creation) and the second one (update).
+    All is done in transactions that are rolled back (but jobs created by
+    signals are kept)
+    """
+    from .managers import SavedObjects
+    from .models import Issue
+
+    defaults = {
+        'fk': {'repository': repository},
+        'related': {'*': {'fk': {'repository': repository}}},
+    }
+
+    content = make_issues_page(nb_issues, repository.full_name)
+
+    def save_page(prefetch):
+        return count_queries(Issue.objects.create_or_update_from_list,
+                             json.loads(content), defaults=defaults,
+                             saved_objects=SavedObjects(), prefetch=prefetch)
+
+    print('Saving %d issues' % nb_issues)
+    print('%10s  %10s  %10s' % ('', 'create', 'update'))
+    for prefetch in (False, True):
+        try:
+            with transaction.atomic():
+                created = save_page(prefetch)
+                updated = save_page(prefetch)
+                raise Rollback
+        except Rollback:
+            pass
+        print('%10s  %10d  %10d' % ('batched' if prefetch else 'one by one',
+                                    created, updated))
+
+
+def make_comments_page(nb_comments=100, repository_path='foo/bar', issue_number=1):
+    """
+    Return a json string looking like a page of comments of an issue got from
+    the github api with the "full+json" format
+    """
+    comments = []
+    for number in range(nb_comments, 0, -1):
+        body = 'Comment number %d, with a `code` part' % number
+        url = 'https://api.github.com/repos/%s/issues/comments/%d' % (repository_path, number)
+        comments.append({
+            'url': url,
+            'html_url': 'https://github.com/%s/issues/%d#issuecomment-%d' % (
+                                            repository_path, issue_number, number),
+            'issue_url': 'https://api.github.com/repos/%s/issues/%d' % (
+                                                    repository_path, issue_number),
+            'id': 2000000 + number,
+            'user': _fake_user('user%d' % (number % 10), 100 + number % 10),
+            'created_at': _fake_date(hours=number * 2),
+            'updated_at': _fake_date(hours=number),
+            'body': body,
+            'body_text': body,
+            'body_html': '<p>%s</p>' % body,
+        })
+    return json.dumps(comments)
+
+
+def make_commits_page(nb_commits=100, repository_path='foo/bar'):
+    """
+    Return a json string looking like a page of commits got from the github api
+    """
+    commits = []
+    for number in range(nb_commits, 0, -1):
+        sha = '%040x' % (3000000 + number)
+        url = 'https://api.github.com/repos/%s/commits/%s' % (repository_path, sha)
+        author = _fake_user('user%d' % (number % 10), 100 + number % 10)
+        commits.append({
+            'url': url,
+            'sha': sha,
+            'html_url': 'https://github.com/%s/commit/%s' % (repository_path, sha),
+            'comments_url': url + '/comments',
+            'commit': {
+                'url': 'https://api.github.com/repos/%s/git/commits/%s' % (repository_path, sha),
+                'author': {'name': author['login'], 'email': '%s@example.com' % author['login'],
+                           'date': _fake_date(hours=number)},
+                'committer': {'name': author['login'], 'email': '%s@example.com' % author['login'],
+                              'date': _fake_date(hours=number)},
+                'message': 'Commit number %d' % number,
+                'tree': {'url': url + '/tree', 'sha': '%040x' % number},
+                'comment_count': 0,
+            },
+            'author': author,
+            'committer': author,
+            'parents': [{'url': url, 'sha': '%040x' % (3000000 + number - 1)}],
+        })
+    return json.dumps(commits)
+
+
+def make_pulls_page(nb_pulls=100, repository_path='foo/bar'):
+    """
+    Return a json string looking like a page of pull requests got from the
+    github api
+    """
+    pulls = json.loads(make_issues_page(nb_pulls, repository_path))
+    for pull in pulls:
+        number = pull['number']
+        sha = '%040x' % (4000000 + number)
+        pull.update({
+            'diff_url': pull['html_url'] + '.diff',
+            'patch_url': pull['html_url'] + '.patch',
+            'issue_url': pull['url'],
+            'merged_at': None,
+            'merge_commit_sha': None,
+            'head': {'label': 'user:branch-%d' % number, 'ref': 'branch-%d' % number,
+                     'sha': sha, 'user': pull['user'], 'repo': None},
+            'base': {'label': 'foo:master', 'ref': 'master',
+                     'sha': '%040x' % 1, 'user': pull['user'], 'repo': None},
+            '_links': {'self': {'href': pull['url']}},
+        })
+    return json.dumps(pulls)
+
+
+def previous_object_fields_from_dict(manager, data, defaults=None, saved_objects=None):
+    """
+    GithubObjectManager.get_object_fields_from_dict as it was before the use of
+    a DeserializationPlan, to compare with the current one
+    """
+    from django.db import models
+    from .ghpool import Connection
+
+    for key in data.keys():
+        if key.startswith('_') or \
+            key.endswith('etag') or \
+            key.endswith('fetched_at') or \
+            key in manager.model.github_ignore:
+            del data[key]
+
+    fields = {'simple': {}, 'fk': {}, 'many': {}}
+
+    for key, value in data.iteritems():
+        field_name = manager.get_matching_field(key)
+        try:
+            field, _, direct, is_m2m = manager.model._meta.get_field_by_name(field_name)
+        except models.FieldDoesNotExist:
+            continue
+
+        if is_m2m or not direct or isinstance(field, models.ForeignKey):
+            if value:
+                model = field.related.parent_model if direct else field.model
+                defaults_related = manager.get_related_defaults(defaults, field_name)
+                if is_m2m or not direct:
+                    fields['many'][field_name] = {
+                        'model': model,
+                        'related_name': field.field.name if hasattr(field, 'field') else None,
+                        'data': value,
+                        'defaults': defaults_related,
+                    }
+                else:
+                    fields['fk'][field_name] = model.objects\
+                        .create_or_update_from_dict(data=value,
+                                                    defaults=defaults_related,
+                                                    saved_objects=saved_objects)
+            else:
+                if is_m2m or not direct:
+                    fields['many'][field_name] = []
+                else:
+                    fields['fk'][field_name] = None
+
+        elif isinstance(field, models.DateTimeField):
+            if value:
+                fields['simple'][field_name] = Connection.parse_date(value)
+            else:
+                fields['simple'][field_name] = None
+
+        else:
+            fields['simple'][field_name] = value
+
+    if defaults:
+        for field_type, default_fields in defaults.iteritems():
+            if field_type not in ('simple', 'fk', 'many'):
+                continue
+            for field_name, value in default_fields.iteritems():
+                if field_name not in fields[field_type]:
+                    fields[field_type][field_name] = value
+
+    return fields
+
+
+def bench_deserialization(repository, paths=None, iterations=20):
+    """
+    Compare the time needed to convert pages of issues, comments, commits and
+    pull requests into fields of our models, with the previous way and with a
+    DeserializationPlan.
+    `paths` can be a dict with "issues", "comments", "commits" and/or "pulls"
+    as keys, and a json file as values, for example a page of comments saved
+    with:
+        curl -H 'Accept: application/vnd.github.v3.full+json' \
+             'https://api.github.com/repos/OWNER/REPO/issues/comments?per_page=100'
+    Else fake pages are used.
+    Related objects (users...) are saved in the database, in a transaction that
+    is rolled back.
+    """
+    from .managers import GithubObjectManager, SavedObjects
+    from .models import Commit, Issue, IssueComment
+
+    pages = [
+        ('issues', Issue, make_issues_page),
+        ('comments', IssueComment, make_comments_page),
+        ('commits', Commit, make_commits_page),
+        ('pulls', Issue, make_pulls_page),
+    ]
+
+    defaults = {
+        'fk': {'repository': repository},
+        'related': {'*': {'fk': {'repository': repository}}},
+    }
+
+    def convert(function, model, content):
+        # decode the content before to only time the conversion
+        pages = [json.loads(content) for i in range(iterations)]
+        saved_objects = SavedObjects()
+        # a first pass to have related objects saved
+        for entry in json.loads(content):
+            function(model.objects, entry, defaults, saved_objects)
+        start = default_timer()
+        for page in pages:
+            for entry in page:
+                function(model.objects, entry, defaults, saved_objects)
+        return (default_timer() - start) * 1000 / iterations
+
+    print('Converting pages, %d times' % iterations)
+    print('%10s  %8s  %12s  %12s' % ('', 'entries', 'ms (before)', 'ms (plan)'))
+    for name, model, make_page in pages:
+        if paths and name in paths:
+            with open(paths[name]) as f:
+                content = f.read()
+        else:
+            content = make_page()
+        try:
+            with transaction.atomic():
+                before = convert(previous_object_fields_from_dict, model, content)
+                after = convert(GithubObjectManager.get_object_fields_from_dict.im_func,
+                                model, content)
+                raise Rollback
+        except Rollback:
+            pass
+        print('%10s  %8d  %12.2f  %12.2f' % (name, len(json.loads(content)), before, after))
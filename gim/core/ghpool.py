@@ -1,3 +1,11 @@
+from contextlib import contextmanager
+from hashlib import sha1
+from httplib import HTTPException
+from random import uniform
+from time import sleep, time
+import socket
+import zlib
+
 from dateutil import parser, tz
 
 from gim.github import GitHub, ApiError, ApiAuthError, ApiNotFoundError
@@ -5,16 +13,242 @@ from gim.github import GitHub, ApiError, ApiAuthError, ApiNotFoundError
 UTC = tz.gettz('UTC')
 
 
+class ResponseCache(object):
+    """
+    Store in redis the last response got from github for each url (and Accept
+    header) by user, to send its etag (or last-modified date) on the next call of the
+    same url, and use the stored body if github tells us nothing changed (304)
+    The stored bodies are compressed, and least recently used ones are removed
+    when their total size is greater than `max_size` (default to the
+    GITHUB_RESPONSE_CACHE_MAX_SIZE setting, 0 to disable the cache)
+    """
+    prefix = 'gim:response-cache'
+
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._database = None
+
+    @property
+    def max_size(self):
+        if self._max_size is None:
+            from django.conf import settings
+            return settings.GITHUB_RESPONSE_CACHE_MAX_SIZE
+        return self._max_size
+
+    @property
+    def connection(self):
+        if self._database is None:
+            from gim.core import get_main_limpyd_database
+            self._database = get_main_limpyd_database()
+        return self._database.connection
+
+    @property
+    def lru_key(self):
+        return '%s:lru' % self.prefix
+
+    @property
+    def size_key(self):
+        return '%s:size' % self.prefix
+
+    def get_key(self, url, accept=None, user=None):
+        """
+        Return the key of the entry for the given url, Accept header and user
+        (username, or token if none): a response is never shared between users,
+        as it may hold private data the other one cannot access
+        """
+        return '%s:%s' % (self.prefix, sha1('%s %s %s' % (
+                                user or '', accept or '', url)).hexdigest())
+
+    def get(self, key):
+        """
+        Return the cached entry (a dict with etag, last-modified, content-type,
+        link and body) for the given key, or None
+        """
+        entry = self.connection.hgetall(key)
+        if not entry or 'body' not in entry:
+            return None
+        self.connection.zadd(self.lru_key, time(), key)
+        entry['body'] = zlib.decompress(entry['body'])
+        return entry
+
+    def set(self, key, headers, content):
+        """
+        Save the content of a response with its etag/last-modified headers (it
+        must have at least one of them), and clean the cache if it's too big
+        """
+        max_size = self.max_size
+        body = zlib.compress(content)
+        size = len(body)
+        if size > max_size:
+            return
+
+        entry = {'body': body, 'size': size}
+        for name in ('etag', 'last-modified', 'content-type', 'link'):
+            value = headers.get(name)
+            if value:
+                entry[name] = value
+
+        old_size = int(self.connection.hget(key, 'size') or 0)
+        pipeline = self.connection.pipeline()
+        pipeline.delete(key)
+        pipeline.hmset(key, entry)
+        pipeline.zadd(self.lru_key, time(), key)
+        pipeline.incrby(self.size_key, size - old_size)
+        total_size = pipeline.execute()[-1]
+
+        if total_size > max_size:
+            self.evict(total_size - max_size)
+
+    def evict(self, size_to_free):
+        """
+        Remove least recently used entries until at least `size_to_free` bytes
+        are freed
+        """
+        while size_to_free > 0:
+            keys = self.connection.zrange(self.lru_key, 0, 9)
+            if not keys:
+                break
+            pipeline = self.connection.pipeline()
+            for key in keys:
+                pipeline.hget(key, 'size')
+            sizes = [int(size or 0) for size in pipeline.execute()]
+            pipeline = self.connection.pipeline()
+            pipeline.delete(*keys)
+            pipeline.zrem(self.lru_key, *keys)
+            pipeline.decrby(self.size_key, sum(sizes))
+            pipeline.execute()
+            size_to_free -= sum(sizes)
+
+    def clear(self):
+        """
+        Remove all entries from the cache
+        """
+        keys = self.connection.zrange(self.lru_key, 0, -1)
+        pipeline = self.connection.pipeline()
+        if keys:
+            pipeline.delete(*keys)
+        pipeline.delete(self.lru_key, self.size_key)
+        pipeline.execute()
+
+
+class RetryPolicy(object):
+    """
+    Decide if a failed github request must be retried, and when.
+    Errors are grouped in classes, each one with its own budget of retries
+    for a request (0 to never retry). The delay before a retry is given by the
+    Retry-After header if any, by the X-RateLimit-Reset header for rate-limit
+    errors, or else is exponential, with some jitter.
+    If the delay is greater than `max_sleep`, we don't wait: the error is
+    raised with a `retry_delay` attribute, that is used by the workers to
+    delay the job instead of retrying it immediately.
+    """
+    budgets = {
+        'network': 3,  # timeouts, connection errors...
+        'server': 5,  # 500, 502, 503, 504
+        'secondary-rate-limit': 2,  # 403/429 with a retry-after/abuse message
+        'rate-limit': 1,  # 403 with no remaining calls
+    }
+    base_delay = 1
+    max_delay = 120
+    max_sleep = 10
+
+    # only retry these methods for errors where the request may have been done
+    idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+    def get_error_class(self, method, exception, response_headers):
+        """
+        Return the class of the given error, or None if it must not be retried
+        """
+        if isinstance(exception, (socket.error, HTTPException)):
+            if method in self.idempotent_methods:
+                return 'network'
+            return None
+
+        if not isinstance(exception, ApiError) or not exception.response:
+            return None
+
+        code = exception.response['code']
+
+        if code in (500, 502, 503, 504):
+            if method in self.idempotent_methods:
+                return 'server'
+            return None
+
+        if code in (403, 429):
+            if response_headers.get('retry-after'):
+                return 'secondary-rate-limit'
+            json = exception.response['json']
+            message = (json.get('message') or '').lower() if isinstance(json, dict) else ''
+            if 'abuse' in message or 'secondary rate limit' in message:
+                return 'secondary-rate-limit'
+            if response_headers.get('x-ratelimit-remaining') == '0':
+                return 'rate-limit'
+
+        return None
+
+    def get_delay(self, error_class, attempt, response_headers):
+        """
+        Return the number of seconds to wait before the given attempt
+        """
+        try:
+            return max(1, int(response_headers['retry-after']))
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        if error_class == 'rate-limit':
+            try:
+                return max(1, int(response_headers['x-ratelimit-reset']) - int(time()) + 1)
+            except (KeyError, TypeError, ValueError):
+                pass
+
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay / 2.0 + uniform(0, delay / 2.0)
+
+    def get_retry(self, method, exception, response_headers, attempts):
+        """
+        Return None if the request must not be retried, or a dict with the
+        error class, the attempt number for this class, the delay, and if we
+        can sleep or must delay the job.
+        `attempts` is a dict used to count retries by error class for the
+        current request, it's updated.
+        """
+        error_class = self.get_error_class(method, exception, response_headers)
+        if error_class is None:
+            return None
+
+        attempt = attempts.get(error_class, 0) + 1
+        if attempt > self.budgets.get(error_class, 0):
+            return None
+        attempts[error_class] = attempt
+
+        delay = self.get_delay(error_class, attempt, response_headers)
+
+        return {
+            'error_class': error_class,
+            'error': str(exception) or exception.__class__.__name__,
+            'attempt': attempt,
+            'delay': delay,
+            'sleep': delay <= self.max_sleep,
+        }
+
+
 class Connection(GitHub):
     """
     A subclass of the default GitHub object to handle a pool of connections,
     one for each username
     """
     pool = {}
+    response_cache = ResponseCache()
+    retry_policy = RetryPolicy()
     ApiError = ApiError
     ApiAuthError = ApiAuthError
     ApiNotFoundError = ApiNotFoundError
 
+    # a lock held by the thread using the connection, released only during
+    # the http requests, so that threads sharing it only run these requests
+    # concurrently (see Repository._fetch_some_prs)
+    shared_lock = None
+
     @staticmethod
     def parse_date(value):
         return parser.parse(value).replace(tzinfo=None)
@@ -72,30 +306,108 @@ class Connection(GitHub):
             self._connection_args['access_token'] = access_token
         super(Connection, self).__init__(username, password, access_token, client_id, client_secret, redirect_uri, scope)
 
-    def _http(self, method, path, request_headers=None, response_headers=None, json_post=True, timeout=None, kw={}):
-        api_error = None
+    def _http(self, method, path, request_headers=None, response_headers=None, json_post=True, timeout=None, kw={}, json_objects=True):
+        """
+        Do the request, retrying it if the retry policy says so. If the retry
+        must be done later, the error is raised with a `retry_delay` attribute
+        """
         if response_headers is None:
             response_headers = {}
+        attempts = {}
+        while True:
+            api_error = retry = None
+            try:
+                return super(Connection, self)._http(method, path, request_headers, response_headers, json_post, timeout, kw, json_objects)
+            except Exception, e:
+                if isinstance(e, ApiError):
+                    api_error = e
+                if self.retry_policy:
+                    retry = self.retry_policy.get_retry(method, e, response_headers, attempts)
+                if not retry:
+                    raise
+                if not retry['sleep']:
+                    e.retry_delay = retry['delay']
+                    raise
+            finally:
+                self.manage_token(
+                    path=path,
+                    method=method,
+                    request_headers=request_headers,
+                    response_headers=response_headers,
+                    kw=kw,
+                    api_error=api_error,
+                    retry=retry
+                )
+            with self._without_shared_lock():
+                sleep(retry['delay'])
+            response_headers.clear()
+
+    def _request(self, method, url, body, headers, timeout):
+        """
+        Use the response cache for GET requests not already conditional, to
+        send the etag (or last-modified date) of the last response for this url
+        and if github returns a 304, return the cached response as if it were
+        a fresh 200 one.
+        Conditional requests made by callers are not cached: they expect the
+        304 to be raised.
+        """
+        cache = self.response_cache
+        if (method != 'GET' or cache is None or not cache.max_size
+                or 'If-None-Match' in headers or 'If-Modified-Since' in headers):
+            return self._send_request(method, url, body, headers, timeout)
+
+        key = cache.get_key(url, headers.get('Accept'), self._connection_args.get('username')
+                                                    or self._connection_args.get('access_token'))
+        entry = cache.get(key)
+        if entry:
+            headers = dict(headers)
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            elif entry.get('last-modified'):
+                headers['If-Modified-Since'] = entry['last-modified']
+
+        code, response_headers, content = self._send_request(
+                                        method, url, body, headers, timeout)
+
+        if code == 304 and entry:
+            # github may not send back these headers with a 304
+            for name in ('content-type', 'link'):
+                if entry.get(name) and not response_headers.get(name):
+                    response_headers[name] = entry[name]
+            return 200, response_headers, entry['body']
+
+        if code == 200 and (response_headers.get('etag') or response_headers.get('last-modified')):
+            cache.set(key, response_headers, content)
+
+        return code, response_headers, content
+
+    @contextmanager
+    def _without_shared_lock(self):
+        """
+        Release the shared lock, if any, while in this context
+        """
+        lock = self.shared_lock
+        if lock is None:
+            yield
+            return
+        lock.release()
         try:
-            return super(Connection, self)._http(method, path, request_headers, response_headers, json_post, timeout, kw)
-        except ApiError, e:
-            api_error = e
-            raise
-        except:
-            raise
+            yield
         finally:
-            self.manage_token(
-                path=path,
-                method=method,
-                request_headers=request_headers,
-                response_headers=response_headers,
-                kw=kw,
-                api_error=api_error
-            )
+            lock.acquire()
+
+    def _send_request(self, method, url, body, headers, timeout):
+        """
+        Do the http request, without holding the shared lock
+        """
+        with self._without_shared_lock():
+            return super(Connection, self)._request(method, url, body, headers, timeout)
 
     def manage_token(self, *args, **kwargs):
         from gim.core.limpyd_models import Token
+        from gim.core.managers import count_synced_object
         Token.update_token_from_gh(self, *args, **kwargs)
+        count_synced_object('api_calls')
 
 
 def parse_header_links(value):
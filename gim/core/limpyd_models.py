@@ -1,6 +1,10 @@
 from datetime import datetime, timedelta
 import json
-from random import choice
+from random import choice, uniform
+from time import time
+from uuid import uuid4
+
+from django.conf import settings
 
 from limpyd import model as lmodel, fields as lfields
 from limpyd.contrib.collection import ExtendedCollectionManager
@@ -36,6 +40,83 @@ class Token(lmodel.RedisModel):
 
     LIMIT = 500
 
+    # api calls reserved on a token when leased, if no estimation is given
+    LEASE_CALLS = 10
+    # seconds after which the calls reserved by a lease are released (the
+    # calls are done, and counted in the remaining ones, or won't be)
+    LEASE_TTL = 60
+
+    # The available tokens are indexed in sorted sets scored by their remaining
+    # api calls: one for all of them, and one by repository and permission. A
+    # set by token keeps the keys of the sorted sets it is in, to update its
+    # score everywhere at once. The leases of a token are in a sorted set, as
+    # "calls:id" scored by their expiry time, and only the live ones are
+    # subtracted from its score when looking for a token to lease.
+    scripts = {
+        'update_score': {
+            # KEYS: set of the index keys of the token
+            # ARGV: token, remaining calls
+            'lua': """
+                local keys = redis.call('smembers', KEYS[1])
+                for i, key in ipairs(keys) do
+                    redis.call('zadd', key, ARGV[2], ARGV[1])
+                end
+                return #keys
+            """,
+        },
+        'lease': {
+            # KEYS: the index to lease a token from
+            # ARGV: calls to reserve, now, ttl of the lease, prefix of the keys
+            #       of the leases of a token, id of the lease
+            'lua': """
+                local calls, now = tonumber(ARGV[1]), tonumber(ARGV[2])
+
+                local function leased(token)
+                    local key = ARGV[4] .. token
+                    redis.call('zremrangebyscore', key, '-inf', now)
+                    local total = 0
+                    for i, lease in ipairs(redis.call('zrange', key, 0, -1)) do
+                        total = total + tonumber(string.match(lease, '^(%d+):'))
+                    end
+                    return total
+                end
+
+                -- tokens are read by decreasing score, and leases only lower
+                -- it, so we can stop when the best one found is better than
+                -- the score of the next token
+                local best, best_available
+                local start, done = 0, false
+                while not done do
+                    local tokens = redis.call('zrevrange', KEYS[1], start, start + 9, 'withscores')
+                    if #tokens == 0 then
+                        break
+                    end
+                    for i = 1, #tokens, 2 do
+                        local score = tonumber(tokens[i + 1])
+                        if best_available and best_available >= score then
+                            done = true
+                            break
+                        end
+                        local available = score - leased(tokens[i])
+                        if not best_available or available > best_available then
+                            best, best_available = tokens[i], available
+                        end
+                    end
+                    start = start + 10
+                end
+
+                if not best or best_available < calls then
+                    return false
+                end
+
+                local key = ARGV[4] .. best
+                redis.call('zadd', key, now + tonumber(ARGV[3]), ARGV[1] .. ':' .. ARGV[5])
+                redis.call('expire', key, tonumber(ARGV[3]) + 1)
+                return best
+            """,
+        },
+    }
+
     @property
     def user(self):
         if not hasattr(self, '_user'):
@@ -47,7 +128,7 @@ class Token(lmodel.RedisModel):
         token, _ = Token.get_or_connect(token=gh._connection_args['access_token'])
         token.update_from_gh(gh, *args, **kwargs)
 
-    def update_from_gh(self, gh, api_error, method, path, request_headers, response_headers, kw):
+    def update_from_gh(self, gh, api_error, method, path, request_headers, response_headers, kw, retry=None):
         """
         Will update the current token object with information from the gh object
         and the error, if not None:
@@ -55,7 +136,7 @@ class Token(lmodel.RedisModel):
         - save the rate_limit limit and remaining, expiring the remaining with
           the reset givent by github
         - save scopes and mark is valid or notes
-        - save the api_error if given
+        - save the api_error if given, with the retry decision if any
         If the remaining call is small (< 10% of the limit), mark the token as
         unavailable and ask for a reset when they will be available
         """
@@ -77,6 +158,10 @@ class Token(lmodel.RedisModel):
                 if api_error.code == 304 or (200 <= api_error.code < 300):
                     is_error = False
 
+        if retry:
+            # an error that will be retried, not always an api one (timeouts)
+            is_error = True
+
         if not is_error:
             self.last_call_ok.hset(str_now)
         else:
@@ -113,6 +198,13 @@ class Token(lmodel.RedisModel):
             else:
                 self.available.hset(1)
 
+        # keep the indexes up to date: the token was just set as available if
+        # we have a rate limit and no unavailability
+        if log_unavailability:
+            self.update_index()
+        elif gh.x_ratelimit_remaining != -1:
+            self.update_index_score(gh.x_ratelimit_remaining)
+
         # ask for a flag every 50 calls, to be sure to have one
         if not (gh.x_ratelimit_remaining+1 or 5000) % 50:
             self.ask_for_reset_flags()
@@ -129,6 +221,8 @@ class Token(lmodel.RedisModel):
                     'headers': response_headers,
                 },
             }
+            if retry:
+                json_data['retry'] = retry
             if api_error:
                 if hasattr(api_error, 'code'):
                     json_data['response']['code'] = api_error.code
@@ -163,6 +257,8 @@ class Token(lmodel.RedisModel):
         if self.valid_scopes.hget() == '1':
             self.available.hset(1)
 
+        self.update_index()
+
         return True
 
     def get_remaining_seconds(self):
@@ -214,18 +310,137 @@ class Token(lmodel.RedisModel):
         if repos_pull:
             self.repos_pull.sadd(*repos_pull)
 
+        self.update_index()
+
+    @classmethod
+    def _call_script(cls, script_name, keys=[], args=[]):
+        """
+        Call the given lua script, registered the first time it is called
+        """
+        conn = cls.get_connection()
+        script = cls.scripts[script_name]
+        if 'script_object' not in script:
+            script['script_object'] = conn.register_script(script['lua'])
+        return script['script_object'](keys=keys, args=args, client=conn)
+
+    @classmethod
+    def get_index_key(cls, repository_pk=None, permission=None):
+        """
+        Return the key of the sorted set indexing the available tokens with the
+        given permission on the given repository, or all of them if no
+        repository or no permission to check
+        """
+        if repository_pk is None or permission not in ('admin', 'push', 'pull'):
+            return cls.make_key(cls._name, 'index')
+        return cls.make_key(cls._name, 'index', repository_pk, permission)
+
+    @classmethod
+    def get_index_keys_key(cls, token=''):
+        """
+        Return the key of the set of the index keys of the given token (or the
+        prefix of these keys if no token)
+        """
+        return cls.make_key(cls._name, 'index-keys', token)
+
+    @classmethod
+    def get_leases_key(cls, token=''):
+        """
+        Return the key of the leases of the given token (or the prefix of these
+        keys if no token)
+        """
+        return cls.make_key(cls._name, 'leases', token)
+
+    def update_index(self):
+        """
+        Put the token in the indexes of all the repositories it can access, if
+        it is available, with its remaining api calls as score, and remove it
+        from all the other ones
+        """
+        token, available = self.hmget('token', 'available')
+        keys_key = self.get_index_keys_key(token)
+
+        keys = set()
+        if available == '1':
+            keys.add(self.get_index_key())
+            for permission in ('admin', 'push', 'pull'):
+                field = getattr(self, 'repos_%s' % permission)
+                keys.update(self.get_index_key(repository_pk, permission)
+                            for repository_pk in field.smembers())
+
+        old_keys = self.connection.smembers(keys_key)
+
+        remaining = int(self.rate_limit_remaining.get() or 0)
+
+        pipeline = self.connection.pipeline()
+        for key in old_keys - keys:
+            pipeline.zrem(key, token)
+        for key in keys:
+            pipeline.zadd(key, remaining, token)
+        pipeline.delete(keys_key)
+        if keys:
+            pipeline.sadd(keys_key, *keys)
+        pipeline.execute()
+
+    def update_index_score(self, remaining):
+        """
+        Update the score of the token in all its indexes, with the given number
+        of remaining api calls. If the token is not indexed yet, fully index it
+        """
+        token = self.token.hget()
+        if not self.database.has_scripting():
+            return self.update_index()
+        if not self._call_script('update_score', keys=[self.get_index_keys_key(token)],
+                                 args=[token, remaining]):
+            self.update_index()
+
+    @classmethod
+    def update_indexes(cls):
+        """
+        Index all the tokens
+        """
+        for token in cls.collection().instances():
+            token.update_index()
+
+    @classmethod
+    def lease(cls, repository_pk=None, permission=None, calls=None):
+        """
+        Return the available token with the most remaining api calls in the
+        index of the given repository and permission (or of all tokens), after
+        atomically reserving `calls` api calls on it for LEASE_TTL seconds, so
+        concurrent workers spread on tokens instead of all using the same one.
+        The remaining calls of a token are the ones in the index minus the ones
+        reserved by its live leases. Return None if no token has enough.
+        """
+        key = cls.get_index_key(repository_pk, permission)
+        args = [calls or cls.LEASE_CALLS, time(), cls.LEASE_TTL,
+                cls.get_leases_key(), uuid4().hex]
+        token = cls._call_script('lease', keys=[key], args=args)
+        if not token:
+            # the tokens may not be indexed yet
+            if cls.get_connection().exists(cls.get_index_key()):
+                return None
+            cls.update_indexes()
+            token = cls._call_script('lease', keys=[key], args=args)
+            if not token:
+                return None
+        try:
+            return cls.get(token=token)
+        except cls.DoesNotExist:
+            return None
+
     @classmethod
-    def get_one_for_repository(cls, repository_pk, permission, available=True, sort_by='-rate_limit_remaining'):
+    def get_one_for_repository(cls, repository_pk, permission, available=True, sort_by='-rate_limit_remaining', calls=None):
+        if available and sort_by == '-rate_limit_remaining' and cls.database.has_scripting():
+            return cls.lease(repository_pk, permission, calls)
         collection = cls.collection()
         if available:
             collection = collection.filter(available=1)
-        collection = cls.collection(available=1)
         if permission == 'admin':
-            collection.filter(repos_admin=repository_pk)
+            collection = collection.filter(repos_admin=repository_pk)
         elif permission == 'push':
-            collection.filter(repos_push=repository_pk)
+            collection = collection.filter(repos_push=repository_pk)
         elif permission == 'pull':
-            collection.filter(repos_pull=repository_pk)
+            collection = collection.filter(repos_pull=repository_pk)
         try:
             if sort_by is None:
                 token = choice(collection.instances())
@@ -237,7 +452,9 @@ class Token(lmodel.RedisModel):
             return token
 
     @classmethod
-    def get_one(cls, available=True, sort_by='-rate_limit_remaining'):
+    def get_one(cls, available=True, sort_by='-rate_limit_remaining', calls=None):
+        if available and sort_by == '-rate_limit_remaining' and cls.database.has_scripting():
+            return cls.lease(calls=calls)
         collection = cls.collection()
         if available:
             collection = collection.filter(available=1)
@@ -256,3 +473,402 @@ class Token(lmodel.RedisModel):
         from .ghpool import Connection
         username, token = self.hmget('username', 'token')
         return Connection.get(username=username, access_token=token)
+
+
+class ModelFingerprints(lmodel.RedisModel):
+    """
+    Store, for a model, the fingerprints of the json payloads of its objects
+    the last time they were saved from github, to skip unchanged objects.
+    All fingerprints of a model are in one hash, with keys computed from the
+    filters used to get the objects.
+    """
+
+    database = get_main_limpyd_database()
+
+    model_name = lfields.InstanceHashField(unique=True)
+    fingerprints = lfields.HashField()
+
+    @classmethod
+    def get_for_model(cls, model):
+        return cls.get_or_connect(model_name=model._meta.object_name)[0]
+
+
+class SyncCursor(lmodel.RedisModel):
+    """
+    Keep where we are in the fetch of a list of objects of a github object
+    (the issues of a repository...), page by page, to be able to resume it
+    where it stopped if the job doing it was stopped.
+    """
+
+    database = get_main_limpyd_database()
+    collection_manager = ExtendedCollectionManager
+
+    object_key = lfields.InstanceHashField(indexable=True)  # like "Repository:42"
+    list_name = lfields.InstanceHashField(indexable=True)  # like "issues"
+    last_page = lfields.InstanceHashField()  # last page saved in the database
+    total_pages = lfields.InstanceHashField()  # number of pages if known
+    etag = lfields.InstanceHashField()  # etag of the last page saved
+    item_date = lfields.InstanceHashField()  # date of the last object saved
+    done = lfields.InstanceHashField()  # if the end of the list was reached
+    updated_at = lfields.InstanceHashField()
+    pages = lfields.HashField()  # number of objects saved for each page
+
+    @staticmethod
+    def get_object_key(obj):
+        return '%s:%s' % (obj._meta.object_name, obj.pk)
+
+    @classmethod
+    def get_for(cls, obj, list_name):
+        return cls.get_or_connect(object_key=cls.get_object_key(obj),
+                                  list_name=list_name)[0]
+
+    @classmethod
+    def get_all_for(cls, obj):
+        return cls.collection(object_key=cls.get_object_key(obj)).instances()
+
+    @classmethod
+    def delete_all_for(cls, obj):
+        for cursor in cls.get_all_for(obj):
+            cursor.delete()
+
+    def get_resume_page(self, first_page):
+        """
+        Return the page from which to fetch the list when asked to start at
+        `first_page`, or None if the end of the list was already reached.
+        """
+        done, last_page = self.hmget('done', 'last_page')
+        if done == '1':
+            return None
+        return max(first_page, int(last_page or 0) + 1)
+
+    def count_objects(self, first_page, last_page=None):
+        """
+        Return the number of objects saved for the pages between the two given
+        ones (included)
+        """
+        return sum(int(count) for page, count in self.pages.hgetall().iteritems()
+                   if int(page) >= first_page and (last_page is None or int(page) <= last_page))
+
+    def save_page(self, page, nb_objects, etag=None, item_date=None, total_pages=None):
+        """
+        Save that the given page was saved in the database
+        """
+        self.pages.hset(page, nb_objects)
+        fields = {
+            'last_page': page,
+            'etag': etag or '',
+            'item_date': str(item_date) if item_date else '',
+            'updated_at': str(datetime.utcnow()),
+        }
+        if total_pages:
+            fields['total_pages'] = total_pages
+        self.hmset(**fields)
+
+    def set_done(self):
+        self.hmset(done=1, updated_at=str(datetime.utcnow()))
+
+
+class FirstFetchPlan(lmodel.RedisModel):
+    """
+    Keep the shards (ranges of pages of a list, like "comments#11") of the
+    first fetch of a repository, fetched in parallel by FirstFetchShard jobs,
+    to know which ones are running and when all of them are done.
+    """
+
+    database = get_main_limpyd_database()
+
+    repository_id = lfields.InstanceHashField(unique=True)
+    shards = lfields.HashField()  # number of fetched objects by shard, empty if not done
+    running_shards = lfields.SortedSetField()  # shards currently fetched => start timestamp
+
+    # a shard running for longer is considered lost (its worker was killed)
+    RUNNING_TIMEOUT = 3600
+
+    @classmethod
+    def get_for(cls, repository):
+        return cls.get_or_connect(repository_id=repository.pk)[0]
+
+    def add_shard(self, shard):
+        # don't reset a shard already done
+        self.shards.hsetnx(shard, '')
+
+    def remove_lost_shards(self):
+        self.running_shards.zremrangebyscore('-inf', time() - self.RUNNING_TIMEOUT)
+
+    def count_running(self):
+        self.remove_lost_shards()
+        return self.running_shards.zcard()
+
+    def start_shard(self, shard, max_running):
+        """
+        Mark the given shard as running, if there is less than `max_running`
+        shards running. Return False if not.
+        """
+        self.remove_lost_shards()
+        self.running_shards.zadd(time(), shard)
+        if self.running_shards.zcard() > max_running:
+            self.running_shards.zrem(shard)
+            return False
+        return True
+
+    def stop_shard(self, shard):
+        self.running_shards.zrem(shard)
+
+    def set_shard_done(self, shard, count):
+        self.shards.hset(shard, count)
+
+    def is_done(self):
+        return all(count != '' for count in self.shards.hvals())
+
+    def get_counts(self):
+        """
+        Return the number of fetched objects by list, for the done shards
+        """
+        counts = {}
+        for shard, count in self.shards.hgetall().iteritems():
+            if count != '':
+                list_name = shard.split('#')[0]
+                counts[list_name] = counts.get(list_name, 0) + int(count)
+        return counts
+
+
+class IssueSyncState(lmodel.RedisModel):
+    """
+    Keep, for an issue, a signature of the values of its header (updated_at,
+    comments_count, head_sha...) when each of its sub-resources (events,
+    comments, commits...) was last fetched, to only fetch again the ones that
+    may have changed (see Issue.fetch_all)
+    """
+
+    database = get_main_limpyd_database()
+
+    issue_id = lfields.InstanceHashField(unique=True)
+    signatures = lfields.HashField()  # signature of the header by sub-resource
+
+    @classmethod
+    def get_for(cls, issue):
+        return cls.get_or_connect(issue_id=issue.pk)[0]
+
+    @classmethod
+    def delete_for(cls, issue):
+        try:
+            cls.get(issue_id=issue.pk).delete()
+        except cls.DoesNotExist:
+            pass
+
+
+class RepositoryActivity(lmodel.RedisModel):
+    """
+    Keep, for a job regularly updating a repository (like "FetchForUpdate:42"),
+    an estimate of the rate of changes of the repository, and the api calls
+    the job costs by hour, to compute the delay before its next run (see
+    plan_next_run)
+    """
+
+    database = get_main_limpyd_database()
+
+    job_key = lfields.InstanceHashField(unique=True)
+    changes_rate = lfields.InstanceHashField()  # estimated changes by hour
+    last_run_at = lfields.InstanceHashField()  # timestamp
+    last_change_at = lfields.InstanceHashField()  # timestamp of the last run with changes
+
+    # weight of the last run in the estimate of the changes rate
+    RATE_SMOOTHING = 0.3
+    # without changes for this delay, a repository is considered as dormant
+    DORMANT_AFTER = 7 * 24 * 60 * 60
+
+    @classmethod
+    def get_for(cls, job_name, repository):
+        """
+        Return the activity of the given job for the given repository (or id of
+        a repository, which may not exist anymore)
+        """
+        repository_id = getattr(repository, 'pk', repository)
+        return cls.get_or_connect(job_key='%s:%s' % (job_name, repository_id))[0]
+
+    def plan_next_run(self, nb_changes, api_calls, min_delay, max_delay, hook_set=False):
+        """
+        Update the estimate of the rate of changes with the number of changes
+        found by the job that just ran, and return the delay before the next
+        run, within the given bounds, and the reason of this delay:
+        - the max delay if the repository has a hook, or is dormant
+        - else the delay to expect one change by run
+        The delay is then increased if needed to respect the global budget of
+        api calls by hour, GITHUB_API_BUDGET (with the cost of this run)
+        """
+        now = time()
+        last_run_at, changes_rate, last_change_at = self.hmget(
+                                    'last_run_at', 'changes_rate', 'last_change_at')
+
+        if last_run_at and changes_rate is not None:
+            elapsed_hours = max(now - float(last_run_at), 1) / 3600.0
+            changes_rate = (self.RATE_SMOOTHING * nb_changes / elapsed_hours
+                            + (1 - self.RATE_SMOOTHING) * float(changes_rate))
+        else:
+            # first run: we know nothing about previous changes
+            changes_rate = None
+
+        if nb_changes:
+            last_change_at = now
+
+        if hook_set:
+            delay, reason = max_delay, 'hook set'
+        elif last_change_at and now - float(last_change_at) > self.DORMANT_AFTER:
+            delay, reason = max_delay, 'dormant'
+        elif changes_rate is None:
+            delay, reason = (min_delay + max_delay) / 2, 'first run'
+        elif not changes_rate:
+            delay, reason = max_delay, 'no changes'
+        else:
+            delay = min(max(3600 / changes_rate, min_delay), max_delay)
+            reason = '%.1f changes/h' % changes_rate
+
+        fields = {'last_run_at': now, 'changes_rate': changes_rate or 0}
+        if last_change_at:
+            fields['last_change_at'] = last_change_at
+        self.hmset(**fields)
+
+        delay, over_budget = ApiBudget.get().check(self.job_key.hget(), api_calls, delay)
+        if over_budget:
+            reason += ', api budget x%.1f' % over_budget
+
+        # spread the runs of repositories planned at the same time
+        return int(delay * uniform(1, 1.1)), reason
+
+    def stop(self):
+        """
+        To call when the job won't run again, to free its api budget
+        """
+        ApiBudget.get().remove(self.job_key.hget())
+
+
+class ApiBudget(lmodel.RedisModel):
+    """
+    Keep the api calls by hour planned by each job regularly updating a
+    repository (see RepositoryActivity), to respect a global budget
+    """
+
+    database = get_main_limpyd_database()
+
+    name = lfields.InstanceHashField(unique=True)
+    calls_by_hour = lfields.SortedSetField()  # job key => planned calls by hour
+
+    @classmethod
+    def get(cls):
+        return cls.get_or_connect(name='github')[0]
+
+    def check(self, job_key, api_calls, delay):
+        """
+        Save the calls by hour planned for the given job if it runs with the
+        given cost every `delay` seconds, and if the total of all jobs is over
+        the budget, increase the delay in proportion.
+        Return the delay and the factor applied to it (None if not needed)
+        """
+        budget = settings.GITHUB_API_BUDGET
+        self.calls_by_hour.zadd(api_calls * 3600.0 / delay, job_key)
+
+        if not budget:
+            return delay, None
+
+        total = sum(score for _, score in self.calls_by_hour.zrange(0, -1, withscores=True))
+        if total <= budget:
+            return delay, None
+
+        factor = total / budget
+        delay *= factor
+        self.calls_by_hour.zadd(api_calls * 3600.0 / delay, job_key)
+        return delay, factor
+
+    def remove(self, job_key):
+        self.calls_by_hour.zrem(job_key)
+
+
+class PendingCommits(lmodel.RedisModel):
+    """
+    Keep, for a repository, the shas (full or abbreviated) of the commits
+    referenced by events or comments that we don't have, to be fetched in
+    batches by a FetchPendingCommits job, and the jobs waiting for them, to be
+    added when done.
+    """
+
+    database = get_main_limpyd_database()
+
+    repository_id = lfields.InstanceHashField(unique=True)
+    shas = lfields.SetField()  # shas to fetch
+    with_files = lfields.SetField()  # shas for which we need the files
+    waiting = lfields.HashField()  # "queue_name#object_id" of a job => "sha#priority"
+
+    @classmethod
+    def get_for(cls, repository_id):
+        return cls.get_or_connect(repository_id=repository_id)[0]
+
+    def add(self, sha, waiting_queue_name=None, waiting_object_id=None, priority=0, with_files=False):
+        self.shas.sadd(sha)
+        if with_files:
+            self.with_files.sadd(sha)
+        if waiting_queue_name:
+            self.waiting.hset('%s#%s' % (waiting_queue_name, waiting_object_id),
+                              '%s#%s' % (sha, priority))
+
+    def remove_shas(self, shas):
+        """
+        Remove the given shas, once done, from the pending ones (but not the
+        ones added in the meantime)
+        """
+        if shas:
+            self.shas.srem(*shas)
+            self.with_files.srem(*shas)
+
+    def pop_waiting(self, shas):
+        """
+        Return, and remove, the jobs waiting for the given shas, as a list of
+        tuples (queue_name, object_id, sha, priority)
+        """
+        jobs = []
+        for key, value in self.waiting.hgetall().iteritems():
+            sha, priority = value.rsplit('#', 1)
+            if sha in shas:
+                queue_name, object_id = key.rsplit('#', 1)
+                jobs.append((queue_name, object_id, sha, int(priority)))
+        if jobs:
+            self.waiting.hdel(*['%s#%s' % job[:2] for job in jobs])
+        return jobs
+
+
+class PendingTemplateUpdates(lmodel.RedisModel):
+    """
+    Keep the keys of the jobs updating cached templates of issues (an issue id,
+    or an object related to issues, like "Milestone#12") that are pending, to
+    add only one job for each until it's run
+    """
+
+    database = get_main_limpyd_database()
+
+    name = lfields.InstanceHashField(unique=True)
+    pending = lfields.SortedSetField()  # key => timestamp of the first demand
+
+    # a demand older than that is considered lost (its job was removed)
+    TIMEOUT = 3600
+
+    @classmethod
+    def get(cls):
+        return cls.get_or_connect(name='issues')[0]
+
+    def is_pending(self, key):
+        score = self.pending.zscore(key)
+        return bool(score) and float(score) > time() - self.TIMEOUT
+
+    def add(self, key):
+        """
+        Mark the given key as pending. Return False if it already was
+        """
+        if self.is_pending(key):
+            return False
+        self.pending.zadd(time(), key)
+        return True
+
+    def remove(self, key):
+        self.pending.zrem(key)
+
+    def get_pending(self):
+        return set(self.pending.zrangebyscore(time() - self.TIMEOUT, '+inf'))
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+
+from gim.core.limpyd_models import FirstFetchPlan, SyncCursor
+from gim.core.models import Repository
+
+
+class Command(BaseCommand):
+    """
+    Show how far along the first fetch of repositories is, using the SyncCursor
+    objects saved by the FirstFetchStep2 jobs for the first page of each list
+    of each repository, and the shards of the following pages (only
+    repositories with a first fetch in progress if none are given)
+    """
+    args = '[owner/repository ...]'
+    help = 'Show the progress of the first fetch of repositories'
+
+    LISTS = ('issues', 'prs', 'issues_events', 'comments', 'pr_comments', 'commit_comments')
+
+    def handle(self, *args, **options):
+        if args:
+            repositories = []
+            for full_name in args:
+                owner, name = full_name.split('/', 1)
+                repositories.append(Repository.objects.get(owner__username=owner, name=name))
+        else:
+            pks = set(int(cursor.object_key.hget().split(':')[1])
+                      for cursor in SyncCursor.collection().instances()
+                      if cursor.object_key.hget().startswith('Repository:'))
+            repositories = Repository.objects.filter(pk__in=pks).order_by('owner__username', 'name')
+
+        if not repositories:
+            self.stdout.write('No first fetch in progress')
+            return
+
+        for repository in repositories:
+            self.stdout.write(repository.full_name)
+            cursors = dict((cursor.list_name.hget(), cursor)
+                           for cursor in SyncCursor.get_all_for(repository))
+            if not cursors:
+                self.stdout.write('    %s' % ('first fetch done' if repository.first_fetch_done
+                                                 else 'first fetch not started'))
+                continue
+            for list_name in self.LISTS:
+                cursor = cursors.get(list_name)
+                if not cursor:
+                    self.stdout.write('    %-16s not started' % list_name)
+                    continue
+                last_page, total_pages, item_date, done, updated_at = cursor.hmget(
+                            'last_page', 'total_pages', 'item_date', 'done', 'updated_at')
+                self.stdout.write('    %-16s page %s/%s, %d objects%s, last object at %s, updated at %s' % (
+                    list_name,
+                    last_page or 0,
+                    total_pages or '?',
+                    cursor.count_objects(1),
+                    ' (done)' if done == '1' else '',
+                    item_date or '?',
+                    updated_at or '?',
+                ))
+            for plan in FirstFetchPlan.collection(repository_id=repository.pk).instances():
+                shards = plan.shards.hgetall()
+                self.stdout.write('    shards: %d/%d done, %d running' % (
+                    len([count for count in shards.values() if count != '']),
+                    len(shards),
+                    plan.count_running(),
+                ))
@@ -0,0 +1,270 @@
+import errno
+import logging
+import os
+import signal
+from ConfigParser import SafeConfigParser
+from importlib import import_module
+from math import ceil
+from optparse import make_option
+from time import sleep, time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils.module_loading import module_has_submodule
+
+logger = logging.getLogger('gim.jobs.supervisor')
+
+
+class WorkersGroup(object):
+    """
+    A group of worker processes listening to the same queues, as defined in a
+    section of the configuration file
+    """
+
+    DEFAULTS = {
+        'processes': '1',
+        'max_processes': '',
+        'jobs_by_process': '100',
+        'max_jobs': '1000',
+        'nice': '0',
+    }
+
+    def __init__(self, name, config):
+        self.name = name
+        self.queues = [queue.strip() for queue in config.get(name, 'queues').split(',')
+                                     if queue.strip()]
+        self.min_processes = config.getint(name, 'processes')
+        self.max_processes = max(self.min_processes,
+                                 int(config.get(name, 'max_processes') or self.min_processes))
+        self.jobs_by_process = config.getint(name, 'jobs_by_process')
+        self.max_jobs = config.getint(name, 'max_jobs')
+        self.nice = config.getint(name, 'nice')
+
+        self.wanted = self.min_processes
+        self.pids = {}  # pid => start time
+
+    def compute_wanted(self, count_jobs):
+        """
+        Set the number of processes wanted for the group, between its limits,
+        depending on the number of jobs waiting (or delayed but ready) in its
+        queues
+        """
+        waiting, delayed, ready = count_jobs(self.queues)
+        wanted = int(ceil(float(waiting + ready) / self.jobs_by_process))
+        self.wanted = min(self.max_processes, max(self.min_processes, wanted))
+        return waiting, delayed, ready
+
+
+class Command(BaseCommand):
+    """
+    Run and supervise processes of workers, for groups of queues defined in a
+    configuration file like this one:
+
+        [DEFAULT]
+        max_jobs = 1000
+
+        [templates]
+        queues = update-issue-tmpl, update-related-issues-tmpl
+        processes = 1
+        max_processes = 4
+        jobs_by_process = 500
+
+        [fetch]
+        queues = fetch-issue-by-number, update-pull-requests, update-repo
+        processes = 2
+        nice = 5
+
+    Queues of a group are listened in the given order, so the first ones have
+    the priority. A group has `processes` processes, and up to `max_processes`
+    if there is more than `jobs_by_process` jobs by process waiting in its
+    queues. A process is restarted after `max_jobs` jobs to bound its memory,
+    or if it crashed. `nice` is added to the niceness of the processes.
+
+    Processes are forked once the django project and all jobs models are
+    loaded, to share memory and start quickly.
+    """
+    args = '<config file>'
+    help = 'Run and supervise the processes of workers defined in a config file'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--check-interval',
+                    action='store',
+                    type='int',
+                    dest='check_interval',
+                    default=30,
+                    help='Seconds between two checks of the queues to scale the workers'),
+    )
+
+    # min delay before restarting a process that crashed just after its start
+    RESTART_DELAY = 5
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('The path of a config file is needed')
+
+        # logs of the supervisor and of the workers
+        jobs_logger = logging.getLogger('gim.jobs')
+        jobs_logger.addHandler(settings.WORKERS_LOGGER_CONFIG['handler'])
+        jobs_logger.setLevel(settings.WORKERS_LOGGER_CONFIG['level'])
+
+        self.groups = self.read_config(args[0])
+        self.check_interval = options['check_interval']
+        self.stopping = False
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        # the processes must not share the database connection
+        connection.close()
+
+        self.supervise()
+
+    def load_job_models(self):
+        """
+        Import the tasks modules of all applications to fill the JobRegistry,
+        and return it
+        """
+        for app in settings.INSTALLED_APPS:
+            module = import_module(app)
+            if module_has_submodule(module, 'tasks'):
+                import_module('%s.tasks' % app)
+
+        from gim.core.tasks import JobRegistry
+        return JobRegistry
+
+    def read_config(self, path):
+        config = SafeConfigParser(WorkersGroup.DEFAULTS)
+        if not config.read(path):
+            raise CommandError('Unable to read the config file %s' % path)
+
+        queue_names = set(J.queue_name for J in self.load_job_models())
+
+        groups = []
+        for name in config.sections():
+            if not config.has_option(name, 'queues'):
+                raise CommandError('No queues for the group %s' % name)
+            group = WorkersGroup(name, config)
+            unknown = set(group.queues) - queue_names
+            if unknown:
+                raise CommandError('Unknown queues for the group %s: %s' % (
+                                   name, ', '.join(sorted(unknown))))
+            groups.append(group)
+
+        if not groups:
+            raise CommandError('No groups of workers in the config file %s' % path)
+
+        return groups
+
+    def stop(self, signum, frame):
+        """
+        Stop the processes (they will end after their current job), then stop
+        """
+        if self.stopping:
+            return
+        logger.warning('Stopping all workers')
+        self.stopping = True
+        for group in self.groups:
+            for pid in group.pids:
+                self.kill(pid)
+
+    def kill(self, pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def start_process(self, group):
+        pid = os.fork()
+        if pid:
+            group.pids[pid] = time()
+            logger.info('[%s] started process %d' % (group.name, pid))
+            return
+
+        # in the child process
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            if group.nice:
+                os.nice(group.nice)
+            from gim.core.tasks.base import Worker
+            Worker(queues=group.queues, max_loops=group.max_jobs).run()
+        except Exception:
+            logger.exception('[%s] process %d failed' % (group.name, os.getpid()))
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def reap_processes(self):
+        """
+        Forget the processes that are done, and return the groups of the ones
+        that crashed just after their start
+        """
+        crashed = set()
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if not pid:
+                break
+            for group in self.groups:
+                if pid in group.pids:
+                    started = group.pids.pop(pid)
+                    if status:
+                        logger.warning('[%s] process %d ended with status %d' % (
+                                       group.name, pid, status))
+                        if time() - started < self.RESTART_DELAY:
+                            crashed.add(group)
+                    else:
+                        logger.info('[%s] process %d ended' % (group.name, pid))
+                    break
+        return crashed
+
+    def scale(self):
+        from gim.core.tasks.utils import count_jobs
+
+        for group in self.groups:
+            before = group.wanted
+            waiting, delayed, ready = group.compute_wanted(count_jobs)
+            if group.wanted != before:
+                logger.info('[%s] %d processes wanted instead of %d (waiting=%d, delayed=%d, ready=%d)' % (
+                            group.name, group.wanted, before, waiting, delayed, ready))
+
+            # stop the most recent processes not wanted anymore
+            extra = sorted(group.pids, key=group.pids.get, reverse=True)[group.wanted:]
+            for pid in extra:
+                self.kill(pid)
+
+    def supervise(self):
+        next_check = 0
+        delayed_groups = {}  # group => time before which it cannot be restarted
+
+        while True:
+            crashed = self.reap_processes()
+
+            if self.stopping:
+                if not any(group.pids for group in self.groups):
+                    break
+                sleep(1)
+                continue
+
+            now = time()
+            for group in crashed:
+                delayed_groups[group] = now + self.RESTART_DELAY
+
+            if now >= next_check:
+                self.scale()
+                next_check = now + self.check_interval
+
+            for group in self.groups:
+                if delayed_groups.get(group, 0) > now:
+                    continue
+                for _ in range(group.wanted - len(group.pids)):
+                    self.start_process(group)
+
+            sleep(1)
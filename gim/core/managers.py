@@ -1,13 +1,17 @@
 
+import hashlib
+import json
 import logging
 import re
 from datetime import datetime
-from time import sleep
+from threading import local
 
-from django.db import models, IntegrityError
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import models, transaction, IntegrityError
 from django.contrib.auth.models import UserManager
 
-from .ghpool import Connection, ApiError
+from .ghpool import Connection
+from .utils import bulk_sync, deferrable, filter_in_chunks
 
 MODE_CREATE = set(('create', ))
 MODE_UPDATE = set(('update', ))
@@ -17,18 +21,184 @@ MODE_ALL = set(('create', 'update'))
 logger = logging.getLogger('django')
 
 
+_sync_counters = local()
+
+
+def reset_sync_counters():
+    """
+    Reset the counters of objects skipped/written, and of api calls, during a
+    sync, for the current thread (done by the workers before running a job)
+    """
+    _sync_counters.counts = {'skipped': 0, 'written': 0, 'api_calls': 0}
+
+
+def get_sync_counters():
+    """
+    Return the counters of objects skipped/written, and of api calls, during a
+    sync since the last call to reset_sync_counters, for the current thread
+    """
+    if getattr(_sync_counters, 'counts', None) is None:
+        reset_sync_counters()
+    return _sync_counters.counts
+
+
+def count_synced_object(kind):
+    """
+    Increment the "skipped", "written" or "api_calls" counter of the current
+    thread
+    """
+    get_sync_counters()[kind] += 1
+
+
+def merge_fingerprints_calls(previous, new):
+    """
+    To use as `merge` for save_fingerprints: the new fingerprints are added to
+    the previous ones, replacing them for the same keys
+    """
+    (model, fingerprints), kwargs = previous
+    fingerprints = fingerprints.copy()
+    fingerprints.update(new[0][1])
+    return (model, fingerprints), kwargs
+
+
+@deferrable(key=lambda model, fingerprints: model, merge=merge_fingerprints_calls)
+def save_fingerprints(model, fingerprints):
+    """
+    Save the given fingerprints (a dict with keys computed from the filters of
+    objects) for the given model, or remove the ones set to None. Deferrable to
+    only save them when the objects are really saved, in one call by model.
+    """
+    from .limpyd_models import ModelFingerprints
+    field = ModelFingerprints.get_for_model(model).fingerprints
+    to_set = dict((key, fingerprint) for key, fingerprint in fingerprints.iteritems()
+                                     if fingerprint is not None)
+    to_remove = [key for key, fingerprint in fingerprints.iteritems() if fingerprint is None]
+    if to_set:
+        field.hmset(**to_set)
+    if to_remove:
+        field.hdel(*to_remove)
+
+
 class SavedObjects(dict):
     """
     A simple dict with two helpers to get/set saved objects during a fetch, to
-    avoid getting/setting them many time from/to the database
+    avoid getting/setting them many time from/to the database.
+    It also holds objects "prefetched" from the database in bulk, before being
+    created/updated, with None for the ones known to not exist yet.
+    If created with `bulk_updates=True`, existing objects without changes are
+    not saved one by one: they are kept to be updated all at once by calling
+    flush_pending_updates.
+    If created with `use_fingerprints=True`, objects in lists whose payload did
+    not change since the last time they were saved are not saved at all (see
+    GithubObjectManager.check_fingerprints)
     """
 
+    def __init__(self, *args, **kwargs):
+        bulk_updates = kwargs.pop('bulk_updates', False)
+        self.use_fingerprints = kwargs.pop('use_fingerprints', False)
+        super(SavedObjects, self).__init__(*args, **kwargs)
+        self.prefetched = {}
+        self.pending_updates = {} if bulk_updates else None
+
     def get_object(self, model, filters):
         return self[model][tuple(sorted(filters.items()))]
 
     def set_object(self, model, filters, obj, saved=False):
         self.setdefault(model, {})[tuple(sorted(filters.items()))] = obj
 
+    def get_prefetched_object(self, model, filters):
+        return self.prefetched[model][tuple(sorted(filters.items()))]
+
+    def set_prefetched_object(self, model, filters, obj):
+        self.prefetched.setdefault(model, {})[tuple(sorted(filters.items()))] = obj
+
+    def is_known(self, model, filters):
+        """
+        Return True if the object for the given filters is already saved or
+        prefetched (even if known to not exist)
+        """
+        key = tuple(sorted(filters.items()))
+        return key in self.get(model, {}) or key in self.prefetched.get(model, {})
+
+    def add_pending_update(self, model, fetched_at_field, obj):
+        self.pending_updates.setdefault((model, fetched_at_field), []).append(obj.pk)
+
+    def flush_pending_updates(self):
+        """
+        Update the fetched_at field and the github status of all objects kept
+        by add_pending_update, with one query by model (and by chunk)
+        """
+        if not self.pending_updates:
+            return
+        now = datetime.utcnow()
+        for (model, fetched_at_field), pks in self.pending_updates.items():
+            for queryset in filter_in_chunks(model.objects.all(), 'pk', pks):
+                queryset.update(**{
+                    fetched_at_field: now,
+                    'github_status': model.GITHUB_STATUS_CHOICES.FETCHED,
+                })
+        self.pending_updates = {}
+
+
+_deserialization_plans = {}
+
+
+class DeserializationPlan(object):
+    """
+    Tell, for each key of json data got from github, what to do to convert it
+    into a field of the given model, to avoid computing it again for every
+    object (see GithubObjectManager.get_object_fields_from_dict)
+    Each key is compiled the first time it is seen, into a tuple with the kind
+    of the entry (DROP, SKIP, SIMPLE, DATETIME, FK, MANY), the name of the
+    field, and, for FK and MANY, the related model and the related name.
+    """
+
+    DROP, SKIP, SIMPLE, DATETIME, FK, MANY = range(6)
+
+    def __init__(self, model):
+        self.model = model
+        self.ignore = frozenset(model.github_ignore)
+        self.entries = {}
+
+    def get(self, key):
+        try:
+            return self.entries[key]
+        except KeyError:
+            entry = self.entries[key] = self.compile(key)
+            return entry
+
+    def compile(self, key):
+        """
+        Return the entry (see the class docstring) for the given json key
+        """
+        # keys to remove from the data
+        if key.startswith('_') or key.endswith('etag') or \
+                key.endswith('fetched_at') or key in self.ignore:
+            return (self.DROP, None, None, None)
+
+        # maybe we use a different field name on our side
+        field_name = self.model.github_matching.get(key, key)
+
+        try:
+            field, _, direct, is_m2m = self.model._meta.get_field_by_name(field_name)
+        except models.FieldDoesNotExist:
+            # there is not field for the given key
+            return (self.SKIP, None, None, None)
+
+        # TODO: manage OneToOneField, not yet used in our models
+        if is_m2m or not direct:  # not sure: a list for a "not direct ?" (a through ?)
+            return (self.MANY, field_name,
+                    field.related.parent_model if direct else field.model,
+                    field.field.name if hasattr(field, 'field') else None)
+
+        if isinstance(field, models.ForeignKey):
+            return (self.FK, field_name, field.related.parent_model, None)
+
+        if isinstance(field, models.DateTimeField):
+            return (self.DATETIME, field_name, None, None)
+
+        return (self.SIMPLE, field_name, None, None)
+
 
 class BaseManager(models.Manager):
 
@@ -99,19 +269,40 @@ class GithubObjectManager(BaseManager):
             request_headers=request_headers,
             response_headers=response_headers
         )
-        if isinstance(data, list):
-            result = self.create_or_update_from_list(data, modes, defaults,
-                        min_date=min_date, fetched_at_field=fetched_at_field,
-                        saved_objects=SavedObjects(), force_update=force_update)
-        else:
-            result = self.create_or_update_from_dict(data, modes, defaults,
-                                            fetched_at_field=fetched_at_field,
-                                            saved_objects=SavedObjects(),
-                                            force_update=force_update,)
-            if not result:
-                raise Exception(
-                    "Unable to create/update an object of the %s kind (modes=%s)" % (
-                        self.model.__name__, ','.join(modes)))
+        return self.create_or_update_from_data(data, modes, defaults,
+                                               min_date=min_date,
+                                               fetched_at_field=fetched_at_field,
+                                               force_update=force_update)
+
+    def create_or_update_from_data(self, data, modes=MODE_ALL, defaults=None,
+                                   min_date=None, fetched_at_field='fetched_at',
+                                   force_update=False):
+        """
+        Create or update objects from data got from github (a list or a dict),
+        and return the list of objects, or the object.
+        See get_from_github for the min_date argument.
+        All is saved in one transaction, unchanged objects are updated in bulk
+        and side effects of saving objects (signals...) are run at the end.
+        Objects in lists with the same payload as the last time are skipped.
+        """
+        saved_objects = SavedObjects(bulk_updates=True, use_fingerprints=True)
+
+        with bulk_sync(), transaction.atomic():
+            if isinstance(data, list):
+                result = self.create_or_update_from_list(data, modes, defaults,
+                            min_date=min_date, fetched_at_field=fetched_at_field,
+                            saved_objects=saved_objects, force_update=force_update)
+            else:
+                result = self.create_or_update_from_dict(data, modes, defaults,
+                                                fetched_at_field=fetched_at_field,
+                                                saved_objects=saved_objects,
+                                                force_update=force_update,)
+                if not result:
+                    raise Exception(
+                        "Unable to create/update an object of the %s kind (modes=%s)" % (
+                            self.model.__name__, ','.join(modes)))
+
+            saved_objects.flush_pending_updates()
 
         return result
 
@@ -124,19 +315,11 @@ class GithubObjectManager(BaseManager):
         gh_callable = self.get_github_callable(gh, identifiers)
         if not parameters:
             parameters = {}
-        # we'll accept some 502 errors
-        tries = 0
-        while tries < 5:
-            try:
-                return gh_callable.get(request_headers=request_headers,
-                                       response_headers=response_headers,
-                                       **parameters)
-            except ApiError, e:
-                if e.response and e.response['code'] == 502:
-                    tries += 1
-                    sleep(1)
-                else:
-                    raise
+        # errors worth a retry are managed by the retry policy of the connection
+        return gh_callable.get(request_headers=request_headers,
+                               response_headers=response_headers,
+                               json_objects=False,
+                               **parameters)
 
     def get_matching_field(self, field_name):
         """
@@ -146,29 +329,279 @@ class GithubObjectManager(BaseManager):
         """
         return self.model.github_matching.get(field_name, field_name)
 
+    def get_json_key(self, field_name):
+        """
+        Return the key of the json data from github holding the value of the
+        given field (the opposite of get_matching_field)
+        """
+        for key, name in self.model.github_matching.iteritems():
+            if name == field_name:
+                return key
+        return field_name
+
+    def get_related_defaults(self, defaults, field_name):
+        """
+        Return the "defaults" dict to use to create/update objects of the given
+        FK/m2m/related field (see get_object_fields_from_dict)
+        """
+        defaults_related = {}
+        if defaults and 'related' in defaults:
+            if field_name in defaults['related']:
+                defaults_related = defaults['related'][field_name]
+            elif field_name in defaults['related'].get('*', {}):
+                defaults_related = defaults['related']['*'][field_name]
+            if '*' in defaults['related'] and '*' not in defaults_related:
+                defaults_related.update(defaults['related']['*'])
+        return defaults_related
+
+    def get_filters_from_data(self, data, defaults=None):
+        """
+        Return the filters to retrieve the object matching the given json data,
+        like get_filters_from_identifiers but without creating/updating related
+        objects: the objects for FK identifiers are only taken from defaults.
+        Return None if filters cannot be computed this way.
+        """
+        filters = {}
+        for field, lookup in self.model.github_identifiers.items():
+            if isinstance(lookup, (tuple, list)):
+                # ignore if we have data for this fk, it will be used instead
+                # of the default
+                if data.get(self.get_json_key(lookup[0])):
+                    return None
+                try:
+                    filters[field] = getattr(defaults['fk'][lookup[0]], lookup[1])
+                except (KeyError, TypeError, AttributeError):
+                    return None
+            else:
+                value = data.get(self.get_json_key(lookup))
+                if value is None or isinstance(value, (dict, list)):
+                    return None
+                filters[field] = value
+        return filters
+
+    def prefetch_from_list(self, data, defaults=None, saved_objects=None):
+        """
+        Load in bulk (one query by model) the existing objects matching the
+        given list of json objects, and the ones in their FKs and m2m lists,
+        and save them as prefetched in saved_objects, to avoid one query by
+        object when creating/updating them.
+        """
+        if saved_objects is None:
+            saved_objects = SavedObjects()
+
+        entries_filters = []
+        related = {}
+        plan = self.get_deserialization_plan()
+
+        for entry in data:
+            if not isinstance(entry, dict):
+                continue
+
+            filters = self.get_filters_from_data(entry, defaults)
+            if filters and not saved_objects.is_known(self.model, filters):
+                entries_filters.append(filters)
+
+            # collect data of related objects, by field
+            for key, value in entry.iteritems():
+                if not value:
+                    continue
+                kind, field_name, model, _ = plan.get(key)
+                if kind not in (plan.FK, plan.MANY):
+                    continue
+                if field_name not in related:
+                    related[field_name] = (
+                        model,
+                        self.get_related_defaults(defaults, field_name),
+                        [],
+                    )
+                if isinstance(value, list):
+                    related[field_name][2].extend(value)
+                else:
+                    related[field_name][2].append(value)
+
+        self.prefetch_from_filters(entries_filters, saved_objects)
+
+        for model, defaults_related, values in related.values():
+            if hasattr(model.objects, 'prefetch_from_list'):
+                model.objects.prefetch_from_list(values, defaults_related, saved_objects)
+
+    def prefetch_from_filters(self, filters_list, saved_objects):
+        """
+        Load objects matching the given list of filters using "IN" queries, and
+        save them (or None if not found) as prefetched in saved_objects.
+        Only done if all filters differ by the same single simple field.
+        """
+        if not filters_list:
+            return
+
+        constants = dict((field, value) for field, value in filters_list[0].items()
+                         if all(filters[field] == value for filters in filters_list))
+        varying = [field for field in filters_list[0] if field not in constants]
+        if len(varying) > 1 or varying and '__' in varying[0]:
+            return
+
+        found = {}
+        if not varying:
+            for obj in self.filter(**constants)[:1]:
+                found[tuple(sorted(constants.items()))] = obj
+        else:
+            field = varying[0]
+            values = set(filters[field] for filters in filters_list)
+            for queryset in filter_in_chunks(self.filter(**constants), field,
+                                             values, margin=50 + len(constants)):
+                for obj in queryset:
+                    key = dict(constants)
+                    key[field] = getattr(obj, field)
+                    found[tuple(sorted(key.items()))] = obj
+
+        for filters in filters_list:
+            saved_objects.set_prefetched_object(self.model, filters,
+                                    found.get(tuple(sorted(filters.items()))))
+
     def create_or_update_from_list(self, data, modes=MODE_ALL, defaults=None,
                                 min_date=None, fetched_at_field='fetched_at',
-                                saved_objects=None, force_update=False):
+                                saved_objects=None, force_update=False,
+                                prefetch=True):
         """
         Take a list of json objects, call create_or_update for each one, and
         return the list of touched objects. Objects that cannot be created are
         not returned.
+        If `prefetch` is True, existing objects are first loaded in bulk (see
+        prefetch_from_list)
         """
         if saved_objects is None:
             saved_objects = SavedObjects()
 
+        if prefetch:
+            self.prefetch_from_list(data, defaults, saved_objects)
+
+        if saved_objects.use_fingerprints and not force_update:
+            checks = self.check_fingerprints(data, defaults, saved_objects)
+        else:
+            checks = [(None, None, None)] * len(data)
+
         objs = []
-        for entry in data:
-            obj = self.create_or_update_from_dict(entry, modes, defaults,
+        new_fingerprints = {}
+        for entry, (key, fingerprint, unchanged_obj) in zip(data, checks):
+            if unchanged_obj:
+                obj = unchanged_obj
+                count_synced_object('skipped')
+            else:
+                obj = self.create_or_update_from_dict(entry, modes, defaults,
                                 fetched_at_field, saved_objects, force_update)
+                if obj and saved_objects.use_fingerprints:
+                    count_synced_object('written')
+                    if key:
+                        new_fingerprints[key] = fingerprint
             if obj:
                 objs.append(obj)
                 if min_date and obj.github_date_field:
                     obj_min_date = getattr(obj, obj.github_date_field[0])
                     if obj_min_date and obj_min_date < min_date:
                         break
+
+        if new_fingerprints:
+            save_fingerprints(self.model, new_fingerprints)
+
         return objs
 
+    def get_fingerprint(self, data, defaults=None):
+        """
+        Return a short hash of the given json data, and of the defaults that
+        would be used to save it.
+        Must be called before the data is altered by get_object_fields_from_dict
+        """
+        defaults = defaults or {}
+        payload = [
+            data,
+            dict((field, getattr(value, 'pk', value))
+                 for field, value in defaults.get('fk', {}).iteritems()),
+            defaults.get('simple'),
+        ]
+        return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str)).hexdigest()[:16]
+
+    def get_fingerprint_key(self, filters):
+        """
+        Return the key used to store the fingerprint of the object matching the
+        given filters
+        """
+        return json.dumps(sorted(filters.items()), default=str)
+
+    def forget_fingerprint(self, obj):
+        """
+        Remove the fingerprint of the given object, to call when it's saved
+        (or deleted) in another way than from a list, so it's not skipped in
+        the next list with a payload matching a previous state
+        """
+        identifiers = getattr(self.model, 'github_identifiers', None)
+        if not identifiers:
+            return
+        filters = {}
+        for field, lookup in identifiers.items():
+            try:
+                if isinstance(lookup, (tuple, list)):
+                    value = getattr(getattr(obj, lookup[0]), lookup[1])
+                else:
+                    value = getattr(obj, lookup)
+            except (ObjectDoesNotExist, AttributeError):
+                return
+            if value is None:
+                return
+            filters[field] = value
+        save_fingerprints(self.model, {self.get_fingerprint_key(filters): None})
+
+    def check_fingerprints(self, data, defaults, saved_objects):
+        """
+        For each entry of the given list of json objects, return a tuple with
+        the key to store its fingerprint, the fingerprint itself, and the
+        existing object if its fingerprint didn't change since it was saved (the
+        object must also be marked as fetched), else None.
+        The key and fingerprint are None if the filters to get the object cannot
+        be computed from the data.
+        """
+        from .limpyd_models import ModelFingerprints
+
+        checks = []
+        for entry in data:
+            filters = self.get_filters_from_data(entry, defaults) if isinstance(entry, dict) else None
+            if not filters:
+                checks.append((None, None, None))
+                continue
+            key = self.get_fingerprint_key(filters)
+            checks.append((key, self.get_fingerprint(entry, defaults), filters))
+
+        keys = [key for key, _, _ in checks if key]
+        if not keys:
+            return checks
+        stored = dict(zip(keys, ModelFingerprints.get_for_model(self.model)
+                                                 .fingerprints.hmget(*keys)))
+
+        result = []
+        for key, fingerprint, filters in checks:
+            obj = None
+            if key and stored[key] == fingerprint:
+                obj = self.get_known_object(filters, saved_objects)
+                if obj and obj.github_status != obj.GITHUB_STATUS_CHOICES.FETCHED:
+                    obj = None
+            result.append((key, fingerprint, obj))
+        return result
+
+    def get_known_object(self, filters, saved_objects):
+        """
+        Return the object matching the given filters, from the ones in
+        saved_objects (saved or prefetched) or else from the database.
+        Return None if it doesn't exist.
+        """
+        for getter in (saved_objects.get_object, saved_objects.get_prefetched_object):
+            try:
+                return getter(self.model, filters)
+            except KeyError:
+                pass
+        try:
+            return self.get(**filters)
+        except self.model.DoesNotExist:
+            return None
+
     def get_filters_from_identifiers(self, fields, identifiers=None):
         """
         Return the filters to use as argument to a Queryset to retrieve an
@@ -207,6 +640,15 @@ class GithubObjectManager(BaseManager):
             return saved_objects.get_object(self.model, filters), True
         except KeyError:
             pass
+        try:
+            obj = saved_objects.get_prefetched_object(self.model, filters)
+        except KeyError:
+            pass
+        else:
+            if obj is None:
+                return None, False
+            saved_objects.set_object(self.model, filters, obj)
+            return obj, False
         try:
             obj = self.get(**filters)
             saved_objects.set_object(self.model, filters, obj)
@@ -299,6 +741,11 @@ class GithubObjectManager(BaseManager):
             setattr(obj, fetched_at_field, datetime.utcnow())
             obj.github_status = obj.GITHUB_STATUS_CHOICES.FETCHED
 
+            # nothing changed, update these two fields later with other ones
+            if not to_create and not updated_fields and saved_objects.pending_updates is not None:
+                saved_objects.add_pending_update(self.model, fetched_at_field, obj)
+                return obj, False
+
             # force update or insert to avoid a exists() call in db
             if to_create:
                 save_params = {'force_insert': True}
@@ -355,6 +802,16 @@ class GithubObjectManager(BaseManager):
 
         return obj
 
+    def get_deserialization_plan(self):
+        """
+        Return the DeserializationPlan of the model, created only once
+        """
+        try:
+            return _deserialization_plans[self.model]
+        except KeyError:
+            plan = _deserialization_plans[self.model] = DeserializationPlan(self.model)
+            return plan
+
     def get_object_fields_from_dict(self, data, defaults=None, saved_objects=None):
         """
         Taking a dict (passed in the data argument), return the fields to use
@@ -373,12 +830,11 @@ class GithubObjectManager(BaseManager):
         will be the "defaults" dict used to create/update "foo)
         """
 
+        plan = self.get_deserialization_plan()
+
         # reduce data to keep only wanted fields
         for key in data.keys():
-            if key.startswith('_') or \
-                key.endswith('etag') or \
-                key.endswith('fetched_at') or \
-                key in self.model.github_ignore:
+            if plan.get(key)[0] == plan.DROP:
                 del data[key]
 
         if saved_objects is None:
@@ -390,73 +846,39 @@ class GithubObjectManager(BaseManager):
             'many': {}
         }
 
-        # run for each field in the dict
+        # run for each field in the dict, using the plan to know what to do
         for key, value in data.iteritems():
+            kind, field_name, model, related_name = plan.get(key)
 
-            # maybe we use a different field name on our side
-            field_name = self.get_matching_field(key)
+            if kind == plan.SIMPLE:
+                fields['simple'][field_name] = value
 
-            try:
-                # get informations about the field
-                field, _, direct, is_m2m = self.model._meta.get_field_by_name(field_name)
-            except models.FieldDoesNotExist:
-                # there is not field for the given key, we pass to the next key
-                continue
+            elif kind == plan.DATETIME:
+                # all github datetime are utc, so we can remove the timezome
+                fields['simple'][field_name] = Connection.parse_date(value) if value else None
 
-            # work depending of the field type
-            # TODO: nanage OneToOneField, not yet used in our models
-            if is_m2m or not direct or isinstance(field, models.ForeignKey):
-                # we have many objects to create: m2m
-                # or we have an external object to create: fk
+            elif kind == plan.FK:
                 if value:
-                    model = field.related.parent_model if direct else field.model
-                    defaults_related = {}
-
-                    if defaults and 'related' in defaults:
-                        if field_name in defaults['related']:
-                            defaults_related = defaults['related'][field_name]
-                        elif field_name in defaults['related'].get('*', {}):
-                            defaults_related = defaults['related']['*'][field_name]
-                        if '*' in defaults['related'] and '*' not in defaults_related:
-                            defaults_related.update(defaults['related']['*'])
-
-                    if is_m2m or not direct:  # not sure: a list for a "not direct ?" (a through ?)
-                        # fields['many'][field_name] = model.objects\
-                        #     .create_or_update_from_list(data=value,
-                        #                                 defaults=defaults_related,
-                        #                                 saved_objects=saved_objects)
-
-                        # pass info to create objects later instead of creating
-                        # them now as the model may need the current object to
-                        # be fully created (a CommitFile need the Commit)
-                        fields['many'][field_name] = {
-                            'model': model,
-                            'related_name': field.field.name if hasattr(field, 'field') else None,
-                            'data': value,
-                            'defaults': defaults_related,
-                        }
-                    else:
-                        fields['fk'][field_name] = model.objects\
-                            .create_or_update_from_dict(data=value,
-                                                        defaults=defaults_related,
-                                                        saved_objects=saved_objects)
+                    fields['fk'][field_name] = model.objects\
+                        .create_or_update_from_dict(data=value,
+                                    defaults=self.get_related_defaults(defaults, field_name),
+                                    saved_objects=saved_objects)
                 else:
-                    if is_m2m or not direct:
-                        fields['many'][field_name] = []
-                    else:
-                        fields['fk'][field_name] = None
+                    fields['fk'][field_name] = None
 
-            elif isinstance(field, models.DateTimeField):
-                # we need to convert a datetimefield
+            elif kind == plan.MANY:
                 if value:
-                    # all github datetime are utc, so we can remove the timezome
-                    fields['simple'][field_name] = Connection.parse_date(value)
+                    # pass info to create objects later instead of creating
+                    # them now as the model may need the current object to
+                    # be fully created (a CommitFile need the Commit)
+                    fields['many'][field_name] = {
+                        'model': model,
+                        'related_name': related_name,
+                        'data': value,
+                        'defaults': self.get_related_defaults(defaults, field_name),
+                    }
                 else:
-                    fields['simple'][field_name] = None
-
-            else:
-                # it's a simple field
-                fields['simple'][field_name] = value
+                    fields['many'][field_name] = []
 
         # add default fields
         if defaults:
@@ -971,19 +1393,29 @@ class CommitManager(WithRepositoryManager):
                 if field in data['stats']:
                     data[field] = data['stats'][field]
 
-        return super(CommitManager, self).get_object_fields_from_dict(
+        fields = super(CommitManager, self).get_object_fields_from_dict(
                                                 data, defaults, saved_objects)
 
+        # files are only given when a commit is fetched alone
+        if fields and 'files' in fields['many']:
+            fields['simple']['files_fetched_at'] = datetime.utcnow()
+
+        return fields
+
     def create_or_update_from_dict(self, data, modes=MODE_ALL, defaults=None,
         fetched_at_field='fetched_at', saved_objects=None, force_update=False):
         """
         In addition to the default create_or_update_from_dict, check if files
-        where fetched and if not, launch a FetchCommitBySha to fetch them
+        where fetched and if not, launch a FetchCommitBySha to fetch them,
+        except if `skip_files_fetch` is set in `defaults` (the files will be
+        fetched only if needed)
         """
         obj = super(CommitManager, self).create_or_update_from_dict(data, modes,
                         defaults, fetched_at_field, saved_objects, force_update)
 
-        if obj and not obj.files_fetched_at:
+        skip_files_fetch = defaults and defaults.get('skip_files_fetch')
+
+        if obj and not obj.files_fetched_at and not skip_files_fetch:
             from gim.core.tasks import FetchCommitBySha
             FetchCommitBySha.add_job(
                 '%s#%s' % (obj.repository_id, obj.sha),
@@ -1042,6 +1474,7 @@ class IssueEventManager(WithIssueManager):
 
     CHECK_REF = re.compile(r'(?:^|\W)#(\d+)(?:[^d]|$)')
 
+    @deferrable(key=lambda manager, obj, *args, **kwargs: (obj.__class__, obj.pk))
     def check_references(self, obj, fields, user_field='user'):
         """
         Check if the given object has references to some issues in its text.
@@ -4,10 +4,15 @@ __all__ = [
 
 from datetime import datetime, timedelta
 from itertools import product
-from math import ceil
+from threading import Lock, local
 from urlparse import urlsplit, parse_qs
 
-from django.db import models, DatabaseError
+from django.conf import settings
+from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from concurrent.futures import ThreadPoolExecutor
 
 from extended_choices import Choices
 
@@ -17,7 +22,13 @@ from ..ghpool import (
     parse_header_links,
     prepare_fetch_headers,
 )
-from ..managers import MODE_ALL, GithubObjectManager
+from ..managers import (
+    MODE_ALL,
+    GithubObjectManager,
+    get_sync_counters,
+    reset_sync_counters,
+)
+from ..utils import bulk_sync, diff_ids, filter_in_chunks, in_chunks
 
 
 class MinDateRaised(Exception):
@@ -137,7 +148,8 @@ class GithubObject(models.Model):
     def _fetch_many(self, field_name, gh, vary=None, defaults=None,
                     parameters=None, remove_missing=True, force_fetch=False,
                     meta_base_name=None, modes=MODE_ALL, max_pages=None,
-                    filter_queryset=None):
+                    filter_queryset=None, parallel_pages=None,
+                    use_sync_cursor=False, delta_sync=False):
         """
         Fetch data from github for the given m2m or related field.
         If defined, "vary" is a dict of list of parameters to fetch. For each
@@ -152,6 +164,19 @@ class GithubObject(models.Model):
         base, simply pass it to the `meta_base_name` argument.
         Mode must be a tuple containing none, one or both of "create" and
         "update". If None is passed, the default is both values.
+        If github tells us the number of the last page, and if we don't expect
+        to stop early (no min date), the following pages are fetched using at
+        most `parallel_pages` requests at the same time (default to the
+        GITHUB_PARALLEL_PAGES setting). Objects are still saved in the database
+        one page after the other, in the page order.
+        If `use_sync_cursor` is True, each saved page is kept in a SyncCursor,
+        and if a previous fetch of the same pages was stopped before its end,
+        the fetch resumes after the last saved page (the returned count still
+        includes the objects of the pages saved by the previous fetch).
+        If `delta_sync` is True, and the list was already fetched, only objects
+        updated since the last fetch are asked (the list must accept the
+        `since` parameter), so missing objects cannot be removed. Deleted
+        objects must be detected by a fetch without `delta_sync`.
         """
         field, _, direct, m2m = self._meta.get_field_by_name(field_name)
         if direct:
@@ -173,6 +198,30 @@ class GithubObject(models.Model):
         if parameters is None:
             parameters = {}
 
+        if parallel_pages is None:
+            parallel_pages = settings.GITHUB_PARALLEL_PAGES
+
+        # a cursor only makes sense for a single list of pages
+        sync_cursor = None
+        already_fetched_count = 0
+        if use_sync_cursor and (not vary or all(len(values) == 1 for values in vary.values())):
+            from ..limpyd_models import SyncCursor
+            sync_cursor = SyncCursor.get_for(self, meta_base_name or field_name)
+
+            first_page = int(parameters.get('page') or 1)
+            last_wanted_page = first_page + max_pages - 1 if max_pages else None
+            resume_page = sync_cursor.get_resume_page(first_page)
+
+            if resume_page is None or last_wanted_page and resume_page > last_wanted_page:
+                # all wanted pages were already fetched
+                return sync_cursor.count_objects(first_page, last_wanted_page)
+
+            if resume_page > first_page:
+                already_fetched_count = sync_cursor.count_objects(first_page, resume_page - 1)
+                if max_pages:
+                    max_pages -= resume_page - first_page
+                parameters = dict(parameters, page=resume_page)
+
         identifiers = getattr(self, 'github_callable_identifiers_for_%s' % meta_base_name)
 
         per_page_parameter = {
@@ -210,61 +259,97 @@ class GithubObject(models.Model):
                            parameters.get('direction') == direction:
                             min_date = fetched_at
 
+        # only ask for objects updated since the last fetch, but all of them
+        delta_since = None
+        if delta_sync and if_modified_since:
+            delta_since = if_modified_since
+            parameters = dict(parameters,
+                              since=delta_since.strftime('%Y-%m-%dT%H:%M:%SZ'))
+            per_page_parameter['per_page'] = parameters.get('per_page',
+                                                            model.github_per_page['max'])
+            min_date = None
+
+        # objects updated during the fetch will be in the next delta one
+        fetch_started_at = datetime.utcnow()
+
         request_headers = prepare_fetch_headers(
                     if_modified_since=if_modified_since,
                     github_format=model.github_format)
 
-        def fetch_page_and_next(objs, parameters, min_date):
+        def fetch_page(parameters, page_gh=None):
             """
-            Fetch a page of objects with the given parameters, and if github
-            tell us there is a "next" page, tell caller to continue fetching by
-            returning the parameters for the next page as first return argument
-            (or None if no next page).
-            Return the etag header of the page as second argument
-
+            Fetch a page of data with the given parameters, and return it, with
+            the response headers. The data is None if github tells us there is
+            no data for this list.
             """
             response_headers = {}
-            etag = None
-            last_page_ok = None
-
-            page_objs = []
-
             try:
-                page_objs = model.objects.get_from_github(
-                    gh=gh,
+                data = model.objects.get_data_from_github(
+                    gh=page_gh or gh,
                     identifiers=identifiers,
-                    modes=modes,
-                    defaults=defaults,
                     parameters=parameters,
                     request_headers=request_headers,
                     response_headers=response_headers,
-                    min_date=min_date,
-                    force_update=force_fetch,
                 )
-
             except ApiNotFoundError:
                 # no data for this list (issues may be no activated, for example)
-                last_page_ok = int(parameters.get('page', 1)) - 1
+                data = None
             except ApiError, e:
                 if e.response and e.response['code'] in (410, ):
                     # no data for this list (issues may be no activated, for example)
-                    last_page_ok = int(parameters.get('page', 1)) - 1
+                    data = None
                 else:
                     raise
-            except Exception:
-                raise
-            else:
-                last_page_ok = int(parameters.get('page', 1))
+            return data, response_headers
 
+        def save_page_and_next(objs, parameters, data, response_headers, min_date):
+            """
+            Create/update objects from a page of fetched data, and if github
+            tell us there is a "next" page, tell caller to continue fetching by
+            returning the parameters for the next page as first return argument
+            (or None if no next page).
+            Return the etag header of the page as second argument, the last
+            page correctly fetched as third one, and the number of the last
+            page if github gave it to us (else None) as fourth argument.
+            """
             etag = response_headers.get('etag') or None
+            last_page = None
+            page_objs = []
+
+            if data is None:
+                last_page_ok = int(parameters.get('page', 1)) - 1
+            else:
+                page_objs = model.objects.create_or_update_from_data(
+                    data,
+                    modes=modes,
+                    defaults=defaults,
+                    min_date=min_date,
+                    force_update=force_fetch,
+                )
+                last_page_ok = int(parameters.get('page', 1))
 
             if not page_objs:
                 # no fetched objects, we're done
                 last_page_ok -= 1
-                return None, etag, last_page_ok
+                return None, etag, last_page_ok, last_page
 
             objs += page_objs
 
+            links = {}
+            if 'link' in response_headers:
+                links = parse_header_links(response_headers['link'])
+                if 'last' in links and 'url' in links['last']:
+                    last_page = parse_qs(urlsplit(links['last']['url']).query).get('page')
+                    if last_page:
+                        last_page = int(last_page[0])
+
+            if sync_cursor:
+                sync_cursor.save_page(
+                    last_page_ok, len(page_objs), etag,
+                    getattr(page_objs[-1], model.github_date_field[0])
+                        if model.github_date_field else None,
+                    last_page)
+
             # if we reached the min_date, stop
             if min_date and not model.github_reverse_order:
                 obj_min_date = getattr(page_objs[-1], model.github_date_field[0])
@@ -273,7 +358,6 @@ class GithubObject(models.Model):
 
             # if we have a next page, got fetch it
             if 'link' in response_headers:
-                links = parse_header_links(response_headers['link'])
                 if 'next' in links and 'url' in links['next']:
                     next_page_parameters = parameters.copy()
                     next_page_parameters.update(
@@ -284,7 +368,7 @@ class GithubObject(models.Model):
                             )
                     )
                     # params for next page
-                    return next_page_parameters, etag, last_page_ok
+                    return next_page_parameters, etag, last_page_ok, last_page
 
             # manage model without pagination activated on the github side
             # but only if we receivend enough data to let us think we may have
@@ -294,10 +378,83 @@ class GithubObject(models.Model):
                 next_page_parameters = parameters.copy()
                 next_page_parameters['page'] = int(parameters.get('page', 1)) + 1
                 # params for next page
-                return next_page_parameters, etag, last_page_ok
+                return next_page_parameters, etag, last_page_ok, last_page
 
             # no more page, stop
-            return None, etag, last_page_ok
+            return None, etag, last_page_ok, last_page
+
+        def fetch_page_and_next(objs, parameters, min_date):
+            """
+            Fetch a page of objects with the given parameters, save them, and
+            return the same values as save_page_and_next
+            """
+            data, response_headers = fetch_page(parameters)
+            return save_page_and_next(objs, parameters, data, response_headers, min_date)
+
+        def fetch_pages_concurrently(objs, parameters, last_page, max_pages_left):
+            """
+            Fetch all pages from the one defined in the given parameters to
+            `last_page` (or only `max_pages_left` ones if defined), with at most
+            `parallel_pages` requests running at the same time, and save them
+            one after the other, in the page order, in the current thread.
+            Return the parameters for the next page (or None if no next page),
+            the last page correctly fetched, and the number of saved pages.
+            """
+            first_page = int(parameters['page'])
+            pages = range(first_page, last_page + 1)
+            if max_pages_left:
+                pages = pages[:max_pages_left]
+
+            # each thread use its own connection, to not mix the rate-limit
+            # headers used to update the token
+            threads_data = local()
+            main_counters = get_sync_counters()
+            counters_lock = Lock()
+
+            def fetch_in_thread(page_parameters):
+                if not hasattr(threads_data, 'gh'):
+                    threads_data.gh = gh.__class__(**gh._connection_args)
+                reset_sync_counters()
+                try:
+                    return fetch_page(page_parameters, threads_data.gh)
+                finally:
+                    # report the api calls counter to the one of the job
+                    with counters_lock:
+                        for kind, value in get_sync_counters().items():
+                            main_counters[kind] += value
+
+            executor = ThreadPoolExecutor(max_workers=parallel_pages)
+            futures = {}
+
+            def submit(index):
+                # only keep `parallel_pages` pages in advance, to not load a
+                # whole list in memory if saving is slower than fetching
+                if index < len(pages):
+                    page_parameters = parameters.copy()
+                    page_parameters['page'] = pages[index]
+                    futures[index] = (page_parameters,
+                                      executor.submit(fetch_in_thread, page_parameters))
+
+            next_page_parameters, last_page_ok, nb_pages = None, None, 0
+            try:
+                for index in range(parallel_pages):
+                    submit(index)
+
+                for index in range(len(pages)):
+                    page_parameters, future = futures.pop(index)
+                    submit(index + parallel_pages)
+                    data, response_headers = future.result()
+                    next_page_parameters, _, last_page_ok, _ = save_page_and_next(
+                        objs, page_parameters, data, response_headers, min_date=None)
+                    nb_pages += 1
+                    if next_page_parameters is None:
+                        break
+            finally:
+                for _, future in futures.values():
+                    future.cancel()
+                executor.shutdown(wait=True)
+
+            return next_page_parameters, last_page_ok, nb_pages
 
         if not vary:
             # no varying parameter, fetch with an empty set of parameters, with
@@ -335,92 +492,121 @@ class GithubObject(models.Model):
         cache_hit = False
         max_pages_raised = False
         something_fetched = False
+        end_reached = False
         last_page_ok = None
 
-        for parameters_combination, etag_field in parameters_combinations:
+        # side effects of saving objects are done once for the whole list
+        with bulk_sync():
+            for parameters_combination, etag_field in parameters_combinations:
 
-            # use the etag if we have one and we don't have any 200 pages yet
-            request_etag = None
-            if not force_fetch and hasattr(self, etag_field):
-                request_etag = getattr(self, etag_field) or None
+                # use the etag if we have one and we don't have any 200 pages yet
+                request_etag = None
+                if not force_fetch and hasattr(self, etag_field):
+                    request_etag = getattr(self, etag_field) or None
 
-                request_headers = prepare_fetch_headers(
-                        if_modified_since=if_modified_since,
-                        if_none_match=request_etag,
-                        github_format=model.github_format)
+                    request_headers = prepare_fetch_headers(
+                            if_modified_since=if_modified_since,
+                            if_none_match=request_etag,
+                            github_format=model.github_format)
 
-            try:
-                # fetch all available pages
-                page = int(parameters.get('page', 0))
-                pages_total = 0
-                page_parameters = parameters_combination.copy()
-                while True:
-                    page += 1
-                    page_parameters, page_etag, last_page_ok = \
-                        fetch_page_and_next(objs, page_parameters, min_date)
-                    pages_total += 1
-                    if page == 1 or model.github_reverse_order:
-                        etags[etag_field] = page_etag
-                        if request_etag:
-                            # clear if-none-match header for pages > 1
-                            request_headers = prepare_fetch_headers(
-                                if_modified_since=if_modified_since,
-                                if_none_match=None,
-                                github_format=model.github_format)
-
-                    if page_parameters is None:
-                        break
-
-                    if max_pages and pages_total >= max_pages:
-                        max_pages_raised = True
-                        break
-
-            except MinDateRaised, e:
-                etags[etag_field] = e.args[0]
-                cache_hit = True
-
-            except ApiError, e:
-                if e.response and e.response['code'] == 304:
-                    # github tell us nothing is new for this combination
+                try:
+                    # fetch all available pages
+                    page = int(parameters.get('page', 0))
+                    pages_total = 0
+                    page_parameters = parameters_combination.copy()
+                    can_be_concurrent = (parallel_pages > 1
+                                         and not min_date
+                                         and not model.github_reverse_order)
+                    while True:
+                        page += 1
+                        page_parameters, page_etag, last_page_ok, last_page = \
+                            fetch_page_and_next(objs, page_parameters, min_date)
+                        pages_total += 1
+                        if page == 1 or model.github_reverse_order:
+                            etags[etag_field] = page_etag
+                            if request_etag:
+                                # clear if-none-match header for pages > 1
+                                request_headers = prepare_fetch_headers(
+                                    if_modified_since=if_modified_since,
+                                    if_none_match=None,
+                                    github_format=model.github_format)
+
+                        if page_parameters is None:
+                            end_reached = True
+                            break
+
+                        if max_pages and pages_total >= max_pages:
+                            max_pages_raised = True
+                            break
+
+                        if (can_be_concurrent and last_page and 'page' in page_parameters
+                                and int(page_parameters['page']) <= last_page):
+                            # we know how many pages are left, fetch them together
+                            can_be_concurrent = False
+                            page_parameters, last_page_ok, nb_pages = \
+                                fetch_pages_concurrently(
+                                    objs, page_parameters, last_page,
+                                    max_pages - pages_total if max_pages else None)
+                            page += nb_pages
+                            pages_total += nb_pages
+
+                            if page_parameters is None:
+                                end_reached = True
+                                break
+
+                            if max_pages and pages_total >= max_pages:
+                                max_pages_raised = True
+                                break
+
+                except MinDateRaised, e:
+                    etags[etag_field] = e.args[0]
                     cache_hit = True
-                    continue
-                else:
-                    raise
 
-            # at least we fetched something
-            something_fetched = True
-
-        # now update the list with created/updated objects
-        if something_fetched:
-            # but only if we had all fresh data !
-            started_at_first_page = int(parameters.get('page', 1)) in (0, 1, None)
-            do_remove = (remove_missing
-                     and not cache_hit
-                     and modes == MODE_ALL
-                     and not max_pages_raised
-                     and started_at_first_page
-                )
-            save_etags_and_fetched_at = started_at_first_page
-            self.update_related_field(field_name,
-                                      [obj.id for obj in objs],
-                                      do_remove=do_remove,
-                                      save_etags_and_fetched_at=save_etags_and_fetched_at,
-                                      etags=etags,
-                                      fetched_at_field=fetched_at_field,
-                                      filter_queryset=filter_queryset,
-                                      last_page_field=last_page_field,
-                                      last_page=last_page_ok)
+                except ApiError, e:
+                    if e.response and e.response['code'] == 304:
+                        # github tell us nothing is new for this combination
+                        cache_hit = True
+                        continue
+                    else:
+                        raise
+
+                # at least we fetched something
+                something_fetched = True
+
+            if sync_cursor and end_reached:
+                sync_cursor.set_done()
+
+            # now update the list with created/updated objects
+            if something_fetched:
+                # but only if we had all fresh data !
+                started_at_first_page = int(parameters.get('page', 1)) in (0, 1, None)
+                do_remove = (remove_missing
+                         and not delta_since
+                         and not cache_hit
+                         and modes == MODE_ALL
+                         and not max_pages_raised
+                         and started_at_first_page
+                    )
+                save_etags_and_fetched_at = started_at_first_page
+                self.update_related_field(field_name,
+                                          [obj.id for obj in objs],
+                                          do_remove=do_remove,
+                                          save_etags_and_fetched_at=save_etags_and_fetched_at,
+                                          etags=etags,
+                                          fetched_at_field=fetched_at_field,
+                                          fetched_at=fetch_started_at,
+                                          filter_queryset=filter_queryset,
+                                          last_page_field=last_page_field,
+                                          last_page=last_page_ok)
 
         # we return the number of fetched objects
-        if not objs:
-            return 0
-        else:
-            return len(objs)
+        return len(objs) + already_fetched_count
 
     def update_related_field(self, field_name, ids, do_remove=True,
                                 save_etags_and_fetched_at=True, etags=None,
                                 fetched_at_field=None, filter_queryset=None,
-                                last_page_field=None, last_page=None):
+                                last_page_field=None, last_page=None,
+                                fetched_at=None):
         """
         For the given field name, with must be a m2m or the reverse side of
         a m2m or a fk, use the given list of ids as the lists of ids of all the
@@ -433,15 +619,14 @@ class GithubObject(models.Model):
 
         count = {'removed': 0, 'added': 0}
 
-        # guess whitch relations to add and whicth to delete
-        existing_queryset = instance_field
+        # guess whitch relations to add and whicth to delete (done by the
+        # database for big relations)
+        existing_queryset = instance_field.all()
         if filter_queryset:
             existing_queryset = instance_field.filter(filter_queryset)
-        existing_ids = set(existing_queryset.order_by().values_list('id', flat=True))
-        fetched_ids = set(ids or [])
+        to_remove, to_add = diff_ids(existing_queryset, ids)
 
         # if some relations are not here, remove them
-        to_remove = existing_ids - fetched_ids
         if do_remove and to_remove:
             count['removed'] = len(to_remove)
             # if FK, only objects with nullable FK have a clear method, so we
@@ -451,18 +636,8 @@ class GithubObject(models.Model):
                 # the original object
                 # Example: a user is not anymore a collaborator, we keep the
                 # the user but remove the relation user <-> repository
-                try:
-                    instance_field.remove(*to_remove)
-                except DatabaseError, e:
-                    # sqlite limits the vars passed in a request to 999
-                    # In this case, we loop on the data by slice of 950 obj to remove
-                    if u'%s' % e != 'too many SQL variables':
-                        raise
-                    per_iteration = 950  # do not use 999 has we may have other vars for internal django filter
-                    to_remove = list(to_remove)
-                    iterations = int(ceil(len(to_remove) / float(per_iteration)))
-                    for iteration in range(0, iterations):
-                        instance_field.remove(*to_remove[iteration * per_iteration:(iteration + 1) * per_iteration])
+                for chunk in in_chunks(to_remove, self._state.db):
+                    instance_field.remove(*chunk)
             else:
                 # The relation cannot be removed, because the current object is
                 # a non-nullable fk of the other objects. In this case we are
@@ -474,36 +649,26 @@ class GithubObject(models.Model):
                 # We also manage here relations via through tables
                 if hasattr(instance_field, 'through'):
                     model = instance_field.through
-                    filter = {
+                    queryset = model.objects.filter(**{
                         '%s__id' % instance_field.source_field_name: self.id,
-                        '%s__id__in' % instance_field.target_field_name: to_remove,
-                    }
+                    })
+                    in_field = '%s__id' % instance_field.target_field_name
                 else:
                     model = instance_field.model
-                    filter = {'id__in': to_remove}
+                    queryset = model.objects.all()
+                    in_field = 'id'
 
-                to_delete_queryset = model.objects.filter(**filter)
                 if filter_queryset:
-                    to_delete_queryset = to_delete_queryset.filter(filter_queryset)
-                model.objects.delete_missing_after_fetch(to_delete_queryset)
+                    queryset = queryset.filter(filter_queryset)
+                for to_delete_queryset in filter_in_chunks(queryset, in_field, to_remove):
+                    model.objects.delete_missing_after_fetch(to_delete_queryset)
 
         # if we have new relations, add them
-        to_add = fetched_ids - existing_ids
         if to_add:
             count['added'] = len(to_add)
             if hasattr(instance_field, 'add'):
-                try:
-                    instance_field.add(*to_add)
-                except DatabaseError, e:
-                    # sqlite limits the vars passed in a request to 999
-                    # In this case, we loop on the data by slice of 950 obj to add
-                    if u'%s' % e != 'too many SQL variables':
-                        raise
-                    per_iteration = 950  # do not use 999 has we may have other vars for internal django filter
-                    to_add = list(to_add)
-                    iterations = int(ceil(count['added'] / float(per_iteration)))
-                    for iteration in range(0, iterations):
-                        instance_field.add(*to_add[iteration * per_iteration:(iteration + 1) * per_iteration])
+                for chunk in in_chunks(to_add, self._state.db):
+                    instance_field.add(*chunk)
 
             elif hasattr(instance_field, 'through'):
                 model = instance_field.through
@@ -524,7 +689,7 @@ class GithubObject(models.Model):
             # can we save a fetch date ?
             if not fetched_at_field:
                 fetched_at_field = '%s_fetched_at' % field_name
-            setattr(self, fetched_at_field, datetime.utcnow())
+            setattr(self, fetched_at_field, fetched_at or datetime.utcnow())
             if fetched_at_field in all_field_names:
                 update_fields.append(fetched_at_field)
 
@@ -636,3 +801,18 @@ class GithubObjectWithId(GithubObject):
     class Meta:
         abstract = True
         app_label = 'core'
+
+
+@receiver(post_save, dispatch_uid="forget_fingerprint_on_save")
+@receiver(post_delete, dispatch_uid="forget_fingerprint_on_delete")
+def forget_fingerprint(sender, instance, **kwargs):
+    """
+    Fingerprints are only saved when saving lists: forget the one of an object
+    saved or deleted in any way (the ones of objects saved from lists are set
+    again after)
+    """
+    if kwargs.get('raw') or not isinstance(instance, GithubObject):
+        return
+    manager = sender._default_manager
+    if isinstance(manager, GithubObjectManager):
+        manager.forget_fingerprint(instance)
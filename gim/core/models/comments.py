@@ -17,6 +17,7 @@ from ..managers import (
     PullRequestCommentEntryPointManager,
     PullRequestCommentManager,
 )
+from ..utils import deferrable
 
 from .base import (
     GithubObject,
@@ -63,6 +64,7 @@ class CommentMixin(models.Model):
             IssueEvent.objects.check_references(self, ['body_html'])
             self.find_commits()
 
+    @deferrable(key=lambda comment, *args, **kwargs: (comment.__class__, comment.pk))
     def find_commits(self, jobs_priority=0):
         """
         Check all references to commits in the comment, and link them via the
@@ -116,7 +118,7 @@ class CommentMixin(models.Model):
             self.linked_commits.add(*to_add)
 
         if not_found:
-            from gim.core.tasks.commit import FetchCommitBySha
+            from gim.core.tasks.commit import FetchPendingCommits
             if isinstance(self, IssueComment):
                 from gim.core.tasks.comment import SearchReferenceCommitForComment as JobModel
             elif isinstance(self, PullRequestComment):
@@ -136,11 +138,8 @@ class CommentMixin(models.Model):
                     except Repository.DoesNotExist:
                         continue
 
-                FetchCommitBySha.add_job('%s#%s' % (repos[repo_tuple].id, new[2]),
-                                                    priority=jobs_priority)
-                JobModel.add_job(self.id, delayed_for=30,
-                                 repository_id=repos[repo_tuple].id, commit_sha=new[2],
-                                 priority=jobs_priority)
+                FetchPendingCommits.add_sha(repos[repo_tuple].id, new[2],
+                                            JobModel, self.id, jobs_priority)
 
 
 class IssueComment(CommentMixin, WithIssueMixin, GithubObjectWithId):
@@ -369,8 +368,8 @@ class CommitCommentEntryPoint(CommentEntryPointMixin):
             self.commit, _ = self.repository.commits.get_or_create(
                 sha=self.commit_sha,
             )
-            from gim.core.tasks.commit import FetchCommitBySha
-            FetchCommitBySha.add_job('%s#%s' % (self.repository_id, self.commit_sha))
+            from gim.core.tasks.commit import FetchPendingCommits
+            FetchPendingCommits.add_sha(self.repository_id, self.commit_sha, with_files=True)
 
         super(CommitCommentEntryPoint, self).save(*args, **kwargs)
 
@@ -450,8 +449,8 @@ class CommitComment(CommentMixin, WithCommitMixin, GithubObjectWithId):
             self.commit, _ = self.repository.commits.get_or_create(
                 sha=self.sha,
             )
-            from gim.core.tasks.commit import FetchCommitBySha
-            FetchCommitBySha.add_job('%s#%s' % (self.repository_id, self.sha))
+            from gim.core.tasks.commit import FetchPendingCommits
+            FetchPendingCommits.add_sha(self.repository_id, self.sha, with_files=True)
 
         elif not self.commit_sha:
             self.commit_sha = self.commit.sha
@@ -14,10 +14,14 @@ from django.contrib.contenttypes import generic
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 
 from extended_choices import Choices
 from jsonfield import JSONField
 
+from ..ghpool import ApiError
+
 from ..managers import (
     IssueEventManager,
     IssueManager,
@@ -25,6 +29,8 @@ from ..managers import (
     WithRepositoryManager,
 )
 
+from ..utils import filter_in_chunks
+
 from .base import (
     GithubObject,
     GithubObjectWithId,
@@ -133,6 +139,23 @@ class Issue(WithRepositoryMixin, GithubObjectWithId):
         'unknown': ('unknown', 'checking'),
     }
 
+    # sub-resources fetched by fetch_all, in this order, with the fields of the
+    # issue/pr header that change when they change, and if they only exist for
+    # pull requests (commits first because they may be used as references in
+    # comments)
+    # (commits and files are versioned by head_sha/base_sha, which must be the
+    # first two fields, see get_previous_head_sha)
+    FETCH_ALL_PLAN = (
+        ('commits', ('head_sha', 'base_sha', 'nb_commits'), True),
+        ('events', ('updated_at', ), False),
+        ('comments', ('comments_count', ), False),
+        ('pr_comments', ('pr_comments_count', ), True),
+        ('files', ('head_sha', 'base_sha', 'nb_changed_files'), True),
+    )
+
+    # the compare api returns at most this number of files
+    MAX_COMPARED_FILES = 300
+
     class Meta:
         app_label = 'core'
         unique_together = (
@@ -313,7 +336,66 @@ class Issue(WithRepositoryMixin, GithubObjectWithId):
             'files'
         ]
 
-    def fetch_commits(self, gh, force_fetch=False, parameters=None):
+    def compare_head(self, gh, previous_head_sha):
+        """
+        Return the result of the github compare api between the given previous
+        head sha of the pull request and the current one, only if the head was
+        simply moved forward (new commits pushed, no rebase). Else return None,
+        also if github cannot compare them (previous head lost after a force
+        push...), so the whole lists are fetched. The result is cached for the current instance, to be used both for
+        commits and files.
+        """
+        if not hasattr(self, '_compared_heads'):
+            self._compared_heads = {}
+
+        key = (previous_head_sha, self.head_sha)
+        if key not in self._compared_heads:
+            from .commits import Commit
+            identifiers = self.repository.github_callable_identifiers + [
+                'compare',
+                '%s...%s' % key,
+            ]
+            try:
+                data = Commit.objects.get_data_from_github(gh, identifiers)
+            except ApiError:
+                data = None
+            self._compared_heads[key] = data if data and data.get('status') == 'ahead' else None
+
+        return self._compared_heads[key]
+
+    def fetch_new_commits(self, gh, previous_head_sha):
+        """
+        Fetch only the commits pushed after the given previous head sha, and
+        add them to the commits of the pull request. Return the number of new
+        commits, or None if it's not possible (not simply new commits, or too
+        many to be returned by the compare api)
+        """
+        from .commits import Commit
+
+        data = self.compare_head(gh, previous_head_sha)
+        if data is None or len(data.get('commits', [])) < data.get('total_commits', 0):
+            return None
+
+        commits = Commit.objects.create_or_update_from_list(data['commits'], defaults={
+            'fk': {'repository': self.repository},
+            'related': {'*': {'fk': {'repository': self.repository}}},
+        })
+        self.update_related_field('commits', [commit.id for commit in commits],
+                                  do_remove=False)
+
+        return len(commits)
+
+    def fetch_commits(self, gh, force_fetch=False, parameters=None,
+                                                    previous_head_sha=None):
+        """
+        If the previous head sha of the pull request is given, try to only
+        fetch the new commits, else fetch the whole list
+        """
+        if previous_head_sha and not force_fetch and not parameters:
+            count = self.fetch_new_commits(gh, previous_head_sha)
+            if count is not None:
+                return count
+
         return self._fetch_many('commits', gh,
                                 defaults={
                                     'fk': {'repository': self.repository},
@@ -322,7 +404,47 @@ class Issue(WithRepositoryMixin, GithubObjectWithId):
                                 parameters=parameters,
                                 force_fetch=force_fetch)
 
-    def fetch_files(self, gh, force_fetch=False, parameters=None):
+    def reuse_unchanged_files(self, gh, previous_head_sha):
+        """
+        Move the files saved for the given previous head sha that were not
+        touched by the commits pushed since, to the current head, so they are
+        only updated (and not deleted then created again) by the next fetch of
+        the files. Return the number of files reused.
+        """
+        from .files import PullRequestFile
+
+        data = self.compare_head(gh, previous_head_sha)
+        if data is None or len(data.get('files', [])) >= self.MAX_COMPARED_FILES:
+            return 0
+
+        changed_paths = set()
+        for file_data in data['files']:
+            changed_paths.add(file_data['filename'])
+            if file_data.get('previous_filename'):
+                changed_paths.add(file_data['previous_filename'])
+
+        # ignore paths already saved for the current head (unique constraint)
+        changed_paths.update(self.files.filter(tree=self.head_sha)
+                                       .values_list('path', flat=True))
+
+        ids = [pk for pk, path in self.files.filter(tree=previous_head_sha)
+                                            .values_list('pk', 'path')
+               if path not in changed_paths]
+
+        for queryset in filter_in_chunks(PullRequestFile.objects.all(), 'pk', ids):
+            queryset.update(tree=self.head_sha)
+
+        return len(ids)
+
+    def fetch_files(self, gh, force_fetch=False, parameters=None,
+                                                    previous_head_sha=None):
+        """
+        If the previous head sha of the pull request is given, reuse the files
+        not changed since
+        """
+        if previous_head_sha and not force_fetch and not parameters:
+            self.reuse_unchanged_files(gh, previous_head_sha)
+
         return self._fetch_many('files', gh,
                                 defaults={
                                     'fk': {
@@ -339,21 +461,93 @@ class Issue(WithRepositoryMixin, GithubObjectWithId):
                                 parameters=parameters,
                                 force_fetch=force_fetch)
 
+    def get_fetch_signature(self, fields):
+        """
+        Return a string with the values of the given header fields, to know if
+        a sub-resource may have changed since the last time it was fetched
+        """
+        return ':'.join(unicode(getattr(self, field)) for field in fields)
+
+    def get_previous_head_sha(self, signature):
+        """
+        Return the head sha saved in the given signature of commits or files,
+        if only the head of the pull request moved since (same base), to only
+        fetch what changed since this head
+        """
+        if not signature:
+            return None
+        head_sha, base_sha = signature.split(':')[:2]
+        if head_sha in ('None', self.head_sha) or base_sha != unicode(self.base_sha):
+            return None
+        return head_sha
+
+    def plan_fetch_all(self, signatures, force_fetch=False, names=None):
+        """
+        Using the header of the issue/pr, freshly fetched, and the given dict
+        of signatures saved when each sub-resource was last fetched, return two
+        lists of tuples (name, signature): the sub-resources to fetch, and the
+        ones to skip because they cannot have changed.
+        If `names` is given, only these sub-resources are planned.
+        """
+        to_fetch, skipped = [], []
+        for name, fields, pr_only in self.FETCH_ALL_PLAN:
+            if names is not None and name not in names:
+                continue
+            if pr_only and not self.is_pull_request:
+                continue
+            if name == 'events' and not self.repository.has_issues:
+                continue  # not available in the github api (see fetch_events)
+            if name == 'comments' and not self.comments_count and not force_fetch:
+                continue  # no api call needed (see fetch_comments)
+            signature = self.get_fetch_signature(fields)
+            if force_fetch or signatures.get(name) != signature:
+                to_fetch.append((name, signature))
+            else:
+                skipped.append((name, signature))
+        return to_fetch, skipped
+
     def fetch_all(self, gh, force_fetch=False, **kwargs):
+        """
+        Fetch the issue, and the pull request if it's one, then only the
+        sub-resources that may have changed since the last time they were
+        fetched (all of them if force_fetch is True).
+        Return the number of sub-resources skipped, ie the minimum number of
+        api calls saved.
+        """
         super(Issue, self).fetch_all(gh, force_fetch=force_fetch)
         #self.fetch_labels(gh, force_fetch=force_fetch)  # already retrieved via self.fetch
 
         if self.is_pull_request:
-            # fetch commits first because they may be used as references in comments
-            self.fetch_commits(gh, force_fetch=force_fetch)
+            # the pr header holds the values needed to plan the next fetches
+            self.fetch_pr(gh, force_fetch=force_fetch)
 
-        self.fetch_events(gh, force_fetch=True)
-        self.fetch_comments(gh, force_fetch=force_fetch)
+        if not self.pk:
+            return 0
 
-        if self.is_pull_request:
-            self.fetch_pr(gh, force_fetch=force_fetch)
-            self.fetch_pr_comments(gh, force_fetch=force_fetch)
-            self.fetch_files(gh, force_fetch=force_fetch)
+        return self.fetch_changed(gh, force_fetch=force_fetch)
+
+    def fetch_changed(self, gh, names=None, force_fetch=False):
+        """
+        Fetch the sub-resources (only the given ones if `names` is set) that may
+        have changed since the last time they were fetched, using the header of
+        the issue/pr which must be up to date (see plan_fetch_all)
+        Return the number of sub-resources skipped.
+        """
+        from ..limpyd_models import IssueSyncState
+
+        sync_state = IssueSyncState.get_for(self)
+        signatures = sync_state.signatures.hgetall()
+        to_fetch, skipped = self.plan_fetch_all(signatures, force_fetch, names)
+
+        for name, signature in to_fetch:
+            kwargs = {'force_fetch': force_fetch}
+            if name in ('commits', 'files'):
+                kwargs['previous_head_sha'] = self.get_previous_head_sha(signatures.get(name))
+            getattr(self, 'fetch_%s' % name)(gh, **kwargs)
+            # only saved when the fetch succeeded, to do it again next time if not
+            sync_state.signatures.hset(name, signature)
+
+        return len(skipped)
 
     @property
     def total_comments_count(self):
@@ -416,6 +610,15 @@ class Issue(WithRepositoryMixin, GithubObjectWithId):
         return self.mergeable_state in self.MERGEABLE_STATES['mergeable']
 
 
+@receiver(post_delete, sender=Issue, dispatch_uid="delete_issue_sync_state")
+def delete_issue_sync_state(sender, instance, **kwargs):
+    """
+    Delete the signatures of the sub-resources of a deleted issue
+    """
+    from ..limpyd_models import IssueSyncState
+    IssueSyncState.delete_for(instance)
+
+
 class IssueEvent(WithIssueMixin, GithubObjectWithId):
     repository = models.ForeignKey('Repository', related_name='issues_events')
     issue = models.ForeignKey('Issue', related_name='events')
@@ -483,10 +686,10 @@ class IssueEvent(WithIssueMixin, GithubObjectWithId):
         super(IssueEvent, self).save(*args, **kwargs)
 
         if needs_comit:
-            from gim.core.tasks.commit import FetchCommitBySha
-            FetchCommitBySha.add_job('%s#%s' % (self.repository_id, self.commit_sha))
+            from gim.core.tasks.commit import FetchPendingCommits
             from gim.core.tasks.event import SearchReferenceCommitForEvent
-            SearchReferenceCommitForEvent.add_job(self.id, delayed_for=30)
+            FetchPendingCommits.add_sha(self.repository_id, self.commit_sha,
+                                        SearchReferenceCommitForEvent, self.id)
 
 
 LABELTYPE_EDITMODE = Choices(
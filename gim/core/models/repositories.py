@@ -3,8 +3,13 @@ __all__ = [
 ]
 
 from datetime import datetime, timedelta
+from threading import Lock, local
 
-from django.db import models
+from django.conf import settings
+from django.db import connection, models
+from django.db.models.signals import post_save
+
+from concurrent.futures import ThreadPoolExecutor
 
 from .. import GITHUB_HOST
 
@@ -17,8 +22,12 @@ from ..managers import (
     MODE_ALL,
     MODE_UPDATE,
     RepositoryManager,
+    get_sync_counters,
+    reset_sync_counters,
 )
 
+from ..utils import bulk_sync, filter_in_chunks
+
 from .base import (
     GithubObjectWithId,
 )
@@ -197,7 +206,14 @@ class Repository(GithubObjectWithId):
         ]
 
     def fetch_issues(self, gh, force_fetch=False, state=None, parameters=None,
-                                        parameters_prs=None, max_pages=None):
+                                        parameters_prs=None, max_pages=None,
+                                        use_sync_cursor=False, delta_sync=False):
+        """
+        Fetch issues, then pull requests (only to update the existing issues
+        if the repository has issues).
+        See _fetch_many for `delta_sync`, only used for issues as the list of
+        pull requests doesn't accept the `since` parameter.
+        """
         from .issues import Issue
 
         if state:
@@ -226,7 +242,9 @@ class Repository(GithubObjectWithId):
                                     parameters=final_issues_parameters,
                                     remove_missing=remove_missing,
                                     force_fetch=force_fetch,
-                                    max_pages=max_pages)
+                                    max_pages=max_pages,
+                                    use_sync_cursor=use_sync_cursor,
+                                    delta_sync=delta_sync)
 
         # now fetch pull requests to have more informations for them (only
         # ones that already exist as an issue, not the new ones)
@@ -251,7 +269,8 @@ class Repository(GithubObjectWithId):
                         force_fetch=force_fetch,
                         meta_base_name='prs',
                         modes=MODE_UPDATE if self.has_issues else MODE_ALL,
-                        max_pages=max_pages)
+                        max_pages=max_pages,
+                        use_sync_cursor=use_sync_cursor)
 
         count += pr_count
 
@@ -264,11 +283,70 @@ class Repository(GithubObjectWithId):
 
         return count
 
+    # max delay between the "closed" event of an issue and its closing date to
+    # use the event to get the closer of the issue
+    CLOSED_EVENT_MAX_DELAY = timedelta(minutes=1)
+
+    # max number of commits returned by one call to the list of commits
+    COMMITS_PER_LIST = 100
+
+    def set_closed_by_from_events(self):
+        """
+        Fill the closed_by of the closed issues without one, with the user of
+        their last "closed" event, if we have it and if it's the one that closed
+        the issue (else the issue may have been reopened and closed again, and
+        we don't have the last events yet).
+        Issues are updated in bulk, with one query by closer (and by chunk).
+        Return the number of updated issues.
+        """
+        from .issues import Issue, IssueEvent
+
+        events = IssueEvent.objects.filter(
+            repository=self,
+            event='closed',
+            user__isnull=False,
+            issue__state='closed',
+            issue__closed_by__isnull=True,
+            issue__closed_by_fetched=False,
+        ).order_by('issue__id', 'created_at', 'github_id').values_list(
+            'issue_id', 'user_id', 'created_at', 'issue__closed_at')
+
+        # keep the last event of each issue
+        last_events = {}
+        for issue_id, user_id, created_at, closed_at in events.iterator():
+            last_events[issue_id] = (user_id, created_at, closed_at)
+
+        closers = {}
+        for issue_id, (user_id, created_at, closed_at) in last_events.iteritems():
+            if closed_at and abs(closed_at - created_at) <= self.CLOSED_EVENT_MAX_DELAY:
+                closers.setdefault(user_id, []).append(issue_id)
+
+        if not closers:
+            return 0
+
+        issues_ids = []
+        for user_id, ids in closers.iteritems():
+            for queryset in filter_in_chunks(Issue.objects.all(), 'pk', ids):
+                queryset.update(closed_by=user_id, closed_by_fetched=True)
+            issues_ids.extend(ids)
+
+        # the updates above don't send signals: send them to let the receivers
+        # (cached templates...) manage the change as for a normal save
+        with bulk_sync():
+            for queryset in filter_in_chunks(Issue.objects.all(), 'pk', issues_ids):
+                for issue in queryset:
+                    post_save.send(sender=Issue, instance=issue, created=False,
+                                   raw=False, using=issue._state.db,
+                                   update_fields=frozenset(['closed_by', 'closed_by_fetched']))
+
+        return len(issues_ids)
+
     def fetch_closed_issues_without_closed_by(self, gh, limit=20):
         # the "closed_by" attribute of an issue is not filled in list call, so
         # we fetch all closed issue that has no closed_by, one by one (but only
         # if we never did it because some times there is noone who closed an
         # issue on the github api :( ))
+        # (call set_closed_by_from_events before to avoid most of these calls)
         if not self.has_issues:
             return 0, 0, 0, 0
 
@@ -347,8 +425,8 @@ class Repository(GithubObjectWithId):
 
         def action(gh, pr):
             pr.fetch_pr(gh, force_fetch=True)
-            pr.fetch_commits(gh)
-            pr.fetch_files(gh)
+            # commits and files are only fetched if the head/base of the pr moved
+            pr.fetch_changed(gh, names=('commits', 'files'))
 
         return self._fetch_some_prs(filter, action, gh=gh, limit=limit)
 
@@ -378,12 +456,14 @@ class Repository(GithubObjectWithId):
             mergeable = pr.mergeable
             mergeable_state = pr.mergeable_state
             pr.fetch_pr(gh, force_fetch=False)
-            if pr.mergeable != mergeable or pr.mergeable_state != mergeable_state:
-                action.updated += 1
-            if not action.last_date or pr.updated_at < action.last_date:
-                action.last_date = pr.updated_at
+            with action.lock:  # prs may be fetched in many threads
+                if pr.mergeable != mergeable or pr.mergeable_state != mergeable_state:
+                    action.updated += 1
+                if not action.last_date or pr.updated_at < action.last_date:
+                    action.last_date = pr.updated_at
         action.updated = 0
         action.last_date = None
+        action.lock = Lock()
 
         count, deleted, errors, todo = self._fetch_some_prs(get_filter(start_date),
                                                         action, gh=gh, limit=limit)
@@ -392,31 +472,214 @@ class Repository(GithubObjectWithId):
 
         return count, action.updated, deleted, errors, todo, action.last_date
 
-    def _fetch_some_prs(self, filter, action, gh, limit=20):
+    def get_connections_for_prs(self, gh, nb_connections):
+        """
+        Return a list of `nb_connections` arguments of connections to use to
+        fetch pull requests in many threads, using available tokens to spread
+        api calls, or the given connection if none is available.
+        For private repositories, only tokens that can pull the repository are
+        used.
+        """
+        from ..limpyd_models import Token
+
+        permission = 'pull' if self.private else 'read'
+
+        connections_args = []
+        for index in range(nb_connections):
+            token = Token.get_one_for_repository(self.pk, permission, sort_by=None)
+            if token:
+                username, access_token = token.hmget('username', 'token')
+                connections_args.append({'username': username,
+                                         'access_token': access_token})
+
+        while len(connections_args) < nb_connections:
+            connections_args.append(gh._connection_args)
+
+        return connections_args
+
+    def _fetch_some_prs(self, filter, action, gh, limit=20, parallel_prs=None):
         """
         Update some PRs, with filter and things to merge depending on the mode.
+        At most `parallel_prs` PRs are updated at the same time (default to the
+        GITHUB_PARALLEL_PRS setting), each thread with its own github and
+        database connections.
+        Only the http requests of the threads are done concurrently: all the
+        rest (saving in the database, side effects...) is done while holding a
+        lock, released by the github connections only during their requests,
+        so the database (sqlite) and the redis pipelines are never used by two
+        threads at the same time.
         """
         prs = list(filter.order_by('-updated_at')[:limit])
 
-        count = errors = deleted = todo = 0
+        if parallel_prs is None:
+            parallel_prs = settings.GITHUB_PARALLEL_PRS
+        parallel_prs = min(parallel_prs, len(prs))
+
+        results = {'count': 0, 'errors': 0, 'deleted': 0}
+        results_lock = Lock()
+
+        def fetch_pr(gh, pr):
+            try:
+                action(gh, pr)
+            except ApiNotFoundError:
+                # the PR doen't exist anymore !
+                pr.delete()
+                result = 'deleted'
+            except ApiError:
+                result = 'errors'
+            else:
+                result = 'count'
+            with results_lock:
+                results[result] += 1
+
+        todo = 0
 
         if len(prs):
 
-            for pr in prs:
+            if parallel_prs <= 1:
+                for pr in prs:
+                    fetch_pr(gh, pr)
+
+            else:
+                connections_args = self.get_connections_for_prs(gh, parallel_prs)
+                main_counters = get_sync_counters()
+                threads_data = local()
+                shared_lock = Lock()
+
+                def fetch_pr_in_thread(pr):
+                    with shared_lock:
+                        if not hasattr(threads_data, 'gh'):
+                            threads_data.gh = gh.__class__(**connections_args.pop())
+                            threads_data.gh.shared_lock = shared_lock
+                        reset_sync_counters()
+                        try:
+                            # side effects are deferred until the end of the PR
+                            with bulk_sync():
+                                fetch_pr(threads_data.gh, pr)
+                        finally:
+                            # report the objects counters to the ones of the job
+                            for kind, value in get_sync_counters().items():
+                                main_counters[kind] += value
+                            # the thread's database connection is not closed by
+                            # django outside of a request
+                            connection.close()
+
+                executor = ThreadPoolExecutor(max_workers=parallel_prs)
                 try:
-                    action(gh, pr)
-                except ApiNotFoundError:
-                    # the PR doen't exist anymore !
-                    pr.delete()
-                    deleted += 1
-                except ApiError:
-                    errors += 1
-                else:
-                    count += 1
+                    # consume results to raise unexpected exceptions
+                    list(executor.map(fetch_pr_in_thread, prs))
+                finally:
+                    executor.shutdown(wait=True)
 
             todo = filter.count()
 
-        return count, deleted, errors, todo
+        return results['count'], results['deleted'], results['errors'], todo
+
+    def get_missing_shas(self, shas):
+        """
+        Return the given shas (full or abbreviated) of the commits we don't
+        have (or never fetched) in the repository
+        """
+        shas = set(shas)
+        fetched = self.commits.filter(fetched_at__isnull=False)
+
+        full_shas = [sha for sha in shas if len(sha) == 40]
+        for queryset in filter_in_chunks(fetched, 'sha', full_shas):
+            shas.difference_update(queryset.values_list('sha', flat=True))
+
+        for sha in [sha for sha in shas if len(sha) < 40]:
+            if fetched.filter(sha__startswith=sha).exists():
+                shas.remove(sha)
+
+        return shas
+
+    def fetch_commits_by_shas(self, gh, shas, max_calls=None, with_files=()):
+        """
+        Fetch the commits with the given shas (full or abbreviated) with as few
+        calls as possible: the list of commits starting at one of them also
+        holds its ancestors, so often other wanted ones (like the commits of a
+        pull request referenced by its events), all saved in one bulk, without
+        their files. The ones in `with_files`, and the last one, are fetched
+        alone, to also get their files.
+        Return three sets of shas: the found ones, the ones unknown by github,
+        and the ones left to fetch (`max_calls` reached or api error).
+        """
+        from .commits import Commit
+
+        alone = set(shas).intersection(with_files)
+        todo = set(shas).difference(alone)
+        found, not_found = set(), set()
+        data_by_sha = {}
+        calls = 0
+
+        identifiers = self.github_callable_identifiers_for_commits
+        parameters = {'per_page': self.COMMITS_PER_LIST}
+
+        while len(todo) > 1 and (not max_calls or calls < max_calls):
+            sha = todo.pop()
+            calls += 1
+            parameters['sha'] = sha
+            try:
+                entries = Commit.objects.get_data_from_github(gh, identifiers, parameters)
+            except ApiError, e:
+                if e.code in (404, 422):
+                    not_found.add(sha)
+                    continue
+                # keep it for later, but save what we already have
+                todo.add(sha)
+                break
+
+            for entry in entries:
+                matching = [wanted for wanted in todo.union([sha])
+                            if entry['sha'].startswith(wanted)]
+                if matching:
+                    data_by_sha[entry['sha']] = entry
+                    found.update(matching)
+                    todo.difference_update(matching)
+
+            if sha not in found:
+                not_found.add(sha)
+
+        if data_by_sha:
+            with bulk_sync():
+                # no files in lists, but don't ask to fetch them for each commit
+                Commit.objects.create_or_update_from_list(data_by_sha.values(), defaults={
+                    'fk': {'repository': self},
+                    'related': {'*': {'fk': {'repository': self}}},
+                    'skip_files_fetch': True,
+                })
+
+        # the last one is fetched alone, with its files, like the ones needing them
+        if len(todo) == 1:
+            alone.update(todo)
+            todo = set()
+
+        while alone and (not max_calls or calls < max_calls):
+            sha = alone.pop()
+            calls += 1
+            try:
+                commit = self.commits.filter(sha__startswith=sha)[0]
+            except IndexError:
+                commit = Commit(repository=self, sha=sha)
+            try:
+                commit.fetch(gh, force_fetch=True)
+            except ApiNotFoundError:
+                not_found.add(sha)
+            except ApiError:
+                # keep it, and the other ones, for later
+                todo.add(sha)
+                break
+            else:
+                found.add(sha)
+
+        todo.update(alone)
+
+        # mark the commits we have but that don't exist anymore
+        if not_found:
+            for queryset in filter_in_chunks(self.commits.all(), 'sha', list(not_found)):
+                queryset.update(deleted=True, fetched_at=datetime.utcnow())
+
+        return found, not_found, todo
 
     def fetch_unfetched_commits(self, gh, limit=20):
         """
@@ -425,25 +688,14 @@ class Repository(GithubObjectWithId):
         """
         qs = self.commits.filter(fetched_at__isnull=True)
 
-        commits = list(qs.order_by('-authored_at')[:limit])
+        shas = list(qs.order_by('-authored_at').values_list('sha', flat=True)[:limit])
 
         count = errors = deleted = todo = 0
 
-        if len(commits):
+        if len(shas):
 
-            for commit in commits:
-                try:
-                    commit.fetch(gh, force_fetch=True)
-                except ApiNotFoundError:
-                    # the commit doesn't exist anymore !
-                    commit.fetched_at = datetime.utcnow()
-                    commit.deleted = True
-                    commit.save(update_fields=['fetched_at', 'deleted'])
-                    deleted += 1
-                except ApiError:
-                    errors += 1
-                else:
-                    count += 1
+            found, not_found, left = self.fetch_commits_by_shas(gh, shas, max_calls=limit)
+            count, deleted, errors = len(found), len(not_found), len(left)
 
             todo = qs.count()
 
@@ -456,7 +708,7 @@ class Repository(GithubObjectWithId):
         ]
 
     def fetch_issues_events(self, gh, force_fetch=False, parameters=None,
-                                                            max_pages=None):
+                                    max_pages=None, use_sync_cursor=False):
         count = self._fetch_many('issues_events', gh,
                                  defaults={
                                     'fk': {'repository': self},
@@ -464,7 +716,8 @@ class Repository(GithubObjectWithId):
                                 },
                                  parameters=parameters,
                                  force_fetch=force_fetch,
-                                 max_pages=max_pages)
+                                 max_pages=max_pages,
+                                 use_sync_cursor=use_sync_cursor)
 
         return count
 
@@ -481,7 +734,8 @@ class Repository(GithubObjectWithId):
         ]
 
     def fetch_comments(self, gh, force_fetch=False, parameters=None,
-                                                                max_pages=None):
+                                    max_pages=None, use_sync_cursor=False,
+                                    delta_sync=False):
         from .comments import IssueComment
 
         final_parameters = {
@@ -497,10 +751,13 @@ class Repository(GithubObjectWithId):
                                 },
                                 parameters=final_parameters,
                                 force_fetch=force_fetch,
-                                max_pages=max_pages)
+                                max_pages=max_pages,
+                                use_sync_cursor=use_sync_cursor,
+                                delta_sync=delta_sync)
 
     def fetch_pr_comments(self, gh, force_fetch=False, parameters=None,
-                                                                max_pages=None):
+                                    max_pages=None, use_sync_cursor=False,
+                                    delta_sync=False):
         from .comments import PullRequestComment
 
         final_parameters = {
@@ -516,7 +773,9 @@ class Repository(GithubObjectWithId):
                                 },
                                 parameters=final_parameters,
                                 force_fetch=force_fetch,
-                                max_pages=max_pages)
+                                max_pages=max_pages,
+                                use_sync_cursor=use_sync_cursor,
+                                delta_sync=delta_sync)
 
     @property
     def github_callable_identifiers_for_commits(self):
@@ -531,7 +790,7 @@ class Repository(GithubObjectWithId):
         ]
 
     def fetch_commit_comments(self, gh, force_fetch=False, parameters=None,
-                                                                max_pages=None):
+                                    max_pages=None, use_sync_cursor=False):
         from .comments import CommitComment
 
         final_parameters = {
@@ -554,14 +813,18 @@ class Repository(GithubObjectWithId):
                                 },
                                 parameters=final_parameters,
                                 force_fetch=force_fetch,
-                                max_pages=max_pages)
+                                max_pages=max_pages,
+                                use_sync_cursor=use_sync_cursor)
 
     def fetch_all(self, gh, force_fetch=False, **kwargs):
         """
         Pass "two_steps=True" to felay fetch of closed issues and comments (by
         adding a FirstFetchStep2 job that will call fetch_all_step2)
+        Pass "delta_sync=True" to only fetch updated issues and comments (but
+        deleted ones won't be detected)
         """
         two_steps = bool(kwargs.get('two_steps', False))
+        delta_sync = bool(kwargs.get('delta_sync', False))
 
         super(Repository, self).fetch_all(gh, force_fetch=force_fetch)
         # self.fetch_collaborators(gh, force_fetch=force_fetch)  # done via the FetchCollaborators task, with a user with push rights
@@ -575,7 +838,7 @@ class Repository(GithubObjectWithId):
             from gim.core.tasks.repository import FirstFetchStep2
             FirstFetchStep2.add_job(self.id, gh=gh)
         else:
-            self.fetch_all_step2(gh, force_fetch)
+            self.fetch_all_step2(gh, force_fetch, delta_sync=delta_sync)
             from gim.core.tasks.repository import FetchUnmergedPullRequests
             FetchUnmergedPullRequests.add_job(self.id, priority=-15, gh=gh, delayed_for=60*60*3)  # 3 hours
 
@@ -583,8 +846,38 @@ class Repository(GithubObjectWithId):
             self.first_fetch_done = True
             self.save(update_fields=['first_fetch_done'])
 
+    # lists fetched by fetch_all_step2, with the names of their sync cursors
+    STEP2_LISTS = {
+        'issues': ('issues', 'prs'),
+        'issues_events': ('issues_events', ),
+        'comments': ('comments', ),
+        'pr_comments': ('pr_comments', ),
+        'commit_comments': ('commit_comments', ),
+    }
+
+    def get_step2_total_pages(self, list_name):
+        """
+        Return the number of pages of the given list of fetch_all_step2, saved
+        in its sync cursors by a fetch with `use_sync_cursors` (0 if unknown)
+        """
+        from ..limpyd_models import SyncCursor
+
+        total_pages = 0
+        for cursor_name in self.STEP2_LISTS[list_name]:
+            total_pages = max(total_pages,
+                              int(SyncCursor.get_for(self, cursor_name).total_pages.hget() or 0))
+        return total_pages
+
     def fetch_all_step2(self, gh, force_fetch=False, start_page=None,
-                        max_pages=None, to_ignore=None, issues_state=None):
+                        max_pages=None, to_ignore=None, issues_state=None,
+                        use_sync_cursors=False, delta_sync=False):
+        """
+        Fetch issues (with pull requests), their events and all comments.
+        If `use_sync_cursors` is True, each list is resumed where a previous
+        call for the same pages was stopped (see SyncCursor)
+        If `delta_sync` is True, only updated issues and comments are fetched
+        (see _fetch_many)
+        """
         if not to_ignore:
             to_ignore = set()
 
@@ -597,19 +890,21 @@ class Repository(GithubObjectWithId):
             'force_fetch': force_fetch,
             'max_pages': max_pages,
             'parameters': parameters,
+            'use_sync_cursor': use_sync_cursors,
         }
 
         counts = {}
 
         if 'issues' not in to_ignore:
             counts['issues'] = self.fetch_issues(parameters_prs=parameters,
-                                                 state=issues_state, **kwargs)
+                                                 state=issues_state,
+                                                 delta_sync=delta_sync, **kwargs)
         if 'issues_events' not in to_ignore:
             counts['issues_events'] = self.fetch_issues_events(**kwargs)
         if 'comments' not in to_ignore:
-            counts['comments'] = self.fetch_comments(**kwargs)
+            counts['comments'] = self.fetch_comments(delta_sync=delta_sync, **kwargs)
         if 'pr_comments' not in to_ignore:
-            counts['pr_comments'] = self.fetch_pr_comments(**kwargs)
+            counts['pr_comments'] = self.fetch_pr_comments(delta_sync=delta_sync, **kwargs)
         if 'commit_comments' not in to_ignore:
             counts['commit_comments'] = self.fetch_commit_comments(**kwargs)
 
@@ -1,12 +1,18 @@
+from datetime import datetime
 from threading import local
 
 import json
+import traceback
+
+from dateutil.parser import parse
 
 from django.conf import settings
 from django.db import DatabaseError
+from django.db.models import Count
 
 from limpyd import fields
 from limpyd.contrib.database import PipelineDatabase
+from limpyd.exceptions import DoesNotExist
 from limpyd.model import MetaRedisModel
 
 from limpyd_jobs import STATUSES
@@ -16,10 +22,12 @@ from limpyd_jobs.models import (
                                 Queue as LimpydQueue,
                                 Error as LimpydError,
                             )
-from limpyd_jobs.utils import compute_delayed_until
+from limpyd_jobs.utils import compute_delayed_until, total_seconds
 from limpyd_jobs.workers import Worker as LimpydWorker, logger
 
 from gim.core.ghpool import ApiError
+from gim.core.managers import get_sync_counters, reset_sync_counters
+from gim.core.utils import bulk_sync
 from gim.core.models import GithubUser
 
 from . import JobRegistry
@@ -40,8 +48,44 @@ NAMESPACE = 'gim'
 
 
 class Queue(LimpydQueue):
+    """
+    In addition to the main queues, there are queues by repository, named like
+    "queue-name@42", for the jobs of models with `fair_by_repository` set (see
+    Job), that are got with their main queue by `get_all`.
+    """
     namespace = NAMESPACE
 
+    # for a queue by repository: the name of its main queue, and the repository
+    base_name = fields.InstanceHashField(indexable=True)
+    repository_id = fields.InstanceHashField()
+
+    # to see if jobs wait too long in a queue
+    last_wait = fields.InstanceHashField()  # seconds waited by the last started job
+    last_started = fields.InstanceHashField()  # when the last job was started
+
+    @classmethod
+    def get_queue(cls, name, priority=0, **fields_if_new):
+        """
+        Set the main queue and the repository of a new queue by repository
+        """
+        if '@' in name:
+            base_name, repository_id = name.split('@', 1)
+            fields_if_new.setdefault('base_name', base_name)
+            fields_if_new.setdefault('repository_id', repository_id)
+        return super(Queue, cls).get_queue(name, priority, **fields_if_new)
+
+    @classmethod
+    def get_all(cls, names):
+        """
+        Return all queues for the given names, including the queues by
+        repository
+        """
+        names = cls._get_iterable_for_names(names)
+        queues = super(Queue, cls).get_all(names)
+        for name in names:
+            queues.extend(cls.collection(base_name=name).instances())
+        return queues
+
 
 class Error(LimpydError):
     namespace = NAMESPACE
@@ -55,7 +99,14 @@ class Error(LimpydError):
 class Worker(LimpydWorker):
     """
     Base worker:
-    - overrides job_success_message to call job.success_message_addon
+    - overrides job_success_message to call job.success_message_addon, and to
+      add the number of objects skipped/written while syncing with github
+    - delays jobs failing with an error to retry later (with a `retry_delay`
+      attribute, set by the retry policy of the github connection)
+    - runs jobs in batch if their model defines `run_batch` (see Job)
+    - rotates across the queues by repository of a queue (with a weight by
+      repository, see get_repositories_weights), instead of always taking
+      jobs from the first ones, and saves how long the jobs waited
     """
     queue_model = Queue
     error_model = Error
@@ -63,13 +114,224 @@ class Worker(LimpydWorker):
     logger_level = settings.WORKERS_LOGGER_CONFIG['level']
     requeue_times = 1000
 
+    def __init__(self, *args, **kwargs):
+        self.fair_keys = []  # (priority, key, repository id) of each queue
+        self.fair_weights = {}  # weight by repository id
+        self.fair_virtual_times = {}  # virtual time of the next job, by key
+        self.fair_clock = 0  # virtual time of the last started job
+        super(Worker, self).__init__(*args, **kwargs)
+
+    def get_repositories_weights(self, repository_ids):
+        """
+        Return the weight of each given repository (as a dict) in the rotation
+        across queues by repository: its number of subscriptions. Override it
+        in a subclass (see the --worker-class option) to use other weights.
+        """
+        from gim.subscriptions.models import Subscription
+        return dict(Subscription.objects.filter(repository_id__in=repository_ids)
+                                        .values_list('repository_id')
+                                        .annotate(count=Count('id')))
+
+    def update_keys(self):
+        """
+        Update the keys to listen, keeping the priority and repository of each
+        one, and the weights of the repositories, to order them at each wait
+        (see fair_ordered_keys)
+        """
+        self.fair_keys = []
+        for queue in self.queue_model.get_all_by_priority(self.queues):
+            priority, repository_id = queue.hmget('priority', 'repository_id')
+            self.fair_keys.append((int(priority or 0), queue.waiting.key,
+                                   int(repository_id) if repository_id else None))
+        self.keys = [key for _, key, _ in self.fair_keys]
+        self.fair_virtual_times = dict((key, time) for key, time
+                                       in self.fair_virtual_times.items() if key in self.keys)
+
+        if not self.keys:
+            self.log('No queues yet', level='warning')
+        self.last_update_keys = datetime.utcnow()
+
+        repository_ids = [repository_id for _, _, repository_id in self.fair_keys
+                                        if repository_id]
+        if repository_ids:
+            try:
+                self.fair_weights = self.get_repositories_weights(repository_ids)
+            except Exception, e:
+                # keep the previous weights
+                self.log('Unable to get the weights of repositories: %s' % e, level='error')
+
+    def fair_ordered_keys(self):
+        """
+        Return the keys to listen ordered by priority, then, for a same
+        priority, by the virtual time of the next job of each queue, to rotate
+        across them (start-time fair queuing: the virtual time of a queue moves
+        forward by 1/weight for each job taken from it)
+        """
+        return [key for _, key, _ in sorted(self.fair_keys, key=lambda fair_key: (
+            -fair_key[0], max(self.fair_virtual_times.get(fair_key[1], 0), self.fair_clock)
+        ))]
+
+    def fair_job_taken(self, key):
+        """
+        Move forward the virtual time of the queue with the given key
+        """
+        repository_id = None
+        for _, fair_key, fair_repository_id in self.fair_keys:
+            if fair_key == key:
+                repository_id = fair_repository_id
+                break
+        weight = max(1, self.fair_weights.get(repository_id, 1)) if repository_id else 1
+        self.fair_clock = max(self.fair_virtual_times.get(key, 0), self.fair_clock)
+        self.fair_virtual_times[key] = self.fair_clock + 1.0 / weight
+
+    def wait_for_job(self):
+        """
+        Wait for a job like the default worker, but listening to the queues in
+        the order given by fair_ordered_keys
+        """
+        blpop_result = self.connection.blpop(self.fair_ordered_keys(), self.timeout)
+        if blpop_result is None:
+            return None
+        queue_redis_key, job_ident = blpop_result
+        self.fair_job_taken(queue_redis_key)
+        self.set_status('running')
+        return self.get_queue(queue_redis_key), self.get_job(job_ident)
+
+    def job_started(self, job, queue):
+        """
+        Save on the queue how long the job waited before being started
+        """
+        now = datetime.utcnow()
+        dates = [parse(date) for date in job.hmget('added', 'delayed_until') if date]
+        if dates:
+            queue.hmset(last_wait='%.1f' % max(0, total_seconds(now - max(dates))),
+                        last_started=str(now))
+        super(Worker, self).job_started(job, queue)
+
+    def execute(self, job, queue):
+        """
+        Run the job, but if it failed with an error the github retry policy
+        wants us to retry later, delay the job instead of having an error.
+        Side effects of saving objects are done at the end of the job (see
+        bulk_sync)
+        """
+        reset_sync_counters()
+        try:
+            with bulk_sync():
+                if job.batch_size and hasattr(job, 'run_batch'):
+                    return self.execute_batch(job, queue)
+                return super(Worker, self).execute(job, queue)
+        except Exception, e:
+            if not self.delay_for_retry(job, queue, e):
+                raise
+            return None
+
+    def delay_for_retry(self, job, queue, exception):
+        """
+        If the exception has a `retry_delay` attribute, delay the job and
+        return True
+        """
+        retry_delay = getattr(exception, 'retry_delay', None)
+        if retry_delay is None:
+            return False
+        job.status.hset(STATUSES.DELAYED)
+        job.delayed_until.hset(compute_delayed_until(delayed_for=retry_delay))
+        self.log('[%s|%s|%s] will be retried in %ds: %s' % (
+                    queue._cached_name, job.pk.get(), job._cached_identifier,
+                    retry_delay, exception), level='warning')
+        return True
+
+    def pop_batch_jobs(self, job, queue):
+        """
+        Pop, in one pipelined call, up to `batch_size - 1` jobs waiting in the
+        queue of the given one, and return the ones that can be run with it
+        (the others are given back to the queue)
+        """
+        key = queue.waiting.key
+        with self.connection.pipeline() as pipeline:
+            pipeline.lrange(key, 0, job.batch_size - 2)
+            pipeline.ltrim(key, job.batch_size - 1, -1)
+            idents = pipeline.execute()[0]
+
+        jobs, others = [], []
+        for ident in idents:
+            if not ident.startswith(job.get_model_repr() + ':'):
+                others.append(ident)
+                continue
+            try:
+                other = job.get_from_ident(ident)
+            except DoesNotExist:
+                continue
+            other._cached_identifier, other._cached_status = other.hmget('identifier', 'status')
+            if other._cached_status == STATUSES.WAITING:
+                jobs.append(other)
+            elif other._cached_status == STATUSES.DELAYED:
+                self.job_delayed(other, queue)
+            else:
+                self.job_skipped(other, queue)
+
+        if others:
+            queue.waiting.lpush(*reversed(others))
+
+        return jobs
+
+    def execute_batch(self, job, queue):
+        """
+        Run the given job with other ones waiting in the same queue, by calling
+        `run_batch` on the job model. The other jobs are ended here as the main
+        loop would do, and the result of the given one is returned to it (or
+        its exception raised)
+        """
+        jobs = self.pop_batch_jobs(job, queue)
+        for other in jobs:
+            self.job_started(other, queue)
+        jobs.insert(0, job)
+
+        try:
+            results = job.run_batch(jobs, queue)
+        except Exception, e:
+            results = [e] * len(jobs)
+
+        for other, result in zip(jobs[1:], results[1:]):
+            self.end_batch_job(other, queue, result)
+
+        if isinstance(results[0], Exception):
+            raise results[0]
+        return results[0]
+
+    def end_batch_job(self, job, queue, result):
+        """
+        End a job run by `execute_batch`, as the main loop does for the job it
+        runs, the result being an exception if the job failed
+        """
+        try:
+            if isinstance(result, Exception):
+                if not self.delay_for_retry(job, queue, result):
+                    self.job_error(job, queue, result)
+                    return
+            job._cached_status = job.status.hget()
+            if job._cached_status == STATUSES.DELAYED:
+                self.job_delayed(job, queue)
+            elif job._cached_status == STATUSES.CANCELED:
+                self.job_skipped(job, queue)
+            else:
+                self.job_success(job, queue, result)
+        except Exception, e:
+            self.log('[%s] unexpected error: %s\n%s' % (
+                        job._cached_identifier, str(e), traceback.format_exc()),
+                     level='error')
+
     def job_success_message(self, job, queue, job_result):
         """
         Add the string returned by the `success_message_addon` method of the job
         to the default success message
         """
         message = super(Worker, self).job_success_message(job, queue, job_result)
-        return message + (job.success_message_addon(queue, job_result) or '')
+        message += job.success_message_addon(queue, job_result) or ''
+        counters = get_sync_counters()
+        if counters['skipped'] or counters['written']:
+            message += ' [skipped=%(skipped)d, written=%(written)d]' % counters
+        return message
 
     def additional_error_fields(self, job, queue, exception, trace=None):
         """
@@ -112,6 +374,22 @@ class Job(LimpydJob):
     gh_args = fields.HashField()  # will store info to create a Github connection
     clonable_fields = ()
 
+    # if True, the jobs are put in queues by repository (named like
+    # "queue-name@42", see get_repository_id_for), across which workers rotate
+    fair_by_repository = False
+
+    # if a job model defines a `run_batch(cls, jobs, queue)` class method, the
+    # worker runs up to `batch_size` of its waiting jobs together with it. It
+    # must return a list with the result of each job (or the exception if it
+    # failed), and do itself what `run` does for each job (statuses...). The
+    # work of each job must be done in its own `bulk_sync` context, so its
+    # side effects are still done if the batch ends with an error
+    batch_size = None
+
+    # api calls reserved on the token leased to run a job (see Token.lease),
+    # Token.LEASE_CALLS if None
+    gh_calls = None
+
     def run(self, queue):
         return None
 
@@ -121,7 +399,28 @@ class Job(LimpydJob):
         Helper to easily get the job's queue
         """
         priority = self.priority.hget()
-        return self.queue_model.get_queue(name=self.queue_name, priority=priority)
+        return self.queue_model.get_queue(
+                    name=self.get_queue_name_for(self.identifier.hget()), priority=priority)
+
+    @classmethod
+    def get_repository_id_for(cls, identifier):
+        """
+        Return the id of the repository of the job with the given identifier,
+        to use its queue by repository if `fair_by_repository` is set
+        """
+        return None
+
+    @classmethod
+    def get_queue_name_for(cls, identifier):
+        """
+        Return the name of the queue to use for the job with the given
+        identifier: the one of its repository if `fair_by_repository` is set
+        """
+        if cls.fair_by_repository:
+            repository_id = cls.get_repository_id_for(identifier)
+            if repository_id:
+                return '%s@%s' % (cls.queue_name, repository_id)
+        return cls.queue_name
 
     def success_message_addon(self, queue, result):
         """
@@ -134,13 +433,17 @@ class Job(LimpydJob):
     def add_job(cls, *args, **kwargs):
         """
         Replace the `gh` argument by a `gh_args` one by getting the connection
-        arguments from it.
+        arguments from it, and use the queue of the job's repository if needed.
         """
 
         if 'gh' in kwargs:
             kwargs['gh_args'] = kwargs['gh']._connection_args
             del kwargs['gh']
 
+        if cls.fair_by_repository and not kwargs.get('queue_name'):
+            identifier = args[0] if args else kwargs['identifier']
+            kwargs['queue_name'] = cls.get_queue_name_for(identifier)
+
         return super(Job, cls).add_job(*args, **kwargs)
 
     def _get_gh(self):
@@ -197,11 +500,11 @@ class Job(LimpydJob):
                 if repository.private and permission not in ('admin', 'push', 'pull'):
                     # force correct permission if repository is private
                     permission = 'pull'
-                token = Token.get_one_for_repository(repository.pk, permission)
+                token = Token.get_one_for_repository(repository.pk, permission, calls=self.gh_calls)
 
             # no repository, not "self", but want one ? don't know why but ok...
             else:
-                token = Token.get_one()
+                token = Token.get_one(calls=self.gh_calls)
 
         # if we don't have token it's that there is no one available: we delay
         # the job
@@ -8,6 +8,10 @@ __all__ = [
 ]
 
 
+from operator import or_
+
+from django.db.models import Q
+
 from limpyd import fields
 from limpyd_jobs import STATUSES
 from limpyd_jobs.utils import compute_delayed_until
@@ -16,6 +20,7 @@ from async_messages import messages
 
 from gim.core.models import IssueComment, PullRequestComment, Commit, CommitComment
 from gim.core.ghpool import ApiError
+from gim.core.utils import bulk_sync
 
 from .base import DjangoModelJob
 
@@ -139,6 +144,7 @@ class SearchReferenceCommitForComment(IssueCommentJob):
     """
 
     queue_name = 'search-ref-commit-comment'
+    batch_size = 50
 
     repository_id = fields.InstanceHashField()
     commit_sha = fields.InstanceHashField()
@@ -157,25 +163,66 @@ class SearchReferenceCommitForComment(IssueCommentJob):
             ).order_by('-authored_at')[0]
         except IndexError:
             # the commit was not found
-
-            tries = int(self.nb_tries.hget() or 0)
-
-            if tries >= 5:
-                # enough tries, stop now
-                self.status.hset(STATUSES.CANCELED)
-                return None
-            else:
-                # we'll try again...
-                self.status.hset(STATUSES.DELAYED)
-                self.delayed_until.hset(compute_delayed_until(delayed_for=60*tries))
-                self.nb_tries.hincrby(1)
-            return False
+            return self.retry_later()
 
         # commit found, save the comment
         self.object.save()
 
         return True
 
+    def retry_later(self):
+        """
+        Delay the job to search again, if not tried too many times
+        """
+        tries = int(self.nb_tries.hget() or 0)
+
+        if tries >= 5:
+            # enough tries, stop now
+            self.status.hset(STATUSES.CANCELED)
+            return None
+        else:
+            # we'll try again...
+            self.status.hset(STATUSES.DELAYED)
+            self.delayed_until.hset(compute_delayed_until(delayed_for=60*tries))
+            self.nb_tries.hincrby(1)
+        return False
+
+    @classmethod
+    def run_batch(cls, jobs, queue):
+        """
+        Search the commits of all the given jobs in one query, and save the
+        comments (loaded together in one query too) of the ones found
+        """
+        refs = [job.hmget('repository_id', 'commit_sha') for job in jobs]
+
+        commits = set(Commit.objects.filter(reduce(or_, [
+            Q(repository_id=repository_id, sha__startswith=commit_sha)
+            for repository_id, commit_sha in refs
+        ])).values_list('repository_id', 'sha'))
+
+        comments = cls.model.objects.in_bulk([int(job.identifier.hget()) for job in jobs])
+
+        results = []
+        for job, (repository_id, commit_sha) in zip(jobs, refs):
+            if not any(commit_repository_id == int(repository_id) and sha.startswith(commit_sha)
+                       for commit_repository_id, sha in commits):
+                results.append(job.retry_later())
+                continue
+            comment = comments.get(int(job.identifier.hget()))
+            if comment is None:
+                results.append(cls.model.DoesNotExist())
+                continue
+            try:
+                # own context to keep its side effects if another job fails
+                with bulk_sync():
+                    comment.save()
+            except Exception, e:
+                results.append(e)
+            else:
+                results.append(True)
+
+        return results
+
 
 class SearchReferenceCommitForPRComment(SearchReferenceCommitForComment):
     model = PullRequestComment
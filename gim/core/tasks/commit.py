@@ -2,6 +2,7 @@
 
 __all__ = [
     'FetchCommitBySha',
+    'FetchPendingCommits',
 ]
 
 from datetime import datetime
@@ -12,8 +13,10 @@ from limpyd_jobs import STATUSES
 
 from gim.core.models import Repository, Commit
 from gim.core.ghpool import ApiNotFoundError
+from gim.core.limpyd_models import PendingCommits
 
 from .base import Job
+from .repository import RepositoryJob
 
 
 class FetchCommitBySha(Job):
@@ -81,3 +84,93 @@ class FetchCommitBySha(Job):
     def success_message_addon(self, queue, result):
         if result is False:
             return ' [deleted]'
+
+
+class FetchPendingCommits(RepositoryJob):
+    """
+    Fetch in batch the commits of a repository that were referenced (by events
+    or comments) but that we don't have, collected via `add_sha`, then add the
+    jobs waiting for them, all in one pass
+    """
+    queue_name = 'fetch-pending-commits'
+
+    count = fields.InstanceHashField()
+    deleted = fields.InstanceHashField()
+    todo = fields.InstanceHashField()
+
+    permission = 'read'
+
+    # wait a little to let other shas be added before fetching them
+    delay = 10
+    max_calls = 20
+
+    @classmethod
+    def add_sha(cls, repository_id, sha, waiting_job_model=None,
+                waiting_object_id=None, priority=0, with_files=False):
+        """
+        Ask for the commit with the given sha to be fetched with the other
+        pending ones of the repository. If a job model is given, a job of this
+        model will be added for the given object id when done (it must accept
+        to be added with the `repository_id` and `commit_sha` fields if it
+        has them). The files of the commit are only fetched if `with_files`
+        is True (commits fetched in a list don't have them)
+        """
+        PendingCommits.get_for(repository_id).add(
+            sha,
+            waiting_job_model.queue_name if waiting_job_model else None,
+            waiting_object_id,
+            priority,
+            with_files
+        )
+        cls.add_job(repository_id, priority=priority, delayed_for=cls.delay)
+
+    def run(self, queue):
+        """
+        Fetch the pending commits of the repository, and add the jobs waiting
+        for the ones that are now done (found or not)
+        """
+        super(FetchPendingCommits, self).run(queue)
+
+        gh = self.gh
+        if not gh:
+            return  # it's delayed !
+
+        from .utils import get_job_model_for_name
+
+        repository = self.repository
+        pending = PendingCommits.get_for(repository.pk)
+
+        # the shas are only removed once done, to not lose them on failure
+        shas = pending.shas.smembers()
+        missing = repository.get_missing_shas(shas)
+
+        found, not_found, todo = repository.fetch_commits_by_shas(
+                gh, missing, max_calls=self.max_calls,
+                with_files=pending.with_files.smembers())
+
+        pending.remove_shas(shas.difference(todo))
+
+        for queue_name, object_id, sha, priority in pending.pop_waiting(shas.difference(todo)):
+            job_model = get_job_model_for_name(queue_name)
+            job_fields = {}
+            if 'commit_sha' in job_model._fields:
+                job_fields = {'repository_id': repository.pk, 'commit_sha': sha}
+            job_model.add_job(object_id, priority=priority, **job_fields)
+
+        self.hmset(count=len(found), deleted=len(not_found), todo=len(todo))
+
+        return len(found), len(not_found), len(todo)
+
+    def on_success(self, queue, result):
+        """
+        Go again later if some shas were not fetched, or were added while
+        running (the job was still queued so no other one was added)
+        """
+        if PendingCommits.get_for(self.repository.pk).shas.scard():
+            self.clone(delayed_for=self.delay)
+
+    def success_message_addon(self, queue, result):
+        """
+        Display the count of fetched, deleted and remaining commits
+        """
+        return ' [fetched=%d, deleted=%d, todo=%d]' % result
@@ -3,6 +3,7 @@
 __all__ = [
     'FetchIssueByNumber',
     'UpdateIssueCacheTemplate',
+    'UpdateRelatedIssuesCacheTemplate',
     'IssueEditStateJob',
     'IssueEditTitleJob',
     'IssueEditBodyJob',
@@ -14,13 +15,18 @@ __all__ = [
 import json
 import time
 
+from django.core.exceptions import ObjectDoesNotExist
+
 from async_messages import message_users, constants, messages
 
 from limpyd import fields
 from limpyd_jobs import STATUSES
 
+from gim.core import models as core_models
 from gim.core.models import Issue, Repository, GithubUser
+from gim.core.limpyd_models import PendingTemplateUpdates
 from gim.core.ghpool import ApiError, ApiNotFoundError
+from gim.core.utils import bulk_sync
 
 from .base import DjangoModelJob, Job
 
@@ -30,9 +36,11 @@ class FetchIssueByNumber(Job):
     Fetch the whole issue for a repository, given only the issue's number
     """
     queue_name = 'fetch-issue-by-number'
+    fair_by_repository = True
     deleted = fields.InstanceHashField()
     force_fetch = fields.InstanceHashField()  # will only force the issue/pr api call
     force_fetch_all = fields.InstanceHashField()  # will be used for fetch_all
+    saved_calls = fields.InstanceHashField()  # sub-resources not fetched because unchanged
     users_to_inform = fields.SetField()
 
     permission = 'read'
@@ -44,6 +52,10 @@ class FetchIssueByNumber(Job):
             self._repository = Repository.objects.get(id=repository_id)
         return self._repository
 
+    @classmethod
+    def get_repository_id_for(cls, identifier):
+        return str(identifier).split('#')[0]
+
     def run(self, queue):
         """
         Fetch the issue with the given number for the current repository
@@ -82,7 +94,7 @@ class FetchIssueByNumber(Job):
 
             # now the normal fetch, if we previously force fetched they'll result in 304
             # except if force_fetch_all
-            issue.fetch_all(gh, force_fetch=force_fetch_all)
+            saved_calls = issue.fetch_all(gh, force_fetch=force_fetch_all)
         except ApiNotFoundError, e:
             # we have a 404, but... check if it's the issue itself
             try:
@@ -106,6 +118,7 @@ class FetchIssueByNumber(Job):
 
                 raise e
         else:
+            self.saved_calls.hset(saved_calls or 0)
             if users_to_inform:
                 message_users(users_to_inform,
                     'The %s <strong>#%d</strong> from <strong>%s</strong> you asked to fetch from Github was updated' % (
@@ -115,14 +128,18 @@ class FetchIssueByNumber(Job):
         return True
 
     def success_message_addon(self, queue, result):
-        result = ''
+        message = ''
         if self.force_fetch_all.hget() == '1':
-            result += ' [force_fetch=all]'
+            message += ' [force_fetch=all]'
         elif self.force_fetch.hget() == '1':
-            result += ' [force_fetch=1]'
+            message += ' [force_fetch=1]'
         if result is False:
-            result += ' [deleted]'
-        return result
+            message += ' [deleted]'
+        else:
+            saved_calls = self.saved_calls.hget()
+            if saved_calls and saved_calls != '0':
+                message += ' [saved_calls=%s]' % saved_calls
+        return message
 
 
 class IssueJob(DjangoModelJob):
@@ -138,6 +155,11 @@ class IssueJob(DjangoModelJob):
             self._issue = self.object
         return self._issue
 
+    @classmethod
+    def get_repository_id_for(cls, identifier):
+        repository_ids = Issue.objects.filter(id=identifier).values_list('repository_id', flat=True)
+        return repository_ids[0] if repository_ids else None
+
     @property
     def repository(self):
         if not hasattr(self, '_repository'):
@@ -145,11 +167,42 @@ class IssueJob(DjangoModelJob):
         return self._repository
 
 
-class UpdateIssueCacheTemplate(IssueJob):
+class PendingTemplateUpdateMixin(object):
+    """
+    Mixin for jobs updating cached templates of issues, to have only one
+    pending job by identifier, with a check in PendingTemplateUpdates instead
+    of adding the job each time it's asked
+    """
+
+    @classmethod
+    def add_pending_job(cls, identifier, **kwargs):
+        """
+        Add a job for the given identifier, only if one is not already pending
+        """
+        if PendingTemplateUpdates.get().add(str(identifier)):
+            cls.add_job(identifier, **kwargs)
+
+    def run(self, queue):
+        # not pending anymore: a new demand must be done after this run
+        PendingTemplateUpdates.get().remove(self.identifier.hget())
+        return super(PendingTemplateUpdateMixin, self).run(queue)
+
+    def on_success(self, queue, result):
+        """
+        If asked again while running, the job was still queued so no other one
+        was added: do it now
+        """
+        if PendingTemplateUpdates.get().is_pending(self.identifier.hget()):
+            self.clone()
+
+
+class UpdateIssueCacheTemplate(PendingTemplateUpdateMixin, IssueJob):
     """
     Job that update the cached template of an issue
     """
     queue_name = 'update-issue-tmpl'
+    fair_by_repository = True
+    batch_size = 50
 
     force_regenerate = fields.InstanceHashField()
     update_duration = fields.InstanceHashField()
@@ -169,9 +222,17 @@ class UpdateIssueCacheTemplate(IssueJob):
             self.status.hset(STATUSES.CANCELED)
             return False
 
+        return self.update_template(issue, start_time)
+
+    def update_template(self, issue, start_time, reload=True):
+        """
+        Update the cached template of the given issue and save the duration
+        since `start_time`
+        """
         issue.update_saved_hash()
         issue.update_cached_template(
-                                force_regenerate=self.force_regenerate.hget())
+                                force_regenerate=self.force_regenerate.hget(),
+                                reload=reload)
 
         duration = '%.2f' % ((time.time() - start_time) * 1000)
 
@@ -179,6 +240,40 @@ class UpdateIssueCacheTemplate(IssueJob):
 
         return duration
 
+    @classmethod
+    def run_batch(cls, jobs, queue):
+        """
+        Update the cached templates of the issues of all the given jobs, loaded
+        together in one query
+        """
+        start_time = time.time()
+
+        pending = PendingTemplateUpdates.get()
+        identifiers = [job.identifier.hget() for job in jobs]
+        for identifier in identifiers:
+            pending.remove(identifier)
+
+        issues = Issue.get_queryset_for_cached_template().in_bulk(
+                                        [int(identifier) for identifier in identifiers])
+
+        results = []
+        for job, identifier in zip(jobs, identifiers):
+            issue = issues.get(int(identifier))
+            if issue is None:
+                # the issue doesn't exist anymore
+                job.status.hset(STATUSES.CANCELED)
+                results.append(False)
+                continue
+            try:
+                # own context to keep its side effects if another job fails
+                with bulk_sync():
+                    results.append(job.update_template(issue, start_time, reload=False))
+            except Exception, e:
+                results.append(e)
+            start_time = time.time()
+
+        return results
+
     def success_message_addon(self, queue, result):
         """
         Display the duration of the cached template update
@@ -191,6 +286,57 @@ class UpdateIssueCacheTemplate(IssueJob):
             return ' [%s]' % msg
 
 
+class UpdateRelatedIssuesCacheTemplate(PendingTemplateUpdateMixin, Job):
+    """
+    Job that update the cached templates of all the issues related to an
+    object (a user, a milestone, a label...), identified by "Model#pk", in
+    chunks, instead of having one job by issue
+    """
+    queue_name = 'update-related-issues-tmpl'
+
+    count = fields.InstanceHashField()
+    update_duration = fields.InstanceHashField()
+
+    chunk_size = 100
+
+    def run(self, queue):
+        """
+        Get the ids of the related issues in one query, and update their
+        cached templates, except the ones that have their own pending job
+        """
+        super(UpdateRelatedIssuesCacheTemplate, self).run(queue)
+
+        start_time = time.time()
+
+        model_name, obj_id = self.identifier.hget().split('#')
+
+        try:
+            obj = getattr(core_models, model_name).objects.get(id=obj_id)
+        except ObjectDoesNotExist:
+            # the object doesn't exist anymore, stop here
+            self.status.hset(STATUSES.CANCELED)
+            return False
+
+        issue_ids = set(obj.get_related_issues().order_by()
+                           .values_list('id', flat=True).distinct())
+        issue_ids.difference_update(
+            int(key) for key in PendingTemplateUpdates.get().get_pending() if key.isdigit())
+
+        count = Issue.update_cached_templates(issue_ids, chunk_size=self.chunk_size)
+
+        duration = '%.2f' % ((time.time() - start_time) * 1000)
+
+        self.hmset(count=count, update_duration=duration)
+
+        return count
+
+    def success_message_addon(self, queue, result):
+        """
+        Display the number of updated issues and the duration
+        """
+        return ' [issues=%s, duration=%sms]' % self.hmget('count', 'update_duration')
+
+
 class BaseIssueEditJob(IssueJob):
     abstract = True
 
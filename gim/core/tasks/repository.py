@@ -5,17 +5,26 @@ __all__ = [
     'FetchCollaborators',
     'FirstFetch',
     'FirstFetchStep2',
+    'FirstFetchShard',
+    'FinalizeFirstFetch',
     'FetchForUpdate',
+    'ReconcileRepository',
 ]
 
 from datetime import timedelta
 from dateutil.parser import parse
 from random import randint
 
+from django.conf import settings
+
 from limpyd import fields
+from limpyd_jobs import STATUSES
+from limpyd_jobs.utils import compute_delayed_until
 from async_messages import messages
 
 from gim.core.models import Repository, GithubUser
+from gim.core.limpyd_models import FirstFetchPlan, RepositoryActivity, SyncCursor
+from gim.core.managers import get_sync_counters
 from gim.subscriptions.models import WaitingSubscription, WAITING_SUBSCRIPTION_STATES
 
 from .base import DjangoModelJob, Job
@@ -34,18 +43,23 @@ class RepositoryJob(DjangoModelJob):
             self._repository = self.object
         return self._repository
 
+    @classmethod
+    def get_repository_id_for(cls, identifier):
+        return identifier
+
 
 class FetchClosedIssuesWithNoClosedBy(RepositoryJob):
     """
     Job that fetches issues from a repository, that are closed but without a
     closed_by (to get the closer_by, we need to fetch each closed issue
-    individually)
+    individually, except if we can get it from the issue's events)
     """
     queue_name = 'fetch-closed-issues'
 
     limit = fields.InstanceHashField()
     count = fields.InstanceHashField()
     errors = fields.InstanceHashField()
+    resolved = fields.InstanceHashField()  # closed_by got from events
 
     permission = 'read'
     clonable_fields = ('gh', 'limit', )
@@ -61,10 +75,13 @@ class FetchClosedIssuesWithNoClosedBy(RepositoryJob):
         if not gh:
             return  # it's delayed !
 
+        # first use the events we have, to only fetch issues without them
+        resolved = self.repository.set_closed_by_from_events()
+
         count, deleted, errors, todo = self.repository.fetch_closed_issues_without_closed_by(
                                                     limit=int(self.limit.hget() or 20), gh=gh)
 
-        self.hmset(count=count, errors=errors)
+        self.hmset(count=count, errors=errors, resolved=resolved)
 
         return count, deleted, errors, todo
 
@@ -78,9 +95,10 @@ class FetchClosedIssuesWithNoClosedBy(RepositoryJob):
 
     def success_message_addon(self, queue, result):
         """
-        Display the count of closed issues fetched
+        Display the count of closed issues fetched, and resolved via events
         """
-        return ' [fetched=%d, deleted=%s, errors=%s, todo=%s]' % result
+        return ' [resolved=%s, fetched=%d, deleted=%s, errors=%s, todo=%s]' % (
+                                            (self.resolved.hget() or 0, ) + result)
 
 
 class FetchUpdatedPullRequests(RepositoryJob):
@@ -89,6 +107,7 @@ class FetchUpdatedPullRequests(RepositoryJob):
     can only have by fetching them one by one
     """
     queue_name = 'update-pull-requests'
+    fair_by_repository = True
 
     limit = fields.InstanceHashField()
     count = fields.InstanceHashField()
@@ -319,24 +338,26 @@ class FirstFetch(Job):
 class FirstFetchStep2(RepositoryJob):
     """
     A job to fetch the less important data of a repository (closed issues and
-    comments)
+    comments).
+    Only the first page of each list is fetched by this job, then the other
+    pages are split in shards (ranges of pages of a list), each one fetched by
+    a FirstFetchShard job, so they can be done in parallel by many workers.
+    The FinalizeFirstFetch job is added when all shards are done.
+    The first page of each list is resumed using SyncCursor objects, to know
+    the number of pages of each list, and deleted by FinalizeFirstFetch.
     """
     queue_name = 'repository-fetch-step2'
-    clonable_fields = ('gh', 'max_pages', )
-
-    start_page = fields.InstanceHashField()
-    max_pages = fields.InstanceHashField()
-    to_ignore = fields.SetField()
+    clonable_fields = ('gh', )
 
     counts = fields.HashField()
-    last_one = fields.InstanceHashField()
+    nb_shards = fields.InstanceHashField()
 
     permission = 'read'
 
     def run(self, queue):
         """
-        Call the fetch_all_step2 method of the linked repository, using the
-        value of the start_page and max_pages job's attributes
+        Fetch the first page of each list then add a job for each shard of
+        the following pages
         """
         super(FirstFetchStep2, self).run(queue)
 
@@ -344,103 +365,269 @@ class FirstFetchStep2(RepositoryJob):
         if not gh:
             return  # it's delayed !
 
-        self._start_page, self._max_pages = self.hmget('start_page', 'max_pages')
+        repository = self.repository
 
-        try:
-            self._start_page = int(self._start_page)
-        except Exception:
-            self._start_page = 1
-            self.start_page.hset(self._start_page)
+        counts = repository.fetch_all_step2(gh=gh, force_fetch=True, max_pages=1,
+                                            issues_state='closed',
+                                            use_sync_cursors=True)
 
-        try:
-            self._max_pages = int(self._max_pages)
-        except Exception:
-            self._max_pages = 5
-            self.max_pages.hset(self._max_pages)
+        plan = FirstFetchPlan.get_for(repository)
+        shard_pages = settings.FIRST_FETCH_SHARD_PAGES
+        shards = []
+        for list_name in repository.STEP2_LISTS:
+            total_pages = repository.get_step2_total_pages(list_name)
+            for first_page in range(2, total_pages + 1, shard_pages):
+                shard = '%s#%s' % (list_name, first_page)
+                plan.add_shard(shard)
+                shards.append(shard)
 
-        try:
-            self._to_ignore = set(self.to_ignore.smembers())
-        except:
-            self._to_ignore = None
+        # private repositories must be fetched with a token that can access it,
+        # for the other ones, let each shard use any available token
+        shard_kwargs = {'max_pages': shard_pages}
+        if repository.private:
+            shard_kwargs['gh'] = gh
+
+        for shard in shards:
+            FirstFetchShard.add_job('%s#%s' % (repository.id, shard), **shard_kwargs)
 
-        counts = self.repository.fetch_all_step2(gh=gh, force_fetch=True,
-                        start_page=self._start_page, max_pages=self._max_pages,
-                        to_ignore=self._to_ignore, issues_state='closed')
+        if not shards:
+            FinalizeFirstFetch.add_job(repository.id, gh=gh)
+
+        self.nb_shards.hset(len(shards))
 
         return counts
 
-    def on_success(self, queue, result):
+    def success_message_addon(self, queue, result):
+        return ' [%s] - %s shard(s)' % (
+            ', '.join(['%s=%s' % (k, v) for k, v in result.iteritems()]),
+            self.nb_shards.hget())
+
+
+class FirstFetchShard(Job):
+    """
+    A job to fetch a shard of the first fetch of a repository: some pages of
+    one of the lists fetched by Repository.fetch_all_step2.
+    The identifier is "repository_id#list_name#first_page".
+    At most FIRST_FETCH_MAX_RUNNING_SHARDS shards of a same repository are
+    fetched at the same time, the other ones are delayed.
+    When the last shard is done, the FinalizeFirstFetch job is added.
+    """
+    queue_name = 'repository-fetch-shard'
+
+    max_pages = fields.InstanceHashField()
+    count = fields.InstanceHashField()
+
+    permission = 'read'
+
+    def _parse_identifier(self):
+        repository_id, self._list_name, first_page = self.identifier.hget().split('#')
+        self._repository_id, self._first_page = int(repository_id), int(first_page)
+
+    @property
+    def repository(self):
+        if not hasattr(self, '_repository'):
+            self._parse_identifier()
+            self._repository = Repository.objects.get(id=self._repository_id)
+        return self._repository
+
+    @property
+    def shard(self):
+        self._parse_identifier()
+        return '%s#%s' % (self._list_name, self._first_page)
+
+    def run(self, queue):
         """
-        When done, if something was fetched, add a new job to continue the fetch
-        of following pages one minute later.
-        If nothing was fetched, we are done and add a job to do a new full
-        fetch to check updates.
+        Fetch the pages of the shard, if not too many shards are running for
+        the same repository, and save the count of fetched objects
         """
+        super(FirstFetchShard, self).run(queue)
 
-        if result:
-            self.counts.hmset(**result)
-            total_count = sum(result.values())
-        else:
-            total_count = 0
+        gh = self.gh
+        if not gh:
+            return  # it's delayed !
 
-        if total_count:
-            # we got data, continue at least one time
+        shard = self.shard
+        plan = FirstFetchPlan.get_for(self.repository)
 
-            self._to_ignore.update([k for k, v in result.iteritems() if not v])
+        if not plan.start_shard(shard, settings.FIRST_FETCH_MAX_RUNNING_SHARDS):
+            # too many running shards for this repository, retry later
+            self.status.hset(STATUSES.DELAYED)
+            self.delayed_until.hset(compute_delayed_until(delayed_for=randint(20, 40)))
+            return None
 
-            kwargs = {'start_page': self._start_page + self._max_pages}
-            if self._to_ignore:
-                kwargs['to_ignore'] = self._to_ignore  # cannot sadd an empty set
+        try:
+            counts = self.repository.fetch_all_step2(gh=gh, force_fetch=True,
+                            start_page=self._first_page,
+                            max_pages=int(self.max_pages.hget() or settings.FIRST_FETCH_SHARD_PAGES),
+                            to_ignore=set(self.repository.STEP2_LISTS) - set([self._list_name]),
+                            issues_state='closed')
+            count = counts.get(self._list_name, 0)
+            plan.set_shard_done(shard, count)
+        finally:
+            plan.stop_shard(shard)
+
+        self.count.hset(count)
 
-            self.clone(delayed_for=60, **kwargs)
+        return count
 
-        else:
-            # got nothing, it's the end, add a job to do future fetches
-            self.last_one.hset(1)
-            FetchForUpdate.add_job(self.object.id, gh=self.gh)
+    def on_success(self, queue, result):
+        """
+        If it was the last shard to be fetched, finalize the first fetch
+        """
+        if FirstFetchPlan.get_for(self.repository).is_done():
+            FinalizeFirstFetch.add_job(self.repository.id, gh=self.gh)
 
     def success_message_addon(self, queue, result):
-        msg = ' [%s]' % (', '.join(['%s=%s' % (k, v) for k, v in result.iteritems()]))
+        return ' [%s, pages=%s-%s, fetched=%s]' % (
+            self._list_name, self._first_page,
+            self._first_page + int(self.max_pages.hget() or 0) - 1, result)
 
-        if result and sum(result.values()):
 
-            msg += ' - Continue (start page %s for %s pages)' % (
-                            self._start_page + self._max_pages, self._max_pages)
+class FinalizeFirstFetch(RepositoryJob):
+    """
+    A job to end the first fetch of a repository, when all its shards are done:
+    the first page of each list is fetched again (to get objects updated while
+    the shards were fetched, and to save the etags and fetch dates to use for
+    next fetches), then the updates of the repository are started.
+    """
+    queue_name = 'finalize-first-fetch'
 
-        else:
-            msg += ' - The end.'
+    counts = fields.HashField()
+
+    permission = 'read'
+
+    def run(self, queue):
+        super(FinalizeFirstFetch, self).run(queue)
+
+        gh = self.gh
+        if not gh:
+            return  # it's delayed !
+
+        repository = self.repository
+        plan = FirstFetchPlan.get_for(repository)
+
+        counts = repository.fetch_all_step2(gh=gh, force_fetch=True, max_pages=1,
+                                            issues_state='closed')
+
+        # the first page is not in the counts of the shards, but in the ones of
+        # the FirstFetchStep2 job
+        total_counts = plan.get_counts()
+        if total_counts:
+            self.counts.hmset(**total_counts)
 
-        return msg
+        if not repository.first_fetch_done:
+            repository.first_fetch_done = True
+            repository.save(update_fields=['first_fetch_done'])
+
+        plan.delete()
+        SyncCursor.delete_all_for(repository)
+
+        return counts
+
+    def on_success(self, queue, result):
+        """
+        Add a job to do future fetches
+        """
+        FetchForUpdate.add_job(self.repository.id, gh=self.gh)
+
+    def success_message_addon(self, queue, result):
+        return ' [shards: %s]' % ', '.join(['%s=%s' % (k, v) for k, v in
+                                             self.counts.hgetall().iteritems()])
 
 
 class FetchForUpdate(RepositoryJob):
     """
-    Job that will do an unforced full fetch of the repository to update all that
-    needs to.
+    Job that will do an unforced fetch of the repository to update all that
+    needs to, only asking for issues and comments updated since the last
+    fetch (deleted ones are detected by the ReconcileRepository job).
     When done:
     - spawn a job to fetch collaborators
-    - clone the job to be done again 15 min laters (+-2mn)
+    - spawn a job to do a full reconciliation later, if not already planned
+    - clone the job to be done again later, with a delay depending on the
+      activity of the repository (see RepositoryActivity)
+    The job is canceled, and not cloned, if the repository was deleted or has
+    no subscriptions anymore.
     """
     queue_name = 'update-repo'
 
     permission = 'read'
     clonable_fields = ('gh', )
 
+    next_delay = fields.InstanceHashField()
+    next_delay_reason = fields.InstanceHashField()
+
     def run(self, queue):
         """
-        Fetch the whole repository stuff if it has a subscription
+        Fetch the whole repository stuff if it has a subscription, and compute
+        the delay before the next fetch, using the number of saved objects
         """
         super(FetchForUpdate, self).run(queue)
 
+        try:
+            repository = self.repository
+        except Repository.DoesNotExist:
+            repository = None
+
+        if repository is None or not repository.has_subscriptions():
+            # not updated anymore: free its api budget
+            self.status.hset(STATUSES.CANCELED)
+            RepositoryActivity.get_for('FetchForUpdate', self.identifier.hget()).stop()
+            return None
+
         gh = self.gh
         if not gh:
             return  # it's delayed !
 
-        self.repository.fetch_all(gh)
+        repository.fetch_all(gh, delta_sync=True)
+
+        counters = get_sync_counters()
+        delay, reason = RepositoryActivity.get_for('FetchForUpdate', repository).plan_next_run(
+            nb_changes=counters['written'],
+            api_calls=counters['api_calls'],
+            min_delay=settings.REPOSITORY_UPDATE_MIN_DELAY,
+            max_delay=settings.REPOSITORY_UPDATE_MAX_DELAY,
+            hook_set=getattr(repository, 'hook_set', False),
+        )
+        self.hmset(next_delay=delay, next_delay_reason=reason)
+
+        return delay
 
     def on_success(self, queue, result):
         """
-        Fetch collaborators and go fetch again in 15 +- 2mn
+        Fetch collaborators, plan a reconciliation (if one is already planned,
+        it's not changed), and go fetch again later
         """
         FetchCollaborators.add_job(self.object.id)
-        self.clone(delayed_for=60 * 13 + randint(0, 60 * 4))
+        ReconcileRepository.add_job(self.object.id, gh=self.gh,
+                                    delayed_for=settings.REPOSITORY_RECONCILIATION_DELAY)
+        self.clone(delayed_for=result)
+
+    def success_message_addon(self, queue, result):
+        """
+        Display when the next fetch will be done, and why
+        """
+        return ' [next in %ss: %s]' % self.hmget('next_delay', 'next_delay_reason')
+
+
+class ReconcileRepository(RepositoryJob):
+    """
+    Job that will do a forced full fetch of the repository, not only of the
+    updated issues and comments like FetchForUpdate, to detect the deleted
+    ones (an unforced fetch would stop on the min date or on a "not modified"
+    response, without removing anything). Added by FetchForUpdate to be run a lot less often than it.
+    """
+    queue_name = 'reconcile-repo'
+
+    permission = 'read'
+
+    def run(self, queue):
+        """
+        Fetch the whole repository stuff
+        """
+        super(ReconcileRepository, self).run(queue)
+
+        gh = self.gh
+        if not gh:
+            return  # it's delayed !
+
+        self.repository.fetch_all(gh, force_fetch=True)
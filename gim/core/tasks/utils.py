@@ -3,6 +3,7 @@ from datetime import datetime
 from operator import attrgetter, itemgetter
 
 from limpyd_jobs import STATUSES
+from limpyd_jobs.utils import datetime_to_score
 
 from gim.hooks.tasks import CheckRepositoryHook, CheckRepositoryEvents
 
@@ -29,7 +30,9 @@ def get_job_model_for_name(name):
 
 def print_queues():
     """
-    Print each queue with waiting or delayed jobs, by priority
+    Print each queue with waiting or delayed jobs, by priority, with the
+    seconds waited by the last started job (so for queues by repository, named
+    like "queue-name@42", we can see if some repositories are starving)
     """
     queues = OrderedDict()
     for q in Queue.collection().sort(by='name', alpha=True).instances():
@@ -37,11 +40,12 @@ def print_queues():
         delayed = q.delayed.zcard()
         if waiting + delayed == 0:
             continue
-        name, priority = q.hmget('name', 'priority')
+        name, priority, last_wait = q.hmget('name', 'priority', 'last_wait')
         queues.setdefault(name, []).append({
             'priority': int(priority),
             'waiting': waiting,
             'delayed': delayed,
+            'last_wait': float(last_wait or 0),
         })
 
     for name in queues:
@@ -49,17 +53,32 @@ def print_queues():
 
         total_waiting = sum([q['waiting'] for q in sub_queues])
         total_delayed = sum([q['delayed'] for q in sub_queues])
+        max_wait = max([q['last_wait'] for q in sub_queues])
 
         if len(sub_queues) == 1:
             priority_part = sub_queues[0]['priority']
         else:
             priority_part = '----'
 
-        print('%30s  %4s  %4d  %4d' % (name, priority_part, total_waiting, total_delayed))
+        print('%30s  %4s  %4d  %4d  %7ds' % (name, priority_part, total_waiting, total_delayed, max_wait))
 
         if len(sub_queues) > 1:
             for i, q in enumerate(sub_queues):
-                print('%30s  %4d  %4d  %4d' % (' ', q['priority'], q['waiting'], q['delayed']))
+                print('%30s  %4d  %4d  %4d  %7ds' % (' ', q['priority'], q['waiting'], q['delayed'], q['last_wait']))
+
+
+def count_jobs(names):
+    """
+    Return the number of jobs waiting, delayed, and delayed but ready to be
+    requeued, in all queues (for all priorities) with the given names
+    """
+    now = datetime_to_score(datetime.utcnow())
+    waiting = delayed = ready = 0
+    for q in Queue.get_all(names):
+        waiting += q.waiting.llen()
+        delayed += q.delayed.zcard()
+        ready += q.delayed.zcount('-inf', now)
+    return waiting, delayed, ready
 
 
 def delete_empty_queues(dry_run=False, max_priority=0):
@@ -5,7 +5,14 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os
+
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase
+
+from limpyd.contrib.database import PipelineDatabase
+
+from gim.core.limpyd_models import Token
 
 
 class SimpleTest(TestCase):
@@ -14,3 +21,117 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class TokenIndexTest(SimpleTestCase):
+    """
+    Test the indexes of tokens by remaining api calls, and the leasing of
+    tokens with the lua scripts, on a redis database that is flushed (the
+    LIMPYD_TEST_DB_REDIS_DB env variable, default to 15)
+    """
+
+    def setUp(self):
+        self.original_database = Token.database
+        Token.use_database(PipelineDatabase(**dict(settings.LIMPYD_DB_CONFIG,
+                db=int(os.environ.get('LIMPYD_TEST_DB_REDIS_DB', 15)))))
+        Token.get_connection().flushdb()
+        self.original_lease_ttl = Token.LEASE_TTL
+
+    def tearDown(self):
+        Token.get_connection().flushdb()
+        Token.use_database(self.original_database)
+        Token.LEASE_TTL = self.original_lease_ttl
+
+    def make_token(self, name, remaining, available=True, repos_pull=()):
+        token = Token(token=name, username=name, available=int(available))
+        token.rate_limit_remaining.set(remaining)
+        if repos_pull:
+            token.repos_pull.sadd(*repos_pull)
+        token.update_index()
+        return token
+
+    def get_score(self, name, repository_pk=None, permission=None):
+        return Token.get_connection().zscore(
+                    Token.get_index_key(repository_pk, permission), name)
+
+    def test_index_keys(self):
+        self.assertEqual(Token.get_index_key(), Token.get_index_key(42, 'read'))
+        self.assertNotEqual(Token.get_index_key(), Token.get_index_key(42, 'pull'))
+        self.assertNotEqual(Token.get_index_key(42, 'pull'), Token.get_index_key(42, 'push'))
+
+    def test_update_index(self):
+        token = self.make_token('t1', 1000, repos_pull=[42])
+        self.assertEqual(self.get_score('t1'), 1000)
+        self.assertEqual(self.get_score('t1', 42, 'pull'), 1000)
+        self.assertIsNone(self.get_score('t1', 42, 'push'))
+
+        # a new score is set in all the indexes of the token
+        token.update_index_score(800)
+        self.assertEqual(self.get_score('t1'), 800)
+        self.assertEqual(self.get_score('t1', 42, 'pull'), 800)
+
+        # an unavailable token is removed from all indexes
+        token.available.hset(0)
+        token.update_index()
+        self.assertIsNone(self.get_score('t1'))
+        self.assertIsNone(self.get_score('t1', 42, 'pull'))
+
+        # and is indexed again if its score is updated once available
+        token.available.hset(1)
+        token.rate_limit_remaining.set(900)
+        token.update_index_score(900)
+        self.assertEqual(self.get_score('t1'), 900)
+        self.assertEqual(self.get_score('t1', 42, 'pull'), 900)
+
+    def test_lease_by_permission(self):
+        self.make_token('t1', 1000)
+        self.make_token('t2', 600, repos_pull=[42])
+        self.make_token('t3', 5000, available=False, repos_pull=[42])
+
+        self.assertEqual(Token.lease(calls=1).token.hget(), 't1')
+        self.assertEqual(Token.lease(42, 'pull', calls=1).token.hget(), 't2')
+        self.assertIsNone(Token.lease(42, 'push', calls=1))
+        self.assertIsNone(Token.lease(42, 'pull', calls=700))
+
+    def test_leases_spread_on_tokens(self):
+        self.make_token('t1', 1000)
+        self.make_token('t2', 995)
+
+        self.assertEqual(Token.lease(calls=10).token.hget(), 't1')
+        # t1 has now 990 calls not leased
+        self.assertEqual(Token.lease(calls=10).token.hget(), 't2')
+        self.assertEqual(Token.lease(calls=10).token.hget(), 't1')
+
+        # leases don't change the scores in the index
+        self.assertEqual(self.get_score('t1'), 1000)
+        self.assertEqual(self.get_score('t2'), 995)
+
+    def test_expired_leases_are_released(self):
+        Token.LEASE_TTL = 0
+        self.make_token('t1', 100)
+
+        # without expiry, the second lease would not find enough calls
+        self.assertEqual(Token.lease(calls=80).token.hget(), 't1')
+        self.assertEqual(Token.lease(calls=80).token.hget(), 't1')
+
+    def test_live_leases_are_kept(self):
+        self.make_token('t1', 100)
+
+        self.assertEqual(Token.lease(calls=80).token.hget(), 't1')
+        self.assertIsNone(Token.lease(calls=80))
+        self.assertEqual(Token.lease(calls=20).token.hget(), 't1')
+
+    def test_get_one_for_repository(self):
+        self.make_token('t1', 1000)
+        self.make_token('t2', 600, repos_pull=[42])
+
+        # leased from the index
+        self.assertEqual(Token.get_one_for_repository(42, 'pull').token.hget(), 't2')
+        self.assertEqual(Token.get_one().token.hget(), 't1')
+
+        # from a collection, filtered on the permission
+        Token.get(token='t1').rate_limit_reset.hset(10)
+        Token.get(token='t2').rate_limit_reset.hset(20)
+        self.assertEqual(Token.get_one_for_repository(42, 'pull', available=False,
+                                sort_by='rate_limit_reset').token.hget(), 't2')
+        self.assertIsNone(Token.get_one_for_repository(43, 'pull', sort_by=None))
@@ -1,7 +1,15 @@
 import gc
+import logging
+import sys
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
+from threading import local
+from uuid import uuid4
 
-from django.db import models
+from django.db import DEFAULT_DB_ALIAS, connections, models, transaction
+
+logger = logging.getLogger('django')
 
 
 def contribute_to_model(contrib, destination):
@@ -88,6 +96,99 @@ def queryset_iterator(queryset, chunksize=1000):
         gc.collect()
 
 
+# maximum number of parameters in a query, by database vendor
+MAX_QUERY_PARAMS = {
+    'sqlite': 999,  # SQLITE_MAX_VARIABLE_NUMBER
+    'oracle': 1000,  # max number of expressions in a list
+    'postgresql': 65535,  # the number of parameters is sent on 2 bytes
+    'mysql': 65535,  # same for prepared statements
+}
+
+
+def get_in_chunk_size(using=DEFAULT_DB_ALIAS, margin=50):
+    """
+    Return the maximum number of values to pass to a "IN" query for the given
+    database, keeping `margin` parameters for other parts of the query.
+    """
+    connection = connections[using]
+    max_params = getattr(connection.features, 'max_query_params', None) \
+                 or MAX_QUERY_PARAMS.get(connection.vendor, 1000)
+    return max_params - margin
+
+
+def chunks(values, size):
+    """
+    Yield lists of at most `size` values from the given iterable
+    """
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def in_chunks(values, using=DEFAULT_DB_ALIAS, margin=50):
+    """
+    Yield lists of values small enough to be used in a "IN" query for the
+    given database (see get_in_chunk_size)
+    """
+    return chunks(values, get_in_chunk_size(using, margin))
+
+
+def filter_in_chunks(queryset, field_name, values, margin=50):
+    """
+    Yield querysets filtering the given one with `field_name` in the given
+    values, by chunks small enough for the database of the queryset
+    """
+    for chunk in in_chunks(values, queryset.db, margin):
+        yield queryset.filter(**{'%s__in' % field_name: chunk})
+
+
+def diff_ids(queryset, ids, min_ids_for_temporary_table=1000):
+    """
+    Return two lists: the ids of the objects of the queryset not in the given
+    list of ids, and the ids of this list not in the queryset.
+    If there are many ids, instead of loading all ids of the queryset to use
+    python sets, the ids are inserted in a temporary table, and the diff is
+    done by the database.
+    """
+    ids = set(ids or [])
+    queryset = queryset.order_by().values_list('pk', flat=True)
+
+    if len(ids) < min_ids_for_temporary_table:
+        existing_ids = set(queryset)
+        return list(existing_ids - ids), list(ids - existing_ids)
+
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    table = qn('tmp_ids_%s' % uuid4().hex)
+    # the column of the subquery is named as the pk column
+    pk = qn(queryset.model._meta.pk.column)
+    queryset_sql, queryset_params = queryset.query.sql_with_params()
+
+    with transaction.atomic(using=queryset.db):
+        cursor = connection.cursor()
+        cursor.execute('CREATE TEMPORARY TABLE %s (id integer PRIMARY KEY)' % table)
+        try:
+            for chunk in in_chunks(ids, queryset.db, margin=0):
+                cursor.execute('INSERT INTO %s (id) VALUES %s' % (
+                    table, ', '.join(['(%s)'] * len(chunk))), chunk)
+
+            cursor.execute('SELECT existing.%(pk)s FROM (%(queryset)s) existing '
+                           'WHERE NOT EXISTS (SELECT 1 FROM %(table)s tmp WHERE tmp.id = existing.%(pk)s)'
+                           % {'pk': pk, 'queryset': queryset_sql, 'table': table}, queryset_params)
+            to_remove = [row[0] for row in cursor.fetchall()]
+
+            cursor.execute('SELECT tmp.id FROM %(table)s tmp '
+                           'WHERE NOT EXISTS (SELECT 1 FROM (%(queryset)s) existing WHERE existing.%(pk)s = tmp.id)'
+                           % {'pk': pk, 'queryset': queryset_sql, 'table': table}, queryset_params)
+            to_add = [row[0] for row in cursor.fetchall()]
+        finally:
+            # a plain DROP TABLE commits the current transaction on mysql
+            cursor.execute('DROP %sTABLE %s' % (
+                'TEMPORARY ' if connection.vendor == 'mysql' else '', table))
+
+    return to_remove, to_add
+
+
 def cached_method(func):
     """
     Based on django.util.functional.memoize. Automatically memoizes instace methods for the lifespan
@@ -106,3 +207,160 @@ def cached_method(func):
             inst._memoized_values[key] = func(*args)
         return inst._memoized_values[key]
     return wrapper
+
+
+_deferred = local()
+
+
+@contextmanager
+def bulk_sync():
+    """
+    To use around code saving many objects from github (a page, a list, a
+    job...): in this context, calls to functions decorated with `deferrable`
+    are not done but saved (only once by object for the ones with a key), to be
+    all done (in one transaction) when exiting the outermost context.
+    If an exception is raised in a context, the calls saved in this context
+    are forgotten (objects saved in it were not, if in a rolled back
+    transaction), but the ones saved in inner contexts exited without error
+    are still done.
+    """
+    calls = getattr(_deferred, 'calls', None)
+
+    if calls is not None:
+        # already in a bulk_sync context, calls will be done by the outermost.
+        # Snapshots of the calls when entering this context, to know the ones
+        # saved in it
+        saved_calls = calls.copy()
+        saved_safe_calls = _deferred.safe_calls.copy()
+        try:
+            yield
+        except Exception:
+            # forget the calls of this context, but not the ones of its inner
+            # contexts exited without error
+            calls = saved_calls
+            _add_new_calls(calls, _deferred.safe_calls, saved_safe_calls)
+            _deferred.calls = calls
+            raise
+        # the calls saved in this context must be done even if an outer
+        # context fails (but not the ones saved before in the outer ones)
+        _add_new_calls(_deferred.safe_calls, _deferred.calls, saved_calls)
+        return
+
+    _deferred.calls = OrderedDict()
+    _deferred.safe_calls = OrderedDict()
+    try:
+        yield
+    except Exception:
+        exc_info = sys.exc_info()
+        _deferred.calls = _deferred.safe_calls
+        try:
+            run_deferred_calls()
+        except Exception:
+            logger.exception('Error while running deferred calls after an error')
+        raise exc_info[0], exc_info[1], exc_info[2]
+    else:
+        run_deferred_calls()
+
+
+def _add_new_calls(calls, new_calls, old_calls):
+    """
+    Add (or update) in `calls` the ones from `new_calls` that are not the same
+    in `old_calls` (a previous snapshot of `new_calls`)
+    """
+    for call_key, call in new_calls.items():
+        if old_calls.get(call_key) is not call:
+            calls.pop(call_key, None)
+            calls[call_key] = call
+
+
+def run_deferred_calls():
+    """
+    Run all calls saved in the bulk_sync context. Calls to deferrable functions
+    done during this run are also saved and run after, until no more calls are
+    saved, allowing them to be coalesced too.
+    Consecutive calls to functions declared with a `pipeline` database are run
+    in one pipeline of this database.
+    """
+    calls = _deferred.calls
+    try:
+        with transaction.atomic():
+            while calls:
+                _deferred.calls = OrderedDict()
+
+                pipelined = []
+                for func, args, kwargs in calls.values():
+                    database = func.deferrable_pipeline
+                    if pipelined and database is not pipelined[0][0].deferrable_pipeline:
+                        _run_pipelined_calls(pipelined)
+                        pipelined = []
+                    if database is not None:
+                        pipelined.append((func, args, kwargs))
+                    else:
+                        func(*args, **kwargs)
+                if pipelined:
+                    _run_pipelined_calls(pipelined)
+
+                calls = _deferred.calls
+    finally:
+        _deferred.calls = _deferred.safe_calls = None
+
+
+def _run_pipelined_calls(calls):
+    with calls[0][0].deferrable_pipeline.pipeline(transaction=False) as pipe:
+        for func, args, kwargs in calls:
+            func(*args, **kwargs)
+        pipe.execute()
+
+
+def deferrable(func=None, key=None, merge=None, pipeline=None):
+    """
+    Decorator to defer calls to the decorated function when in a `bulk_sync`
+    context. Return values are lost in this case.
+    If `key` is given, it's a function called with the arguments of each call,
+    returning a key to only do one call by key: the last one, or the result
+    of `merge`, if given, called with the previous and the new calls, each
+    one as a tuple (args, kwargs), and returning a tuple (args, kwargs) too.
+    If `pipeline` is given, it's a limpyd database, in a pipeline of which the
+    deferred calls can be done (so they must not need results of redis calls).
+    Can be used with or without arguments.
+    """
+    if func is None:
+        return lambda func: deferrable(func, key=key, merge=merge, pipeline=pipeline)
+
+    func.deferrable_pipeline = pipeline
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        calls = getattr(_deferred, 'calls', None)
+        if calls is None:
+            return func(*args, **kwargs)
+        if key is None:
+            call_key = (func, object())
+        else:
+            call_key = (func, key(*args, **kwargs))
+            if merge is not None and call_key in calls:
+                _, previous_args, previous_kwargs = calls[call_key]
+                args, kwargs = merge((previous_args, previous_kwargs), (args, kwargs))
+            # the call takes the place of the last one
+            calls.pop(call_key, None)
+        calls[call_key] = (func, args, kwargs)
+    return wrapper
+
+
+def merge_post_save_calls(previous, new):
+    """
+    To use as `merge` for deferrable post_save signal handlers: keep the new
+    call, but with `created` set to True if it was in the previous one
+    """
+    args, kwargs = new
+    if previous[1].get('created'):
+        kwargs = dict(kwargs, created=True)
+    return args, kwargs
+
+
+def post_save_key(sender, instance, **kwargs):
+    """
+    To use as `key` for deferrable post_save signal handlers, to run them only
+    once by object
+    """
+    return sender, instance.pk
@@ -1,13 +1,41 @@
 # inspired by http://justcramer.com/2010/12/06/tracking-changes-to-fields-in-django/
 
 from django.contrib.contenttypes.models import ContentType
+from django.db.models.query import QuerySet
 from django.db.models.signals import post_init, post_save, m2m_changed
 
 from gim.core.models import GithubUser,  Milestone, Issue, Label
+from gim.core.utils import deferrable
 
 UNSAVED = dict()
 
 
+def merge_tracked_changes(previous, new):
+    """
+    When an object is saved many times in bulk_sync, create only one event,
+    with the old values from the first save
+    """
+    _, previous_created, previous_changed_fields = previous[0][1:]
+    tracker, instance, created, changed_fields = new[0]
+    changed_fields = dict(changed_fields, **previous_changed_fields)
+    return (tracker, instance, created or previous_created, changed_fields), {}
+
+
+@deferrable(key=lambda tracker, instance, created, changed_fields: (tracker, instance.pk),
+            merge=merge_tracked_changes)
+def create_tracked_event(tracker, instance, created, changed_fields):
+    """
+    Create the event for the given changes, deferred in bulk_sync
+    """
+    if not created:
+        # ignore fields that changed back to their old value
+        changed_fields = dict((field, old) for field, old in changed_fields.iteritems()
+                              if old != getattr(instance, field))
+        if not changed_fields:
+            return
+    tracker.create_event(instance, created, changed_fields)
+
+
 class ChangeTracker(object):
 
     fields = ()
@@ -26,16 +54,23 @@ class ChangeTracker(object):
 
     @classmethod
     def _instance_post_save(cls, instance, **kwargs):
-        cls.create_event(instance, **kwargs)
+        # get the changes now, but the event may be created later, with the
+        # values of the instance at this time (see create_tracked_event)
+        created = kwargs.get('created', False)
+        changed_fields = {}
+        if not created:
+            changed_fields = dict((field, list(old) if isinstance(old, QuerySet) else old)
+                                  for field, old in instance.changed_fields().iteritems())
         cls._instance_update_fields(instance)
+        if created or changed_fields:
+            create_tracked_event(cls, instance, created, changed_fields)
 
     @classmethod
-    def create_event(cls, instance, **kwargs):
+    def create_event(cls, instance, created, changed_fields):
         event = None
-        if kwargs.get('created'):
+        if created:
             event = cls.add_created_event(instance)
         else:
-            changed_fields = instance.changed_fields()
             if changed_fields:
                 event = cls.add_changed_event(instance, changed_fields)
                 if not cls.add_changed_parts(instance, changed_fields, event) and not event.parts.count():
@@ -14,7 +14,7 @@ from gim.subscriptions.models import (WaitingSubscription,
                                       SUBSCRIPTION_STATES, )
 
 from gim.core import GITHUB_HOST
-from gim.core.tasks.repository import FirstFetch
+from gim.core.tasks.repository import FirstFetch, FetchForUpdate
 from gim.hooks.tasks import CheckRepositoryEvents
 
 from gim.front.mixins.views import LinkedToUserFormViewMixin, DeferrableViewPart
@@ -96,8 +96,10 @@ class AddRepositoryView(ToggleRepositoryBaseView):
             if repository.first_fetch_done:
                 message = 'Your subscription to <strong>%s</strong> was just added'
                 subscription.convert(form.can_use)
-                # start fetching events (it'll be ignored if there is already a queued job)
+                # start fetching events and updates (it'll be ignored if there
+                # is already a queued job)
                 CheckRepositoryEvents.add_job(repository.id)
+                FetchForUpdate.add_job(repository.id)
 
         messages.success(self.request, message % name)
 
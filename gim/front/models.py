@@ -17,7 +17,8 @@ from markdown import markdown
 from limpyd import model as lmodel, fields as lfields
 
 from gim.core import models as core_models, get_main_limpyd_database
-from gim.core.utils import contribute_to_model, cached_method
+from gim.core.utils import (contribute_to_model, cached_method, deferrable,
+                            merge_post_save_calls, post_save_key)
 
 from gim.events.models import EventPart
 
@@ -341,16 +342,26 @@ class _Issue(models.Model):
             self.update_saved_hash()
         return hash_obj.hash.hget()
 
-    def update_cached_template(self, force_regenerate=False):
+    @classmethod
+    def get_queryset_for_cached_template(cls):
+        """
+        Return a queryset of issues with all that is needed to render their
+        cached template, to minimize queries
+        """
+        return cls.objects.select_related('user', 'assignee', 'created_by', 'milestone')\
+                          .prefetch_related('labels__label_type')
+
+    def update_cached_template(self, force_regenerate=False, reload=True):
         """
         Update, if needed, the cached template for the current issue.
+        If `reload` is False, the issue must have been loaded with
+        get_queryset_for_cached_template
         """
         template = 'front/repository/issues/include_issue_item_for_cache.html'
 
-        # mnimize queries
-        issue = self.__class__.objects.filter(id=self.id)\
-                .select_related('user', 'assignee', 'created_by', 'milestone')\
-                .prefetch_related('labels__label_type')[0]
+        issue = self
+        if reload:
+            issue = self.get_queryset_for_cached_template().filter(id=self.id)[0]
 
         context = Context({
             'issue': issue,
@@ -359,6 +370,23 @@ class _Issue(models.Model):
 
         loader.get_template(template).render(context)
 
+    @classmethod
+    def update_cached_templates(cls, issue_ids, force_regenerate=False, chunk_size=100):
+        """
+        Update the saved hash and the cached template of the given issues,
+        loaded by chunks of `chunk_size`. Return the number of updated issues.
+        """
+        issue_ids = sorted(issue_ids)
+        count = 0
+        for start in range(0, len(issue_ids), chunk_size):
+            issues = cls.get_queryset_for_cached_template().filter(
+                                        id__in=issue_ids[start:start+chunk_size])
+            for issue in issues:
+                issue.update_saved_hash()
+                issue.update_cached_template(force_regenerate, reload=False)
+                count += 1
+        return count
+
     @cached_method
     def all_commits(self, include_deleted):
         qs = self.related_commits.select_related('commit__author',
@@ -775,7 +803,38 @@ class Hash(lmodel.RedisModel):
     hash = lfields.InstanceHashField()
 
 
+@deferrable(pipeline=Hash.database)
+def save_hash(hash_obj, hash):
+    """
+    Save the new hash of an object, pipelined with other ones in bulk_sync
+    """
+    hash_obj.hash.hset(hash)
+
+
+@deferrable(key=lambda issue_id: issue_id)
+def ask_for_issue_template_update(issue_id):
+    """
+    Add a job to update the cached template of an issue, only once by issue in
+    bulk_sync, and only if one is not already pending
+    """
+    from gim.core.tasks.issue import UpdateIssueCacheTemplate
+    UpdateIssueCacheTemplate.add_pending_job(issue_id)
+
+
+@deferrable(key=lambda instance: (instance.__class__, instance.pk))
+def ask_for_related_issues_template_update(instance):
+    """
+    Add a job to update the cached templates of all issues related to the
+    given object, only once by object in bulk_sync, and only if one is not
+    already pending
+    """
+    from gim.core.tasks.issue import UpdateRelatedIssuesCacheTemplate
+    UpdateRelatedIssuesCacheTemplate.add_pending_job(
+                            '%s#%s' % (instance.__class__.__name__, instance.pk))
+
+
 @receiver(post_save, dispatch_uid="hash_check")
+@deferrable(key=post_save_key, merge=merge_post_save_calls)
 def hash_check(sender, instance, created, **kwargs):
     """
     Check if the hash of the object has changed since its last save and if True,
@@ -808,15 +867,12 @@ def hash_check(sender, instance, created, **kwargs):
         return
 
     # save the new hash
-    hash_obj.hash.hset(instance.hash)
-
-    from gim.core.tasks.issue import UpdateIssueCacheTemplate
+    save_hash(hash_obj, instance.hash)
 
     if isinstance(instance, core_models.Issue):
         # if an issue, add a job to update its template
-        UpdateIssueCacheTemplate.add_job(instance.id)
+        ask_for_issue_template_update(instance.id)
 
     else:
         # if not an issue, add a job to update the templates of all related issues
-        for issue in instance.get_related_issues():
-            UpdateIssueCacheTemplate.add_job(issue.id)
+        ask_for_related_issues_template_update(instance)
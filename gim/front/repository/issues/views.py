@@ -2,12 +2,10 @@
 
 from datetime import datetime
 import json
-from math import ceil
 from time import sleep
 
 from django.contrib import messages
 from django.core.urlresolvers import reverse_lazy
-from django.db import DatabaseError
 from django.http import Http404, HttpResponseRedirect, HttpResponsePermanentRedirect
 from django.shortcuts import get_object_or_404, render
 from django.utils.datastructures import SortedDict
@@ -25,6 +23,7 @@ from gim.core.tasks.issue import (IssueEditStateJob, IssueEditTitleJob,
                                   IssueCreateJob, FetchIssueByNumber)
 from gim.core.tasks.comment import (IssueCommentEditJob, PullRequestCommentEditJob,
                                     CommitCommentEditJob)
+from gim.core.utils import get_in_chunk_size
 
 from gim.subscriptions.models import SUBSCRIPTION_STATES
 
@@ -506,22 +505,13 @@ class IssuesView(WithQueryStringViewMixin, BaseRepositoryView):
         else:
             limit_reached = False
 
-        try:
-            issues = list(issues.all())
-        except DatabaseError, e:
-            # sqlite limits the vars passed in the request to 999, and
-            # prefetch_related use a in(...), and with more than 999 issues
-            # sqlite raises an error.
-            # In this case, we loop on the data by slice of 999 issues
-            if u'%s' % e != 'too many SQL variables':
-                raise
-            queryset = issues
-            issues = []
-            per_fetch = 999
-
-            iterations = int(ceil(issues_count / float(per_fetch)))
-            for iteration in range(0, iterations):
-                issues += list(queryset[iteration * per_fetch:(iteration + 1) * per_fetch])
+        # prefetch_related uses a "IN" query, limited in size by the database
+        # (only 999 values for sqlite), so we load issues by slices if needed
+        queryset = issues
+        issues = []
+        per_fetch = get_in_chunk_size(queryset.db)
+        for start in range(0, issues_count, per_fetch):
+            issues += list(queryset[start:start + per_fetch])
 
         label_type = context['issues_filter']['objects'].get('group_by', None)
         attribute = context['issues_filter']['objects'].get('group_by_field', None)
@@ -1017,6 +1007,12 @@ class CommitAjaxIssueView(CommitViewMixin, SimpleAjaxIssueView):
         context = super(CommitAjaxIssueView, self).get_context_data(**kwargs)
         context['current_commit'] = self.commit
 
+        # commits fetched in a list have no files: fetch them when needed
+        if not self.commit.files_fetched_at and not self.commit.deleted:
+            from gim.core.tasks.commit import FetchCommitBySha
+            FetchCommitBySha.add_job('%s#%s' % (self.repository.id, self.commit.sha),
+                                     force_fetch='1')
+
         entry_points = self.commit.all_entry_points
 
         # force urls, as we are in an issue
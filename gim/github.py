@@ -44,9 +44,14 @@ ApiNotFoundError: https://api.github.com/users/github-not-exist-user/followers
 '''
 
 import base64
+import httplib
 import re
+import socket
+import threading
 import urllib
 import urllib2
+import urlparse
+import zlib
 
 import logging
 from pprint import pformat
@@ -71,8 +76,21 @@ try:
 except ImportError:
     import simplejson as json
 
+try:
+    # C-accelerated decoder, used for plain (non JsonObject) decoding
+    import ujson as fast_json
+except ImportError:
+    fast_json = None
+
 TIMEOUT = 60
 
+# max number of idle connections kept alive for each host
+POOL_MAXSIZE = 10
+MAX_REDIRECTS = 5
+
+# methods of requests that can be sent again if the response is lost
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
 _URL = 'https://api.github.com'
 _METHOD_MAP = dict(
         GET=lambda: 'GET',
@@ -86,12 +104,139 @@ RW_SCOPE = 'user,public_repo,repo,repo:status,gist'
 SCOPE_SPLITTER = re.compile('\,\s*')
 
 
+class HTTPSConnectionPool(object):
+
+    '''
+    A pool of keep-alive https connections, by host, safe to share between
+    threads: a connection is used by only one request at a time, and put back
+    in the pool once its response is fully read.
+    '''
+
+    def __init__(self, maxsize=POOL_MAXSIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def _get_connection(self, host, timeout):
+        '''
+        Return a tuple with an idle connection for the given host (or a new one
+        if none is available), and a flag telling if the connection is reused
+        '''
+        with self._lock:
+            idle = self._idle.get(host)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            return httplib.HTTPSConnection(host, timeout=timeout), False
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def _release_connection(self, host, conn):
+        '''
+        Put back the connection in the pool, or close it if the pool is full
+        '''
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        '''
+        Close all idle connections
+        '''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.itervalues():
+            for conn in connections:
+                conn.close()
+
+    def _request(self, host, method, path, body, headers, timeout):
+        '''
+        Send the request and return the response and the connection used.
+        If a reused connection was closed by the server in the meantime, retry
+        once with a fresh connection, but only if the request could not be sent
+        or is idempotent, to never send twice a request that is not.
+        '''
+        conn, reused = self._get_connection(host, timeout)
+        sent = False
+        try:
+            conn.request(method, path, body, headers)
+            sent = True
+            return conn.getresponse(), conn
+        except socket.timeout:
+            conn.close()
+            raise
+        except (httplib.BadStatusLine, httplib.CannotSendRequest, socket.error):
+            conn.close()
+            if not reused or sent and method not in IDEMPOTENT_METHODS:
+                raise
+
+        conn = httplib.HTTPSConnection(host, timeout=timeout)
+        try:
+            conn.request(method, path, body, headers)
+            return conn.getresponse(), conn
+        except Exception:
+            conn.close()
+            raise
+
+    def urlopen(self, method, url, body=None, headers=None, timeout=None):
+        '''
+        Make a request and return a tuple with the status code, the headers (a
+        httplib.HTTPMessage) and the content of the response.
+        The content is always fully read, to be able to reuse the connection.
+        Redirects are followed the same way urllib2 does.
+        '''
+        headers = dict(headers or {})
+        for redirect in range(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            path = parts.path or '/'
+            if parts.query:
+                path = '%s?%s' % (path, parts.query)
+
+            response, conn = self._request(parts.netloc, method, path, body,
+                                           headers, timeout or TIMEOUT)
+            try:
+                content = response.read()
+            except Exception:
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._release_connection(parts.netloc, conn)
+
+            location = response.getheader('location')
+            if location and (response.status in (301, 302, 303, 307) and method in ('GET', 'HEAD')
+                          or response.status in (301, 302, 303) and method == 'POST'):
+                url = urlparse.urljoin(url, location)
+                if method == 'POST':
+                    method, body = 'GET', None
+                    headers = dict((k, v) for k, v in headers.iteritems()
+                                   if k.lower() not in ('content-length', 'content-type'))
+                continue
+
+            return response.status, response.msg, content
+
+        raise ApiError(url, JsonObject(method=method, url=url),
+                       JsonObject(code=response.status, json=None))
+
+
+http_pool = HTTPSConnectionPool()
+
+
 class GitHub(object):
 
     '''
     GitHub client.
     '''
 
+    # pool of keep-alive connections, shared by all clients
+    http_pool = http_pool
+
     def __init__(self, username=None, password=None, access_token=None, client_id=None, client_secret=None, redirect_uri=None, scope=None):
         self._reset_headers()
         self._authorization = None
@@ -156,7 +301,7 @@ class GitHub(object):
     def __getattr__(self, attr):
         return _Callable(self, '/%s' % attr)
 
-    def _http(self, method, path, request_headers=None, response_headers=None, json_post=True, timeout=None, kw={}):
+    def _http(self, method, path, request_headers=None, response_headers=None, json_post=True, timeout=None, kw={}, json_objects=True):
         data = None
         if method == 'GET' and kw:
             path = '%s?%s' % (path, _encode_params(kw))
@@ -170,49 +315,53 @@ class GitHub(object):
             logger.info('REQUEST %s %s %s', method, url, request_headers)
         else:
             logger.info('%s REQUEST %s %s %s', '*' * 10, method, url, pformat(request_headers))
-        opener = urllib2.build_opener(urllib2.HTTPSHandler)
-        request = urllib2.Request(url, data=data, headers=request_headers or {})
-        request.get_method = _METHOD_MAP[method]
+        headers = dict(request_headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip, deflate')
         if self._authorization:
-            request.add_header('Authorization', self._authorization)
+            headers['Authorization'] = self._authorization
         if method in ('POST', 'PUT', 'PATCH'):
-            request.add_header('Content-Type', 'application/x-www-form-urlencoded')
-        try:
-            response = opener.open(request, timeout=timeout or TIMEOUT)
-            is_json = self._process_resp(response.headers)
-            if isinstance(response_headers, dict):
-                response_headers.update(response.headers.dict.copy())
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        code, headers, content = self._request(method, url, data, headers, timeout)
+        is_json = self._process_resp(headers)
+        if isinstance(response_headers, dict):
+            response_headers.update(headers.dict.copy())
+        if 200 <= code < 300:
             if logger.level > logging.DEBUG:
-                logger.info('==> %s', 200)
+                logger.info('==> %s', code)
             else:
-                logger.debug('=========> RESPONSE %s %s', 200, pformat(response_headers))
-            content = response.read()
+                logger.debug('=========> RESPONSE %s %s', code, pformat(response_headers))
             # if logger.level <= logging.DEBUG:
             #     logger.debug('CONTENT\n' + '=' * 40)
             #     logger.debug('%s', pformat(_parse_json(content) if is_json else content))
             #     logger.debug('\n' + '=' * 40)
             if is_json:
-                return _parse_json(content)
+                return _parse_json(content, json_objects)
             else:
                 return content
-        except urllib2.HTTPError, e:
-            is_json = self._process_resp(e.headers)
-            if isinstance(response_headers, dict):
-                response_headers.update(e.headers.dict.copy())
+        else:
             if logger.level > logging.DEBUG:
-                logger.info('==> %s', e.code)
+                logger.info('==> %s', code)
             else:
-                logger.debug('=========> RESPONSE %s %s', e.code, pformat(response_headers))
-            if is_json:
-                _json = _parse_json(e.read())
+                logger.debug('=========> RESPONSE %s %s', code, pformat(response_headers))
+            if is_json and content:
+                _json = _parse_json(content)
             else:
                 _json = None
             req = JsonObject(method=method, url=url)
-            resp = JsonObject(code=e.code, json=_json)
+            resp = JsonObject(code=code, json=_json)
             if resp.code == 404:
                 raise ApiNotFoundError(url, req, resp)
             raise ApiError(url, req, resp)
 
+    def _request(self, method, url, body, headers, timeout):
+        '''
+        Do the real http request and return a tuple with the status code, the
+        response headers and the content
+        '''
+        code, headers, content = self.http_pool.urlopen(method, url, body=body,
+                                            headers=headers, timeout=timeout)
+        return code, headers, _decode_content(headers, content)
+
     def _process_resp(self, headers):
         is_json = False
         self._reset_headers()
@@ -241,8 +390,8 @@ class _Executable(object):
         self._method = method
         self._path = path
 
-    def __call__(self, request_headers=None, response_headers=None, json_post=True, timeout=None, **kw):
-        return self._gh._http(self._method, self._path, request_headers, response_headers, json_post, timeout, kw)
+    def __call__(self, request_headers=None, response_headers=None, json_post=True, timeout=None, json_objects=True, **kw):
+        return self._gh._http(self._method, self._path, request_headers, response_headers, json_post, timeout, kw, json_objects)
 
     def __str__(self):
         return '_Executable (%s %s)' % (self._method, self._path)
@@ -308,13 +457,36 @@ def _encode_json(obj):
     return json.dumps(obj, default=_dump_obj)
 
 
-def _parse_json(jsonstr):
-    def _obj_hook(pairs):
-        o = JsonObject()
-        for k, v in pairs.iteritems():
-            o[str(k)] = v
-        return o
-    return json.loads(jsonstr, object_hook=_obj_hook)
+def _decode_content(headers, content):
+    '''
+    Decompress content sent with a gzip or deflate content-encoding.
+    '''
+    encoding = headers.get('content-encoding', '').strip().lower() if headers else ''
+    if not content or encoding not in ('gzip', 'deflate'):
+        return content
+    if encoding == 'gzip':
+        content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+    else:
+        try:
+            content = zlib.decompress(content)
+        except zlib.error:
+            # raw deflate stream, without zlib header
+            content = zlib.decompress(content, -zlib.MAX_WBITS)
+    del headers['content-encoding']
+    return content
+
+
+def _parse_json(jsonstr, json_objects=True):
+    '''
+    Decode json str. Objects are JsonObject (dict with attribute access) by
+    default, or plain dicts if json_objects is False (using the C-accelerated
+    ujson decoder if installed).
+    '''
+    if not json_objects:
+        if fast_json is not None:
+            return fast_json.loads(jsonstr)
+        return json.loads(jsonstr)
+    return json.loads(jsonstr, object_hook=JsonObject)
 
 
 class ApiError(Exception):
@@ -5,7 +5,7 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 
 from gim.core.models import Repository, Issue
-from gim.core.utils import contribute_to_model
+from gim.core.utils import contribute_to_model, deferrable
 
 
 class _Repository(models.Model):
@@ -23,6 +23,7 @@ contribute_to_model(_Repository, Repository)
 
 
 @receiver(post_save, sender=Issue, dispatch_uid="update_graphs_data")
+@deferrable(key=lambda sender, instance, **kwargs: instance.repository_id)
 def update_graphs_data(sender, instance, created, **kwargs):
     if not isinstance(instance, Issue):
         return
@@ -5,19 +5,29 @@ __all__ = [
 
 from random import randint
 
+from django.conf import settings
+
+from limpyd import fields
 from limpyd_jobs import STATUSES
 
+from gim.core.limpyd_models import RepositoryActivity
+from gim.core.managers import get_sync_counters
 from gim.core.tasks.repository import RepositoryJob
 
 
 class CheckRepositoryEvents(RepositoryJob):
     """
-    Every minute, if the hook is not set, check the new events.
+    If the hook is not set, regularly check the new events, with a delay
+    depending on the activity of the repository (at least the one given by
+    github)
     """
     queue_name = 'check-repo-events'
 
     permission = 'read'
 
+    next_delay = fields.InstanceHashField()
+    next_delay_reason = fields.InstanceHashField()
+
     def run(self, queue):
         """
         Get the last events of the repository to update data and fetch updated
@@ -30,31 +40,44 @@ class CheckRepositoryEvents(RepositoryJob):
             # we'll run on the "hook" mode
             # also, do not fetch events if no sbuscriptions for a repository
             self.status.hset(STATUSES.CANCELED)
+            RepositoryActivity.get_for('CheckRepositoryEvents', repository).stop()
             return
 
         gh = self.gh
         if not gh:
             return  # it's delayed !
 
-        updated_issues_count, delay = repository.check_events(gh)
+        updated_issues_count, min_delay = repository.check_events(gh)
+        min_delay = min_delay or 60
+
+        delay, reason = RepositoryActivity.get_for('CheckRepositoryEvents', repository).plan_next_run(
+            nb_changes=updated_issues_count,
+            api_calls=get_sync_counters()['api_calls'],
+            min_delay=min_delay,
+            max_delay=max(min_delay, settings.REPOSITORY_EVENTS_MAX_DELAY),
+        )
+        self.hmset(next_delay=delay, next_delay_reason=reason)
 
-        return updated_issues_count, delay or 60
+        return updated_issues_count, delay
 
     def on_success(self, queue, result):
         """
-        Go check events again in the minimal delay given by gtthub, but only if
-        the hook is not set on this repository
+        Go check events again in the delay computed from the activity of the
+        repository (never less than the minimal one given by github), but only
+        if the hook is not set on this repository
         This delay is passed as the result argument.
         """
         updated_issues_count, delay = result
-        self.clone(delayed_for=delay + randint(0, 10))
+        self.clone(delayed_for=delay)
 
     def success_message_addon(self, queue, result):
         """
-        Display the count of updated issues
+        Display the count of updated issues, and when the next check will be
+        done, and why
         """
         updated_issues_count, delay = result
-        return ' [updated=%d]' % updated_issues_count
+        return ' [updated=%d, next in %ss: %s]' % (
+                updated_issues_count, delay, self.next_delay_reason.hget())
 
 
 class CheckRepositoryHook(RepositoryJob):
@@ -283,6 +283,37 @@ GITHUB_CLIENT_SECRET = get_env_variable('GITHUB_CLIENT_SECRET')
 
 GITHUB_HOOK_URL = get_env_variable('GITHUB_HOOK_URL', default=None)
 
+# max number of pages of a same list fetched at the same time (1 to disable)
+GITHUB_PARALLEL_PAGES = int(get_env_variable('GITHUB_PARALLEL_PAGES', default=4))
+
+# max number of pull requests of a same repository fetched at the same time by
+# the jobs updating them one by one (1 to disable)
+GITHUB_PARALLEL_PRS = int(get_env_variable('GITHUB_PARALLEL_PRS', default=4))
+
+# number of pages of a list fetched by each job ("shard") of the first fetch of
+# a repository, and max number of these jobs running at the same time for a
+# same repository
+FIRST_FETCH_SHARD_PAGES = int(get_env_variable('FIRST_FETCH_SHARD_PAGES', default=10))
+FIRST_FETCH_MAX_RUNNING_SHARDS = int(get_env_variable('FIRST_FETCH_MAX_RUNNING_SHARDS', default=4))
+
+# max size, in bytes, of the compressed responses kept to do conditional
+# requests on github (0 to disable)
+GITHUB_RESPONSE_CACHE_MAX_SIZE = int(get_env_variable('GITHUB_RESPONSE_CACHE_MAX_SIZE', default=100*1024*1024))
+
+# delay, in seconds, between two full fetches of a repository, to detect
+# deleted issues and comments (other fetches only get updated ones)
+REPOSITORY_RECONCILIATION_DELAY = int(get_env_variable('REPOSITORY_RECONCILIATION_DELAY', default=24*60*60))
+
+# bounds of the delay, in seconds, between two updates of a repository, and
+# between two checks of its events (if no hook), adapted to its activity
+REPOSITORY_UPDATE_MIN_DELAY = int(get_env_variable('REPOSITORY_UPDATE_MIN_DELAY', default=5*60))
+REPOSITORY_UPDATE_MAX_DELAY = int(get_env_variable('REPOSITORY_UPDATE_MAX_DELAY', default=2*60*60))
+REPOSITORY_EVENTS_MAX_DELAY = int(get_env_variable('REPOSITORY_EVENTS_MAX_DELAY', default=10*60))
+
+# max number of api calls by hour used by the jobs above, for all repositories
+# (their delays are increased to respect it, 0 to disable)
+GITHUB_API_BUDGET = int(get_env_variable('GITHUB_API_BUDGET', default=0))
+
 DATABASES = {  # default to a sqlite db "gim.db"
     'default': {
         'ENGINE': get_env_variable('DB_ENGINE', default='django.db.backends.sqlite3'),